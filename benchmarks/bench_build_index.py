@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Benchmark: build_index row construction with per-book URL lookups vs URLs rendered on read.
+
+Creates one synthetic site database of --books books with two formats each and
+builds their index.db rows without writing them: first for the first --sample
+books with the get_desc_url/get_img_url/get_format_url helpers, which read the
+site table for every URL as build_index used to, then for every book as
+build_index does now, without URLs (the summary view renders them from the
+site's templates). Prints books/s of each. build_index is then run once and the
+URLs read from the summary view are checked against the helpers' ones, and the
+size of index.db per book is printed. With --workers, a full build_index is
+then run from scratch for each number of reader processes, and the resulting
+summary views are compared.
+
+    python3 benchmarks/bench_build_index.py --books 1000000 --sample 50000
+    python3 benchmarks/bench_build_index.py --books 200000 --sample 10000 --workers 0,2,4
+"""
+
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import sys
+import time
+
+from bench_common import prepare_workdir
+
+
+def make_site(functions, books, major):
+    db = functions.init_site_db("http://10.1.2.3:8080", _uuid="bench-site", dir="./data/")
+    db["site"].update("bench-site", {"major": major, "version": f"{major}.0"})
+    rows = ((f"bench-{i:08d}", i, "main", f"Book number {i}", json.dumps([f"Author {i % 997}"]),
+             "Series" if i % 3 else None, 1, "eng", json.dumps({"isbn": f"978{i:010d}"}), json.dumps(["fiction"]),
+             "Fake Press", "2001-01-01T00:00:00+00:00", "2020-01-01T00:00:00+00:00", "2020-01-01T00:00:00+00:00",
+             json.dumps(["epub", "pdf"]), 1) for i in range(1, books + 1))
+    sizes = ((f"bench-{i:08d}", f, base + i) for i in range(1, books + 1) for f, base in (("epub", 100000), ("pdf", 200000)))
+    with db.conn:
+        db.conn.executemany(
+            "INSERT INTO ebooks (uuid, id, library, title, authors, series, series_index, language, identifiers, "
+            "tags, publisher, pubdate, last_modified, timestamp, formats, cover) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        db.conn.executemany("INSERT INTO ebook_formats (uuid, format, size) VALUES (?, ?, ?)", sizes)
+    return db
+
+
+def per_book_summary(functions, db, ebook):
+    """build_index's summary construction before the per-site context, reduced to its URLs."""
+    formats = json.loads(ebook["formats"])
+    return {
+        "uuid": ebook["uuid"],
+        "title": functions.get_desc_url(db, ebook),
+        "cover": functions.get_img_url(db, ebook),
+        "links": [functions.get_format_url(db, ebook, f) for f in formats],
+    }
+
+
+def rendered_urls(uuids):
+    """The URLs of books as the summary view renders them, in per_book_summary's shape."""
+    rendered = []
+    with contextlib.closing(sqlite3.connect("data/index.db")) as conn:
+        for uuid in uuids:
+            title, cover, links = conn.execute("SELECT title, cover, links FROM summary WHERE uuid = ?",
+                                               [uuid]).fetchone()
+            rendered.append({"uuid": uuid, "title": json.loads(title)["href"], "cover": json.loads(cover)["img_src"],
+                             "links": [link["href"] for link in json.loads(links)]})
+    return rendered
+
+
+def index_hash():
+    digest = hashlib.sha256()
+    with contextlib.closing(sqlite3.connect("data/index.db")) as conn:
+        for row in conn.execute("SELECT rowid, * FROM summary ORDER BY rowid"):
+            digest.update(repr(row).encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--books", type=int, default=1000000)
+    parser.add_argument("--sample", type=int, default=50000, help="books run through the per-book lookups")
+    parser.add_argument("--major", type=int, default=5, help="Calibre major version of the site")
+    parser.add_argument("--workers", default="", help="comma separated reader counts for full build_index runs")
+    args = parser.parse_args()
+
+    prepare_workdir()
+    import logging
+    import functions
+    # The helpers log one line per URL; keep the log file out of the measurement
+    logging.disable(logging.INFO)
+
+    start = time.perf_counter()
+    db = make_site(functions, args.books, args.major)
+    print(f"{args.books} books generated in {time.perf_counter() - start:.1f}s")
+
+    start = time.perf_counter()
+    before = [per_book_summary(functions, db, dict(ebook))
+              for ebook in db.query(f"SELECT * FROM ebooks LIMIT {args.sample}")]
+    before_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    sizes = functions.calishot_formats.sizes(db)
+    for ebook in db.query("SELECT * FROM ebooks"):
+        functions.calishot_indexsync.book_row(functions.calishot_indexsync.ebook_summary(1, ebook, sizes.get(ebook["uuid"])))
+    after_s = time.perf_counter() - start
+
+    print(f"{'URLs':>8} {'books':>8} {'seconds':>8} {'books/s':>8}")
+    print(f"{'per book':>8} {len(before):>8} {before_s:>8.2f} {len(before) / before_s:>8.0f}")
+    print(f"{'on read':>8} {args.books:>8} {after_s:>8.2f} {args.books / after_s:>8.0f}")
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        functions.build_index()
+    elapsed = time.perf_counter() - start
+    with contextlib.closing(sqlite3.connect("data/index.db")) as conn:
+        conn.execute("VACUUM")
+    size = os.path.getsize("data/index.db")
+    print(f"build_index: {elapsed:.2f}s, index.db {size / 1024 / 1024:.1f} MB ({size / args.books:.0f} bytes/book)")
+    print("same URLs:", before == rendered_urls([book["uuid"] for book in before]))
+
+    if args.workers:
+        print(f"{'workers':>7} {'seconds':>8} {'books/s':>8} {'summary hash':>17}")
+        for workers in [int(w) for w in args.workers.split(",")]:
+            if os.path.exists("data/index.db"):
+                os.remove("data/index.db")
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                functions.build_index(workers=workers)
+            elapsed = time.perf_counter() - start
+            print(f"{workers:>7} {elapsed:>8.2f} {args.books / elapsed:>8.0f} {index_hash():>17}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,54 @@
+"""
+Shared helpers for the benchmark scripts.
+
+functions.py opens ./data/sites.db and reads ./config.ini at import time, so the
+benchmarks run inside a throw-away working directory that provides both.
+"""
+
+import os
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+FAKE_SERVER = Path(__file__).resolve().parent / "fake_calibre.py"
+
+
+def prepare_workdir():
+    """Create a temp dir with config.ini and data/, chdir into it and make the repo importable."""
+    workdir = Path(tempfile.mkdtemp(prefix="calishot-bench-"))
+    (workdir / "data").mkdir()
+    (workdir / "config.ini").write_text("[shodan]\napi_key = benchmark-dummy-key\n")
+    os.chdir(workdir)
+    if str(REPO_ROOT) not in sys.path:
+        sys.path.insert(0, str(REPO_ROOT))
+    return workdir
+
+
+def start_fake_server(**options):
+    """Start fake_calibre.py in a subprocess. Returns (process, base_url)."""
+    cmd = [sys.executable, str(FAKE_SERVER), "--port", "0"]
+    for key, value in options.items():
+        if value is None:
+            continue
+        cmd += ["--" + key.replace("_", "-"), str(value)]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True)
+    port = int(proc.stdout.readline().strip())
+    return proc, f"http://127.0.0.1:{port}"
+
+
+def stop_fake_server(proc):
+    proc.terminate()
+    try:
+        proc.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+
+def server_stats(base_url):
+    """Return the fake server's connection/request counters."""
+    import json
+    import urllib.request
+    with urllib.request.urlopen(base_url + "/_stats", timeout=5) as r:
+        return json.loads(r.read().decode("utf-8"))
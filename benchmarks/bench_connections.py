@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Benchmark: TCP connections opened per indexed site, with and without the session registry.
+
+Runs check_calibre_site + index_ebooks against a fake Calibre server twice:
+once with calishot_http pooling disabled (every call a bare requests.get(),
+the old behaviour) and once with the per-host keep-alive sessions. The fake
+server counts accepted connections, so the difference is measured, not guessed.
+
+    python3 benchmarks/bench_connections.py --sites 5 --books 3000 --libraries 2
+"""
+
+import argparse
+import contextlib
+import io
+import sqlite3
+import sys
+import time
+
+from bench_common import prepare_workdir, server_stats, start_fake_server, stop_fake_server
+
+
+def run(functions, base_url, n_sites, pooled):
+    functions.calishot_http.registry.close_all()
+    functions.calishot_http.registry.enabled = pooled
+    before = server_stats(base_url)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(n_sites):
+            functions.check_calibre_site({"uuid": f"bench-{i}", "url": base_url})
+            functions.index_ebooks(base_url)
+    elapsed = time.perf_counter() - start
+    after = server_stats(base_url)
+    functions.calishot_http.registry.close_all()
+    connections = after["connections"] - before["connections"]
+    requests_made = after["requests"] - before["requests"]
+    return connections, requests_made, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sites", type=int, default=5)
+    parser.add_argument("--books", type=int, default=3000)
+    parser.add_argument("--libraries", type=int, default=2)
+    parser.add_argument("--latency", type=float, default=0.0)
+    args = parser.parse_args()
+
+    workdir = prepare_workdir()
+    proc, base_url = start_fake_server(books=args.books, libraries=args.libraries, latency=args.latency)
+    try:
+        with sqlite3.connect(workdir / "data" / "sites.db") as conn:
+            conn.execute("CREATE TABLE sites (uuid TEXT PRIMARY KEY, url TEXT, hostnames TEXT, status TEXT, "
+                         "last_check TEXT, book_count INTEGER, last_book_count INTEGER, new_books INTEGER, "
+                         "libraries_count INTEGER)")
+            conn.execute("INSERT INTO sites (uuid, url) VALUES ('bench-site', ?)", (base_url,))
+        import functions
+
+        print(f"{args.sites} sites x {args.books} books in {args.libraries} libraries")
+        print(f"{'mode':>10} {'requests':>9} {'connections':>12} {'conn/site':>10} {'seconds':>8}")
+        for label, pooled in (("before", False), ("after", True)):
+            connections, requests_made, elapsed = run(functions, base_url, args.sites, pooled)
+            print(f"{label:>10} {requests_made:>9} {connections:>12} {connections / args.sites:>10.1f} {elapsed:>8.2f}")
+    finally:
+        stop_fake_server(proc)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Benchmark: /ajax calls of a full index pass vs an incremental re-index.
+
+Indexes a library on the fake Calibre server, adds and edits a few books, and
+indexes it again. With the per-library high-water mark the second pass stops
+at the first already-known book and only re-fetches the edited ones; with
+force_refresh=True it pages through the whole library as before.
+
+    python3 benchmarks/bench_incremental.py --books 20000 --added 30 --edited 3
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import sqlite3
+import sys
+import time
+import urllib.request
+
+from bench_common import prepare_workdir, server_stats, start_fake_server, stop_fake_server
+
+
+def index_pass(functions, base_url, force_refresh=False):
+    before = server_stats(base_url)["calls"]
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        functions.index_ebooks(base_url, force_refresh=force_refresh)
+    elapsed = time.perf_counter() - start
+    after = server_stats(base_url)["calls"]
+    return {k: after.get(k, 0) - before.get(k, 0) for k in ("search", "books")}, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--books", type=int, default=20000)
+    parser.add_argument("--added", type=int, default=30)
+    parser.add_argument("--edited", type=int, default=3)
+    args = parser.parse_args()
+
+    workdir = prepare_workdir()
+    proc, base_url = start_fake_server(books=args.books)
+    try:
+        with sqlite3.connect(workdir / "data" / "sites.db") as conn:
+            conn.execute("CREATE TABLE sites (uuid TEXT PRIMARY KEY, url TEXT, hostnames TEXT, status TEXT, "
+                         "last_check TEXT, book_count INTEGER, last_book_count INTEGER, new_books INTEGER, "
+                         "libraries_count INTEGER)")
+            conn.execute("INSERT INTO sites (uuid, url) VALUES ('bench-site', ?)", (base_url,))
+        import functions
+
+        print(f"{'pass':>12} {'search':>7} {'books':>6} {'seconds':>8}")
+        calls, elapsed = index_pass(functions, base_url)
+        print(f"{'full':>12} {calls['search']:>7} {calls['books']:>6} {elapsed:>8.2f}")
+
+        urllib.request.urlopen(f"{base_url}/_add?n={args.added}").read()
+        for i in range(1, args.edited + 1):
+            urllib.request.urlopen(f"{base_url}/_touch?id={i * 7}").read()
+
+        calls, elapsed = index_pass(functions, base_url)
+        print(f"{'incremental':>12} {calls['search']:>7} {calls['books']:>6} {elapsed:>8.2f}")
+        calls, elapsed = index_pass(functions, base_url, force_refresh=True)
+        print(f"{'forced':>12} {calls['search']:>7} {calls['books']:>6} {elapsed:>8.2f}")
+
+        conn = sqlite3.connect(workdir / "data" / "bench-site.db")
+        rows = conn.execute("SELECT count(*) FROM ebooks").fetchone()[0]
+        edited = conn.execute("SELECT count(*) FROM ebooks WHERE last_modified > '2021'").fetchone()[0]
+        mark = conn.execute("SELECT timestamp, boundary_uuids FROM watermarks").fetchall()
+        print(f"ebooks rows: {rows} (expected {args.books + args.added}), edited rows refreshed: {edited}")
+        print(f"watermarks: {json.dumps(mark)}")
+    finally:
+        stop_fake_server(proc)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Benchmark: r.json() vs streaming decode of a large /ajax/books response.
+
+Fetches the same books?ids= page from a fake Calibre server whose books carry
+long comments, once decoded with r.json() and once with
+calishot_jsonstream.JSONObjectStream over r.iter_content(). Prints the response
+size, wall-clock time and the peak Python heap (tracemalloc) of each, and checks
+that both give the same books.
+
+    python3 benchmarks/bench_jsondecode.py --books 1000 --comment-size 20000,100000
+"""
+
+import argparse
+import sys
+import time
+import tracemalloc
+
+from bench_common import prepare_workdir, start_fake_server, stop_fake_server
+
+
+def measure(decode):
+    tracemalloc.start()
+    start = time.perf_counter()
+    books, nbytes = decode()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return books, nbytes, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--books", type=int, default=1000, help="ids per books?ids= call")
+    parser.add_argument("--comment-size", default="2000,20000,100000", help="comma separated comments lengths")
+    args = parser.parse_args()
+
+    prepare_workdir()
+    import calishot_http
+    import calishot_jsonstream
+
+    print(f"{'comments':>8} {'body MB':>8} {'json s':>7} {'json peak MB':>12} {'stream s':>8} {'stream peak MB':>14} same")
+    for size in [int(s) for s in args.comment_size.split(",")]:
+        proc, base_url = start_fake_server(books=args.books, comment_size=size)
+        try:
+            url = f"{base_url}/ajax/books/main?ids=" + ",".join(str(i) for i in range(1, args.books + 1))
+
+            def with_json():
+                r = calishot_http.get(url, timeout=60)
+                return r.json(), len(r.content)
+
+            def with_stream():
+                r = calishot_http.get(url, timeout=60, stream=True)
+                stream = calishot_jsonstream.JSONObjectStream(r.iter_content(chunk_size=65536))
+                books = dict(stream)
+                r.close()
+                return books, stream.bytes
+
+            plain, nbytes, plain_s, plain_peak = measure(with_json)
+            streamed, _, stream_s, stream_peak = measure(with_stream)
+            mb = 1024 * 1024
+            print(f"{size:>8} {nbytes / mb:>8.1f} {plain_s:>7.2f} {plain_peak / mb:>12.1f} "
+                  f"{stream_s:>8.2f} {stream_peak / mb:>14.1f} {plain == streamed}")
+        finally:
+            stop_fake_server(proc)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
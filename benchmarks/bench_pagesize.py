@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Benchmark: fixed vs adaptive page size for /ajax/search + /ajax/books paging.
+
+Two fake Calibre servers: a fast one where every request costs mostly latency
+(bigger pages mean fewer round trips), and a slow home server that rejects
+books?ids= calls above --max-ids with a 503 (fixed 1000-id pages never get
+through). Each server is indexed with fixed pages of --num ids, then twice
+adaptively: cold, and warm from the page size the cold run persisted.
+
+    python3 benchmarks/bench_pagesize.py --books 20000 --latency 0.3 --max-ids 300
+"""
+
+import argparse
+import contextlib
+import io
+import sqlite3
+import sys
+import time
+
+from bench_common import prepare_workdir, server_stats, start_fake_server, stop_fake_server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--books", type=int, default=20000)
+    parser.add_argument("--latency", type=float, default=0.3)
+    parser.add_argument("--per-item-latency", type=float, default=0.00005)
+    parser.add_argument("--max-ids", type=int, default=300, help="slow server: largest accepted books?ids= call")
+    parser.add_argument("--num", type=int, default=1000, help="fixed page size, and the adaptive starting size")
+    args = parser.parse_args()
+
+    workdir = prepare_workdir()
+    servers = {
+        "fast": start_fake_server(books=args.books, latency=args.latency, per_item_latency=args.per_item_latency),
+        "slow": start_fake_server(books=args.books // 4, latency=args.latency, per_item_latency=args.per_item_latency,
+                                  max_ids=args.max_ids),
+    }
+    try:
+        with sqlite3.connect(workdir / "data" / "sites.db") as conn:
+            conn.execute("CREATE TABLE sites (uuid TEXT PRIMARY KEY, url TEXT, hostnames TEXT, status TEXT, "
+                         "last_check TEXT, book_count INTEGER, last_book_count INTEGER, new_books INTEGER, "
+                         "libraries_count INTEGER)")
+            for name, (_, base_url) in servers.items():
+                conn.execute("INSERT INTO sites (uuid, url) VALUES (?, ?)", (name, base_url))
+        import functions
+
+        print(f"fast: {args.books} books, slow: {args.books // 4} books and at most {args.max_ids} ids per call; "
+              f"latency {args.latency}s + {args.per_item_latency}s/id")
+        print(f"{'server':>6} {'mode':>14} {'seconds':>8} {'rows':>7} {'books calls':>11} {'page size':>10}")
+        for name, (_, base_url) in servers.items():
+            site_db = workdir / "data" / f"{name}.db"
+            for mode, adaptive in (("fixed", False), ("adaptive cold", True), ("adaptive warm", True)):
+                if site_db.exists():
+                    site_db.unlink()
+                before = server_stats(base_url)["calls"].get("books", 0)
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    functions.index_ebooks(base_url, num=args.num, force_refresh=True, adaptive=adaptive)
+                elapsed = time.perf_counter() - start
+                calls = server_stats(base_url)["calls"].get("books", 0) - before
+                conn = sqlite3.connect(site_db)
+                rows = conn.execute("SELECT COUNT(*) FROM ebooks").fetchone()[0] if "ebooks" in {
+                    r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")} else 0
+                conn.close()
+                size = args.num
+                if adaptive:
+                    size = sqlite3.connect(workdir / "data" / "sites.db").execute(
+                        "SELECT page_size FROM server_capabilities WHERE server = ?", (base_url,)).fetchone()[0]
+                print(f"{name:>6} {mode:>14} {elapsed:>8.2f} {rows:>7} {calls:>11} {size!s:>10}")
+    finally:
+        for proc, _ in servers.values():
+            stop_fake_server(proc)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Benchmark: sequential vs pipelined (prefetching) index_ebooks, with identical output.
+
+Indexes the same library on a fake Calibre server with injected latency, once
+with prefetch=0 (fetch, transform and write strictly in turn) and once per
+requested prefetch depth. Prints wall-clock time and the per-stage timings, and
+checks that every run leaves byte-for-byte the same ebooks rows.
+
+    python3 benchmarks/bench_pipeline.py --books 5000 --latency 0.2 --prefetch 0,1,2,4
+"""
+
+import argparse
+import contextlib
+import hashlib
+import io
+import sqlite3
+import sys
+import time
+
+from bench_common import prepare_workdir, start_fake_server, stop_fake_server
+
+
+def dump_hash(path):
+    conn = sqlite3.connect(path)
+    digest = hashlib.sha256()
+    for row in conn.execute("SELECT * FROM ebooks ORDER BY uuid"):
+        digest.update(repr(row).encode("utf-8"))
+    conn.close()
+    return digest.hexdigest()[:16]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--books", type=int, default=5000)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--per-item-latency", type=float, default=0.0002)
+    parser.add_argument("--num", type=int, default=500, help="page size")
+    parser.add_argument("--prefetch", default="0,1,2,4")
+    args = parser.parse_args()
+
+    workdir = prepare_workdir()
+    proc, base_url = start_fake_server(books=args.books, latency=args.latency, per_item_latency=args.per_item_latency)
+    try:
+        with sqlite3.connect(workdir / "data" / "sites.db") as conn:
+            conn.execute("CREATE TABLE sites (uuid TEXT PRIMARY KEY, url TEXT, hostnames TEXT, status TEXT, "
+                         "last_check TEXT, book_count INTEGER, last_book_count INTEGER, new_books INTEGER, "
+                         "libraries_count INTEGER)")
+            conn.execute("INSERT INTO sites (uuid, url) VALUES ('bench-site', ?)", (base_url,))
+        import functions
+
+        site_db = workdir / "data" / "bench-site.db"
+        print(f"{args.books} books, page {args.num}, latency {args.latency}s + {args.per_item_latency}s/id")
+        print(f"{'prefetch':>8} {'seconds':>8} {'rows hash':>17}  stages")
+        for depth in [int(d) for d in args.prefetch.split(",")]:
+            if site_db.exists():
+                site_db.unlink()
+            out = io.StringIO()
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(out):
+                functions.index_ebooks(base_url, num=args.num, force_refresh=True, prefetch=depth)
+            elapsed = time.perf_counter() - start
+            stages = [l.split(": ", 1)[1] for l in out.getvalue().splitlines() if "stage timings" in l]
+            print(f"{depth:>8} {elapsed:>8.2f} {dump_hash(site_db):>17}  {'; '.join(stages)}")
+    finally:
+        stop_fake_server(proc)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
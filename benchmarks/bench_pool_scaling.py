@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+Benchmark: wall-clock time of check_calibre_site over a gevent pool, by pool size.
+
+Starts a fake Calibre server with injected latency in a subprocess and probes
+the same number of sites with increasing pool sizes. With sockets patched
+(default) the time should drop roughly linearly with pool size; run with
+CALISHOT_CONCURRENCY=off to see the old serial behaviour.
+
+    python3 benchmarks/bench_pool_scaling.py --sites 100 --latency 0.1
+"""
+
+import argparse
+import contextlib
+import io
+import sys
+import time
+
+from bench_common import prepare_workdir, start_fake_server, stop_fake_server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sites", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.1)
+    parser.add_argument("--pool-sizes", default="1,10,50,100")
+    args = parser.parse_args()
+
+    prepare_workdir()
+    proc, base_url = start_fake_server(latency=args.latency, books=100)
+    try:
+        import functions
+
+        sites = [{"uuid": f"bench-{i}", "url": base_url} for i in range(args.sites)]
+        print(f"concurrency mode: {functions.CONCURRENCY_MODE}, {args.sites} sites, latency {args.latency}s/request")
+        print(f"{'pool':>6} {'seconds':>9} {'sites/s':>9}")
+        for size in [int(s) for s in args.pool_sizes.split(",")]:
+            pool = functions.make_pool(size)
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                results = pool.map(functions.check_calibre_site, sites)
+            elapsed = time.perf_counter() - start
+            online = sum(1 for r in results if r and r.get("status") == "online")
+            print(f"{size:>6} {elapsed:>9.2f} {args.sites / elapsed:>9.1f}   ({online} online)")
+    finally:
+        stop_fake_server(proc)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
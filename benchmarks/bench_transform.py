@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Benchmark: inline vs process-pool metadata transform, with identical output.
+
+Builds synthetic /ajax/books records without languages (so every book goes
+through langid over its comments) and transforms them with
+calishot_transform.TransformStage for each requested worker count. Prints
+throughput and checks that every run produces the same rows. With --distinct,
+comments repeat like books copied across mirrors, and each worker count is run
+cold and warm against a fresh language cache to show its hit rate.
+
+    python3 benchmarks/bench_transform.py --books 20000 --workers 0,2,4
+    python3 benchmarks/bench_transform.py --books 20000 --distinct 5000 --workers 0
+"""
+
+import argparse
+import hashlib
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import calishot_langcache
+import calishot_transform
+
+WORDS = ("the quick brown fox jumps over a lazy dog while la nuit tombe sur le vieux port "
+         "und der Wind weht durch die Gassen mientras el sol se pone detras de las montanas").split()
+
+
+def make_records(count, comment_words, distinct=0, seed=1):
+    rnd = random.Random(seed)
+    comments = [" ".join(rnd.choice(WORDS) for _ in range(comment_words)) for _ in range(distinct)]
+    records = []
+    for book_id in range(1, count + 1):
+        records.append((str(book_id), {
+            "uuid": f"bench-{book_id:08d}",
+            "title": f"Le Livre numero {book_id}",
+            "authors": [f"Auteur {book_id % 97}", "Zoë Brontë"],
+            "comments": rnd.choice(comments) if comments else " ".join(rnd.choice(WORDS) for _ in range(comment_words)),
+            "series": "Série" if book_id % 3 else None,
+            "series_index": 1.0,
+            "identifiers": {"isbn": f"978{book_id:010d}"},
+            "tags": ["fiction", "littérature"],
+            "publisher": "Fake Press",
+            "pubdate": "2001-01-01T00:00:00+00:00",
+            "languages": [],
+            "cover": f"/get/cover/{book_id}/main",
+            "last_modified": "2020-01-01T00:00:00+00:00",
+            "timestamp": "2020-01-01T00:00:00+00:00",
+            "formats": ["epub"],
+            "format_metadata": {"epub": {"size": 1000 + book_id}},
+        }))
+    return records
+
+
+def rows_hash(rows):
+    digest = hashlib.sha256()
+    for row in rows:
+        digest.update(repr(sorted(row.items())).encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--books", type=int, default=20000)
+    parser.add_argument("--comment-words", type=int, default=80)
+    parser.add_argument("--batch", type=int, default=100, help="records per worker batch")
+    parser.add_argument("--page", type=int, default=1000, help="records per stage.run() call, like an index page")
+    parser.add_argument("--workers", default="0,2,4")
+    parser.add_argument("--distinct", type=int, default=0,
+                        help="number of distinct comments texts (0 = every book unique, no cache runs)")
+    args = parser.parse_args()
+
+    records = make_records(args.books, args.comment_words, args.distinct)
+    # Load the model in the parent too so the inline run is not charged for it
+    calishot_transform.classify("warm up")
+
+    print(f"{args.books} books, {args.comment_words} words of comments each, batch {args.batch}")
+    print(f"{'workers':>7} {'cache':>5} {'seconds':>8} {'books/s':>8} {'rows hash':>17}  cache hits")
+    for workers in [int(w) for w in args.workers.split(",")]:
+        runs = [("off", None)]
+        if args.distinct:
+            cache = calishot_langcache.LanguageCache(Path(tempfile.mkdtemp()) / "langid_cache.db")
+            runs += [("cold", cache), ("warm", cache)]
+        for label, cache in runs:
+            stage = calishot_transform.TransformStage(workers=workers, batch_size=args.batch)
+            stage.run(records[:args.batch * max(1, workers)], "main")  # start the pool
+            stage.cache = cache
+            hits, lookups = (cache.hits, cache.hits + cache.misses) if cache else (0, 0)
+            start = time.perf_counter()
+            rows = []
+            for i in range(0, len(records), args.page):
+                rows.extend(stage.run(records[i:i + args.page], "main"))
+            elapsed = time.perf_counter() - start
+            stage.close()
+            ratio = f"{cache.hits - hits}/{cache.hits + cache.misses - lookups}" if cache else "-"
+            print(f"{workers:>7} {label:>5} {elapsed:>8.2f} {len(records) / elapsed:>8.0f} {rows_hash(rows):>17}  {ratio}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+"""
+Minimal fake Calibre content server used by the benchmarks in this directory.
+
+It answers the handful of /ajax endpoints the crawler talks to
+(search, library-info, books) plus /get/<format>/<id>/<library> downloads,
+/_add and /_touch to simulate books being added or edited between runs, and
+/_fail and /_heal to simulate a link that drops partway through a library,
+with an optional injected latency so wall-clock behaviour can be measured
+without touching real hosts.
+
+Run standalone:
+    python3 benchmarks/fake_calibre.py --port 8099 --books 5000 --latency 0.2
+"""
+
+import argparse
+import datetime
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, unquote
+
+
+class FakeCalibreState:
+    def __init__(self, books=1000, libraries=("main",), latency=0.0, per_item_latency=0.0,
+                 comment_size=200, version="calibre 5.44.0", max_ids=None):
+        self.books = books
+        self.libraries = list(libraries)
+        self.latency = latency
+        self.per_item_latency = per_item_latency
+        self.comment_size = comment_size
+        self.version = version
+        # Reject /ajax/books calls asking for more than this many ids (simulates slow home servers)
+        self.max_ids = max_ids
+        # (library, id) -> last_modified of books edited through /_touch
+        self.modified = {}
+        self.connections = 0
+        self.requests = 0
+        # /ajax endpoint name -> number of calls
+        self.calls = {}
+        # /ajax/books answers 500 once it has been called this many times (see /_fail, /_heal)
+        self.fail_books_after = None
+        self.lock = threading.Lock()
+
+    def added(self, book_id):
+        # ids grow with time so "timestamp desc" is "id desc"
+        stamp = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc) + datetime.timedelta(seconds=book_id)
+        return stamp.isoformat()
+
+    def search(self, library, sort):
+        ids = list(range(self.books, 0, -1))
+        if sort == "last_modified":
+            touched = sorted((i for (lib, i) in self.modified if lib == library),
+                             key=lambda i: self.modified[(library, i)], reverse=True)
+            ids = touched + [i for i in ids if (library, i) not in self.modified]
+        return ids
+
+    def book(self, book_id, library):
+        return {
+            "uuid": f"{library}-{book_id:08d}",
+            "title": f"Book {book_id}",
+            "authors": [f"Author {book_id % 97}"],
+            "comments": ("Lorem ipsum dolor sit amet. " * (self.comment_size // 28 + 1))[: self.comment_size],
+            "series": None,
+            "series_index": 1.0,
+            "identifiers": {"isbn": f"978{book_id:010d}"},
+            "tags": ["fiction"],
+            "publisher": "Fake Press",
+            "pubdate": "2001-01-01T00:00:00+00:00",
+            "languages": ["eng"],
+            "cover": f"/get/cover/{book_id}/{library}",
+            "last_modified": self.modified.get((library, book_id), self.added(book_id)),
+            "timestamp": self.added(book_id),
+            "formats": ["epub"],
+            "format_metadata": {"epub": {"size": 1000 + book_id}},
+        }
+
+
+class FakeCalibreHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state = None  # set by make_server
+
+    def version_string(self):
+        return self.state.version
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        with self.state.lock:
+            self.state.connections += 1
+
+    def _send_json(self, payload, status=200):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        state = self.state
+        with state.lock:
+            state.requests += 1
+        parsed = urlparse(self.path)
+        parts = [unquote(p) for p in parsed.path.split("/") if p]
+        qs = parse_qs(parsed.query)
+
+        if parts == ["_stats"]:
+            return self._send_json({"connections": state.connections, "requests": state.requests, "calls": state.calls})
+
+        if parts == ["_add"]:
+            # Simulate new books being added to every library
+            with state.lock:
+                state.books += int(qs.get("n", ["1"])[0])
+            return self._send_json({"books": state.books})
+
+        if parts == ["_touch"]:
+            # Simulate a book being edited: bump its last_modified
+            library = qs.get("library", [state.libraries[0]])[0]
+            now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+            with state.lock:
+                state.modified[(library, int(qs["id"][0]))] = now
+            return self._send_json({"last_modified": now})
+
+        if parts == ["_fail"]:
+            # Simulate a flaky link: /ajax/books starts failing after n more calls
+            with state.lock:
+                state.fail_books_after = state.calls.get("books", 0) + int(qs.get("after", ["0"])[0])
+            return self._send_json({"fail_books_after": state.fail_books_after})
+
+        if parts == ["_heal"]:
+            state.fail_books_after = None
+            return self._send_json({"fail_books_after": None})
+
+        if parts[:1] == ["get"]:
+            time.sleep(state.latency)
+            body = b"x" * 1024
+            self.send_response(200)
+            self.send_header("Content-Type", "application/epub+zip")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        if parts[:1] != ["ajax"] or len(parts) < 2:
+            return self._send_json({"error": "not found"}, status=404)
+
+        endpoint = parts[1]
+        with state.lock:
+            state.calls[endpoint] = state.calls.get(endpoint, 0) + 1
+        library = parts[2] if len(parts) > 2 else (qs.get("library_id", [state.libraries[0]])[0])
+
+        if endpoint == "library-info":
+            time.sleep(state.latency)
+            return self._send_json({
+                "library_map": {lib: lib for lib in state.libraries},
+                "default_library": state.libraries[0],
+            })
+
+        if library not in state.libraries:
+            return self._send_json({"error": "no such library"}, status=404)
+
+        if endpoint == "search":
+            num = int(qs.get("num", ["0"])[0])
+            offset = int(qs.get("offset", ["0"])[0])
+            time.sleep(state.latency + state.per_item_latency * num)
+            ids = state.search(library, qs.get("sort", ["timestamp"])[0])[offset:offset + num]
+            return self._send_json({"total_num": state.books, "offset": offset, "num": len(ids), "book_ids": ids})
+
+        if endpoint == "books":
+            if state.fail_books_after is not None and state.calls["books"] > state.fail_books_after:
+                return self._send_json({"error": "simulated failure"}, status=500)
+            ids = [int(i) for i in qs.get("ids", [""])[0].split(",") if i]
+            if state.max_ids is not None and len(ids) > state.max_ids:
+                time.sleep(state.latency)
+                return self._send_json({"error": "too many ids"}, status=503)
+            time.sleep(state.latency + state.per_item_latency * len(ids))
+            return self._send_json({str(i): state.book(i, library) for i in ids if 0 < i <= state.books})
+
+        return self._send_json({"error": "not found"}, status=404)
+
+
+def make_server(port=0, **kwargs):
+    """Create (but do not start) a fake server. Returns (server, state)."""
+    state = FakeCalibreState(**kwargs)
+    handler = type("BoundFakeCalibreHandler", (FakeCalibreHandler,), {"state": state})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    return server, state
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Calibre content server for benchmarks")
+    parser.add_argument("--port", type=int, default=0, help="port to listen on (0 = pick a free one)")
+    parser.add_argument("--books", type=int, default=1000, help="number of books per library")
+    parser.add_argument("--libraries", default="main", help="comma separated library names")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument("--per-item-latency", type=float, default=0.0, help="seconds added per requested id")
+    parser.add_argument("--comment-size", type=int, default=200, help="length of each book's comments text")
+    parser.add_argument("--max-ids", type=int, default=None, help="reject /ajax/books calls above this many ids")
+    args = parser.parse_args()
+
+    server, _ = make_server(
+        port=args.port,
+        books=args.books,
+        libraries=[l for l in args.libraries.split(",") if l],
+        latency=args.latency,
+        per_item_latency=args.per_item_latency,
+        comment_size=args.comment_size,
+        max_ids=args.max_ids,
+    )
+    # First line on stdout is the bound port so parent processes can read it
+    print(server.server_address[1], flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,175 +3,214 @@
 # Python3 calishot.py  #
 ########################
 
+import argparse
 from pathlib import Path
-from functions import import_urls_from_file, check_calibre_list, index_site_list, get_stats, index_site_list_seq, import_urls_from_file, check_calibre_site, build_index, index_to_json, diff, calibre_by_country, book_search, output_online_db
 
 import logging
 import calishot_logging
-# Initialize shared rotating file logger pinned to project CWD
 from pathlib import Path as _Path
-# Pin to the repository root (directory of this file), matching calishot_web/app.py
-calishot_logging.init_logging(logging.INFO, log_file=_Path(__file__).resolve().parent / 'calishot.log')
-
-#####################
-# Flags for testing #
-#####################
-run_search_by_country = False
-run_book_search = False
-run_check_calibre_list = False
-run_output_online_db = True
-run_index_site_list = True
-run_index_site_list_seq = False
-run_build_index_eng = True
-run_get_stats = True
-run_index_to_json = True
-
-####################################################
-# Call search_by_country Function for each Country #
-####################################################
-if run_search_by_country:
-    print("Running search_by_country...")
-    logging.info("Running search_by_country...")
-    
-    # Complete list of ISO 3166-1 alpha-2 country codes
-    country_codes = [
-   'AD', 'AE', 'AF', 'AG', 'AI', 'AL', 'AM', 'AO', 'AR', 'AT', 'AU', 'AZ',
-        'BA', 'BB', 'BD', 'BE', 'BF', 'BG', 'BH', 'BI', 'BJ', 'BN', 'BO', 'BR',
-        'BS', 'BT', 'BW', 'BY', 'BZ', 'CA', 'CD', 'CF', 'CG', 'CH', 'CI', 'CL',
-        'CM', 'CN', 'CO', 'CR', 'CU', 'CV', 'CY', 'CZ', 'DE', 'DJ', 'DK', 'DM',
-        'DO', 'DZ', 'EC', 'EE', 'EG', 'ER', 'ES', 'ET', 'FI', 'FJ', 'FM', 'FR',
-        'GA', 'GB', 'GD', 'GE', 'GH', 'GM', 'GN', 'GQ', 'GR', 'GT', 'GW', 'GY',
-        'HN', 'HR', 'HT', 'HU', 'ID', 'IE', 'IL', 'IN', 'IQ', 'IR', 'IS', 'IT',
-        'JM', 'JO', 'JP', 'KE', 'KG', 'KH', 'KI', 'KM', 'KN', 'KP', 'KR', 'KW',
-        'KZ', 'LA', 'LB', 'LC', 'LI', 'LK', 'LR', 'LS', 'LT', 'LU', 'LV', 'LY',
-        'MA', 'MC', 'MD', 'ME', 'MG', 'MH', 'MK', 'ML', 'MM', 'MN', 'MR', 'MT',
-        'MU', 'MV', 'MW', 'MX', 'MY', 'MZ', 'NA', 'NE', 'NG', 'NI', 'NL', 'NO',
-        'NP', 'NR', 'NZ', 'OM', 'PA', 'PE', 'PG', 'PH', 'PK', 'PL', 'PT', 'PW',
-        'PY', 'QA', 'RO', 'RS', 'RU', 'RW', 'SA', 'SB', 'SC', 'SD', 'SE', 'SG',
-        'SI', 'SK', 'SL', 'SM', 'SN', 'SO', 'SR', 'SS', 'ST', 'SV', 'SY', 'SZ',
-        'TD', 'TG', 'TH', 'TJ', 'TL', 'TM', 'TN', 'TO', 'TR', 'TT', 'TV', 'TW',
-        'TZ', 'UA', 'UG', 'US', 'UY', 'UZ', 'VA', 'VC', 'VE', 'VN', 'VU', 'WS',
-        'YE', 'ZA', 'ZM', 'ZW', 'AX', 'AS', 'AQ', 'AW', 'BM', 'BQ', 'BV', 'IO',
-        'KY', 'CX', 'CC', 'CK', 'FO', 'GS', 'HM', 'SJ', 'SS', 'TF', 'UM', 'FK',
-        'FO', 'GF', 'PF', 'GI', 'GL', 'GP', 'GU', 'GG', 'HK', 'IM', 'JE', 'MO',
-        'MQ', 'YT', 'MS', 'NC', 'NU', 'NF', 'MP', 'PS', 'PN', 'PR', 'RE', 'BL',
-        'SH', 'MF', 'PM', 'SX', 'GS', 'SJ', 'TK', 'TC', 'VG', 'VI', 'WF', 'EH',
-        'AX'
-    ]
-    
-    print(f"Processing {len(country_codes)} countries...")
-    logging.info(f"Processing {len(country_codes)} countries")
-    
-    # Process each country code
-    for country_code in sorted(country_codes):
-        print(f"\nProcessing country: {country_code}")
-        logging.info(f"Processing country: {country_code}")
-        calibre_by_country(country_code)
-    
-##############################################
-# Call book_search Function for each Country #
-##############################################
-if run_book_search:
-    print("Running run_book_search...")
-    logging.info("Running run_book_search...")
-    
-    # Complete list of ISO 3166-1 alpha-2 country codes
-    country_codes = [
-        'AD', 'AE', 'AF', 'AG', 'AI', 'AL', 'AM', 'AO', 'AR', 'AT', 'AU', 'AZ',
-        'BA', 'BB', 'BD', 'BE', 'BF', 'BG', 'BH', 'BI', 'BJ', 'BN', 'BO', 'BR',
-        'BS', 'BT', 'BW', 'BY', 'BZ', 'CA', 'CD', 'CF', 'CG', 'CH', 'CI', 'CL',
-        'CM', 'CN', 'CO', 'CR', 'CU', 'CV', 'CY', 'CZ', 'DE', 'DJ', 'DK', 'DM',
-        'DO', 'DZ', 'EC', 'EE', 'EG', 'ER', 'ES', 'ET', 'FI', 'FJ', 'FM', 'FR',
-        'GA', 'GB', 'GD', 'GE', 'GH', 'GM', 'GN', 'GQ', 'GR', 'GT', 'GW', 'GY',
-        'HN', 'HR', 'HT', 'HU', 'ID', 'IE', 'IL', 'IN', 'IQ', 'IR', 'IS', 'IT',
-        'JM', 'JO', 'JP', 'KE', 'KG', 'KH', 'KI', 'KM', 'KN', 'KP', 'KR', 'KW',
-        'KZ', 'LA', 'LB', 'LC', 'LI', 'LK', 'LR', 'LS', 'LT', 'LU', 'LV', 'LY',
-        'MA', 'MC', 'MD', 'ME', 'MG', 'MH', 'MK', 'ML', 'MM', 'MN', 'MR', 'MT',
-        'MU', 'MV', 'MW', 'MX', 'MY', 'MZ', 'NA', 'NE', 'NG', 'NI', 'NL', 'NO',
-        'NP', 'NR', 'NZ', 'OM', 'PA', 'PE', 'PG', 'PH', 'PK', 'PL', 'PT', 'PW',
-        'PY', 'QA', 'RO', 'RS', 'RU', 'RW', 'SA', 'SB', 'SC', 'SD', 'SE', 'SG',
-        'SI', 'SK', 'SL', 'SM', 'SN', 'SO', 'SR', 'SS', 'ST', 'SV', 'SY', 'SZ',
-        'TD', 'TG', 'TH', 'TJ', 'TL', 'TM', 'TN', 'TO', 'TR', 'TT', 'TV', 'TW',
-        'TZ', 'UA', 'UG', 'US', 'UY', 'UZ', 'VA', 'VC', 'VE', 'VN', 'VU', 'WS',
-        'YE', 'ZA', 'ZM', 'ZW', 'AX', 'AS', 'AQ', 'AW', 'BM', 'BQ', 'BV', 'IO',
-        'KY', 'CX', 'CC', 'CK', 'FO', 'GS', 'HM', 'SJ', 'SS', 'TF', 'UM', 'FK',
-        'FO', 'GF', 'PF', 'GI', 'GL', 'GP', 'GU', 'GG', 'HK', 'IM', 'JE', 'MO',
-        'MQ', 'YT', 'MS', 'NC', 'NU', 'NF', 'MP', 'PS', 'PN', 'PR', 'RE', 'BL',
-        'SH', 'MF', 'PM', 'SX', 'GS', 'SJ', 'TK', 'TC', 'VG', 'VI', 'WF', 'EH',
-        'AX'
-    ]
-    
-    print(f"Processing {len(country_codes)} countries...")
-    logging.info(f"Processing {len(country_codes)} countries")
-    
-    # Process each country code
-    for country_code in sorted(country_codes):
-        print(f"\nProcessing country: {country_code}")
-        logging.info(f"Processing country: {country_code}")
-        book_search(country_code)
-    
-    # Process other.txt if it exists in the data directory
-    other_file = Path("data/other.txt")
-    if other_file.exists():
-        print("\nProcessing data/other.txt...")
-        logging.info("Processing data/other.txt")
-        import_urls_from_file("data/other.txt", country="other")
-    else:
-        print("\ndata/other.txt not found, skipping...")
-        logging.info("data/other.txt not found, skipping...")
-
-####################################
-# Call check_calibre_list Function #
-####################################
-if run_check_calibre_list:
-    print ("Running run_check_calibre_list...")
-    logging.info("Running run_check_calibre_list...")
-    check_calibre_list()
-    
-##################################
-# Call output_online_db Function #
-##################################
-if run_output_online_db:
-    print ("Running output_online_db...")
-    logging.info("Running output_online_db...")
-    output_online_db()
-
-##################################
-# Call index_site_list Function #
-##################################
-if run_index_site_list:
-    print ("Running index_site_list...")
-    logging.info("Running index_site_list...")
-    index_site_list('./data/online.txt')
-
-#####################################
-# Call index_site_list_seq Function #
-#####################################
-if run_index_site_list_seq:
-    print ("Running index_site_list_seq...")
-    logging.info("Running index_site_list_seq...")
-    index_site_list_seq('./data/online.txt')
-
-#################################
-# Call build_index_eng Function #
-#################################
-if run_build_index_eng:
-    print ("Running run_build_index_eng...")
-    logging.info("Running run_build_index_eng...")
-    build_index()
-
-###########################
-# Call get_stats Function #
-###########################
-if run_get_stats:
-    print ("Running get_stats...")
-    logging.info("Running get_stats...")
-    get_stats()
-
-###############################
-# Call index_to_json Function #
-###############################
-if run_index_to_json:
-    print ("Running index_to_json...")
-    logging.info("Running index_to_json...")
-    index_to_json()
\ No newline at end of file
+
+# Everything runs from main(): the worker processes of calishot_procpool import
+# this script again, and must neither crawl nor import functions when they do
+def main():
+    from functions import import_urls_from_file, check_calibre_list, compact_site_dbs, list_checkpoints, reset_checkpoints, index_site_list, get_stats, index_site_list_seq, import_urls_from_file, check_calibre_site, build_index, index_to_json, diff, calibre_by_country, book_search, output_online_db
+
+    # Initialize shared rotating file logger pinned to project CWD
+    # Pin to the repository root (directory of this file), matching calishot_web/app.py
+    calishot_logging.init_logging(logging.INFO, log_file=_Path(__file__).resolve().parent / 'calishot.log')
+
+    ########################
+    # Command line options #
+    ########################
+    parser = argparse.ArgumentParser(description="Calishot crawler: runs the stages enabled by the flags below.")
+    parser.add_argument('--engine', choices=['gevent', 'async'], default='gevent', help='health-check engine used by check_calibre_list (default: gevent)')
+    parser.add_argument('--check-all', action='store_true', help='health-check every site, not only the ones due per next_check_at')
+    parser.add_argument('--no-preprobe', action='store_true', help='skip the TCP connect pre-probe that marks unreachable hosts down before the HTTP check')
+    parser.add_argument('--compact-site-dbs', action='store_true', help='merge duplicate per-site ebook databases into one <sites.uuid>.db per site and exit')
+    parser.add_argument('--dry-run', action='store_true', help='with --compact-site-dbs, only report what would be merged')
+    parser.add_argument('--list-checkpoints', action='store_true', help='list unfinished (resumable) library indexing passes and exit')
+    parser.add_argument('--rebuild-index', action='store_true', help='rebuild index.db from every site database instead of only the ones that changed')
+    parser.add_argument('--shadow-index', action='store_true', help='build index.db into index.db.building and swap it in atomically when done')
+    parser.add_argument('--recompute-stats', action='store_true', help='rebuild the per-format statistics of every site database, print them and exit')
+    parser.add_argument('--reset-checkpoints', nargs='?', const='', metavar='SITE', help='delete indexing checkpoints (all, or of one site uuid/URL) and exit')
+    args = parser.parse_args()
+
+    if args.compact_site_dbs:
+        compact_site_dbs(dry_run=args.dry_run)
+        raise SystemExit(0)
+    if args.list_checkpoints:
+        list_checkpoints()
+        raise SystemExit(0)
+    if args.recompute_stats:
+        get_stats(recompute=True)
+        raise SystemExit(0)
+    if args.reset_checkpoints is not None:
+        reset_checkpoints(site=args.reset_checkpoints or None)
+        raise SystemExit(0)
+
+    #####################
+    # Flags for testing #
+    #####################
+    run_search_by_country = False
+    run_book_search = False
+    run_check_calibre_list = False
+    run_output_online_db = True
+    run_index_site_list = True
+    run_index_site_list_seq = False
+    run_build_index_eng = True
+    run_get_stats = True
+    run_index_to_json = True
+
+    ####################################################
+    # Call search_by_country Function for each Country #
+    ####################################################
+    if run_search_by_country:
+        print("Running search_by_country...")
+        logging.info("Running search_by_country...")
+
+        # Complete list of ISO 3166-1 alpha-2 country codes
+        country_codes = [
+       'AD', 'AE', 'AF', 'AG', 'AI', 'AL', 'AM', 'AO', 'AR', 'AT', 'AU', 'AZ',
+            'BA', 'BB', 'BD', 'BE', 'BF', 'BG', 'BH', 'BI', 'BJ', 'BN', 'BO', 'BR',
+            'BS', 'BT', 'BW', 'BY', 'BZ', 'CA', 'CD', 'CF', 'CG', 'CH', 'CI', 'CL',
+            'CM', 'CN', 'CO', 'CR', 'CU', 'CV', 'CY', 'CZ', 'DE', 'DJ', 'DK', 'DM',
+            'DO', 'DZ', 'EC', 'EE', 'EG', 'ER', 'ES', 'ET', 'FI', 'FJ', 'FM', 'FR',
+            'GA', 'GB', 'GD', 'GE', 'GH', 'GM', 'GN', 'GQ', 'GR', 'GT', 'GW', 'GY',
+            'HN', 'HR', 'HT', 'HU', 'ID', 'IE', 'IL', 'IN', 'IQ', 'IR', 'IS', 'IT',
+            'JM', 'JO', 'JP', 'KE', 'KG', 'KH', 'KI', 'KM', 'KN', 'KP', 'KR', 'KW',
+            'KZ', 'LA', 'LB', 'LC', 'LI', 'LK', 'LR', 'LS', 'LT', 'LU', 'LV', 'LY',
+            'MA', 'MC', 'MD', 'ME', 'MG', 'MH', 'MK', 'ML', 'MM', 'MN', 'MR', 'MT',
+            'MU', 'MV', 'MW', 'MX', 'MY', 'MZ', 'NA', 'NE', 'NG', 'NI', 'NL', 'NO',
+            'NP', 'NR', 'NZ', 'OM', 'PA', 'PE', 'PG', 'PH', 'PK', 'PL', 'PT', 'PW',
+            'PY', 'QA', 'RO', 'RS', 'RU', 'RW', 'SA', 'SB', 'SC', 'SD', 'SE', 'SG',
+            'SI', 'SK', 'SL', 'SM', 'SN', 'SO', 'SR', 'SS', 'ST', 'SV', 'SY', 'SZ',
+            'TD', 'TG', 'TH', 'TJ', 'TL', 'TM', 'TN', 'TO', 'TR', 'TT', 'TV', 'TW',
+            'TZ', 'UA', 'UG', 'US', 'UY', 'UZ', 'VA', 'VC', 'VE', 'VN', 'VU', 'WS',
+            'YE', 'ZA', 'ZM', 'ZW', 'AX', 'AS', 'AQ', 'AW', 'BM', 'BQ', 'BV', 'IO',
+            'KY', 'CX', 'CC', 'CK', 'FO', 'GS', 'HM', 'SJ', 'SS', 'TF', 'UM', 'FK',
+            'FO', 'GF', 'PF', 'GI', 'GL', 'GP', 'GU', 'GG', 'HK', 'IM', 'JE', 'MO',
+            'MQ', 'YT', 'MS', 'NC', 'NU', 'NF', 'MP', 'PS', 'PN', 'PR', 'RE', 'BL',
+            'SH', 'MF', 'PM', 'SX', 'GS', 'SJ', 'TK', 'TC', 'VG', 'VI', 'WF', 'EH',
+            'AX'
+        ]
+
+        print(f"Processing {len(country_codes)} countries...")
+        logging.info(f"Processing {len(country_codes)} countries")
+
+        # Process each country code
+        for country_code in sorted(country_codes):
+            print(f"\nProcessing country: {country_code}")
+            logging.info(f"Processing country: {country_code}")
+            calibre_by_country(country_code)
+
+    ##############################################
+    # Call book_search Function for each Country #
+    ##############################################
+    if run_book_search:
+        print("Running run_book_search...")
+        logging.info("Running run_book_search...")
+
+        # Complete list of ISO 3166-1 alpha-2 country codes
+        country_codes = [
+            'AD', 'AE', 'AF', 'AG', 'AI', 'AL', 'AM', 'AO', 'AR', 'AT', 'AU', 'AZ',
+            'BA', 'BB', 'BD', 'BE', 'BF', 'BG', 'BH', 'BI', 'BJ', 'BN', 'BO', 'BR',
+            'BS', 'BT', 'BW', 'BY', 'BZ', 'CA', 'CD', 'CF', 'CG', 'CH', 'CI', 'CL',
+            'CM', 'CN', 'CO', 'CR', 'CU', 'CV', 'CY', 'CZ', 'DE', 'DJ', 'DK', 'DM',
+            'DO', 'DZ', 'EC', 'EE', 'EG', 'ER', 'ES', 'ET', 'FI', 'FJ', 'FM', 'FR',
+            'GA', 'GB', 'GD', 'GE', 'GH', 'GM', 'GN', 'GQ', 'GR', 'GT', 'GW', 'GY',
+            'HN', 'HR', 'HT', 'HU', 'ID', 'IE', 'IL', 'IN', 'IQ', 'IR', 'IS', 'IT',
+            'JM', 'JO', 'JP', 'KE', 'KG', 'KH', 'KI', 'KM', 'KN', 'KP', 'KR', 'KW',
+            'KZ', 'LA', 'LB', 'LC', 'LI', 'LK', 'LR', 'LS', 'LT', 'LU', 'LV', 'LY',
+            'MA', 'MC', 'MD', 'ME', 'MG', 'MH', 'MK', 'ML', 'MM', 'MN', 'MR', 'MT',
+            'MU', 'MV', 'MW', 'MX', 'MY', 'MZ', 'NA', 'NE', 'NG', 'NI', 'NL', 'NO',
+            'NP', 'NR', 'NZ', 'OM', 'PA', 'PE', 'PG', 'PH', 'PK', 'PL', 'PT', 'PW',
+            'PY', 'QA', 'RO', 'RS', 'RU', 'RW', 'SA', 'SB', 'SC', 'SD', 'SE', 'SG',
+            'SI', 'SK', 'SL', 'SM', 'SN', 'SO', 'SR', 'SS', 'ST', 'SV', 'SY', 'SZ',
+            'TD', 'TG', 'TH', 'TJ', 'TL', 'TM', 'TN', 'TO', 'TR', 'TT', 'TV', 'TW',
+            'TZ', 'UA', 'UG', 'US', 'UY', 'UZ', 'VA', 'VC', 'VE', 'VN', 'VU', 'WS',
+            'YE', 'ZA', 'ZM', 'ZW', 'AX', 'AS', 'AQ', 'AW', 'BM', 'BQ', 'BV', 'IO',
+            'KY', 'CX', 'CC', 'CK', 'FO', 'GS', 'HM', 'SJ', 'SS', 'TF', 'UM', 'FK',
+            'FO', 'GF', 'PF', 'GI', 'GL', 'GP', 'GU', 'GG', 'HK', 'IM', 'JE', 'MO',
+            'MQ', 'YT', 'MS', 'NC', 'NU', 'NF', 'MP', 'PS', 'PN', 'PR', 'RE', 'BL',
+            'SH', 'MF', 'PM', 'SX', 'GS', 'SJ', 'TK', 'TC', 'VG', 'VI', 'WF', 'EH',
+            'AX'
+        ]
+
+        print(f"Processing {len(country_codes)} countries...")
+        logging.info(f"Processing {len(country_codes)} countries")
+
+        # Process each country code
+        for country_code in sorted(country_codes):
+            print(f"\nProcessing country: {country_code}")
+            logging.info(f"Processing country: {country_code}")
+            book_search(country_code)
+
+        # Process other.txt if it exists in the data directory
+        other_file = Path("data/other.txt")
+        if other_file.exists():
+            print("\nProcessing data/other.txt...")
+            logging.info("Processing data/other.txt")
+            import_urls_from_file("data/other.txt", country="other")
+        else:
+            print("\ndata/other.txt not found, skipping...")
+            logging.info("data/other.txt not found, skipping...")
+
+    ####################################
+    # Call check_calibre_list Function #
+    ####################################
+    if run_check_calibre_list:
+        print ("Running run_check_calibre_list...")
+        logging.info("Running run_check_calibre_list...")
+        check_calibre_list(engine=args.engine, check_all=args.check_all, preprobe=not args.no_preprobe)
+
+    ##################################
+    # Call output_online_db Function #
+    ##################################
+    if run_output_online_db:
+        print ("Running output_online_db...")
+        logging.info("Running output_online_db...")
+        output_online_db()
+
+    ##################################
+    # Call index_site_list Function #
+    ##################################
+    if run_index_site_list:
+        print ("Running index_site_list...")
+        logging.info("Running index_site_list...")
+        index_site_list('./data/online.txt')
+
+    #####################################
+    # Call index_site_list_seq Function #
+    #####################################
+    if run_index_site_list_seq:
+        print ("Running index_site_list_seq...")
+        logging.info("Running index_site_list_seq...")
+        index_site_list_seq('./data/online.txt')
+
+    #################################
+    # Call build_index_eng Function #
+    #################################
+    if run_build_index_eng:
+        print ("Running run_build_index_eng...")
+        logging.info("Running run_build_index_eng...")
+        build_index(full=args.rebuild_index, shadow=args.shadow_index)
+
+    ###########################
+    # Call get_stats Function #
+    ###########################
+    if run_get_stats:
+        print ("Running get_stats...")
+        logging.info("Running get_stats...")
+        get_stats()
+
+    ###############################
+    # Call index_to_json Function #
+    ###############################
+    if run_index_to_json:
+        print ("Running index_to_json...")
+        logging.info("Running index_to_json...")
+        index_to_json()
+
+
+if __name__ == "__main__":
+    main()
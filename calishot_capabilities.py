@@ -0,0 +1,217 @@
+"""
+Per-server capability cache for the count and paging endpoints.
+
+Calibre servers disagree on how a library is addressed (/ajax/search/<lib> vs
+?library_id=<lib>), some need an explicit empty query, and some only answer
+the global search. Finding the working form costs a string of failed round
+trips per library on every run. The first form that answers is recorded per
+server (scheme://host:port) in the server_capabilities table of sites.db,
+together with the version parsed from the Server header. Later runs go
+straight to it and only probe the other forms again when it stops working.
+The page size and ceiling learned by calishot_pagesize are kept in the same row.
+
+A CapabilityCache reads the table once and answers from memory afterwards, so
+the greenlets of an index run share one copy. Given a SitesWriter, it queues
+its writes there instead of opening sites.db itself.
+"""
+
+import datetime
+import logging
+import re
+import sqlite3
+import threading
+from urllib.parse import quote
+
+from calishot_http import origin
+
+# Count endpoint variants, in probing order
+VARIANTS = ("path", "library_id", "path_query", "library_id_query", "global", "global_query")
+GLOBAL_VARIANTS = ("global", "global_query")
+
+_EMPTY_QUERY = "query=%5B%5D"
+
+
+def library_url(api, endpoint, library, form="path"):
+    """
+    Base URL of an /ajax endpoint for a library, ready for 'param=value&...' to be appended.
+
+    Args:
+        api (str): The server's /ajax/ URL.
+        endpoint (str): 'search' or 'books'.
+        library (str): Library name, with or without a leading '/'; '' for the default library.
+        form (str): 'path' (/ajax/search/<lib>) or 'library_id' (/ajax/search?library_id=<lib>).
+    """
+    library = (library or "").strip("/")
+    if not library:
+        return f"{api}{endpoint}?"
+    if form == "library_id":
+        return f"{api}{endpoint}?library_id={quote(library)}&"
+    return f"{api}{endpoint}/{library}?"
+
+
+def count_url(api, library, variant):
+    """URL of the num=0 count request for one of VARIANTS."""
+    extra = "&" + _EMPTY_QUERY if variant.endswith("_query") else ""
+    if variant.startswith("global") or not (library or "").strip("/"):
+        return f"{api}search?num=0&sort=timestamp&sort_order=desc{extra}"
+    form = "library_id" if variant.startswith("library_id") else "path"
+    return library_url(api, "search", library, form) + f"num=0&sort=timestamp&sort_order=desc{extra}"
+
+
+def library_form(variant):
+    """Paging form matching a count variant."""
+    return "library_id" if (variant or "").startswith("library_id") else "path"
+
+
+def variants_for(library, preferred=None):
+    """Variants to try for a library, the remembered one first."""
+    order = list(VARIANTS if (library or "").strip("/") else GLOBAL_VARIANTS)
+    if preferred in order:
+        order.remove(preferred)
+        order.insert(0, preferred)
+    return order
+
+
+def parse_version(server_header):
+    """Return (version, major) from a Server header like 'calibre 5.44.0'; major is 0 if unknown."""
+    match = re.search(r"calibre.(\d+)", server_header or "")
+    return server_header or "", int(match.group(1)) if match else 0
+
+
+def total_from(data):
+    """Book count from a search response, accepting the key names seen in the wild."""
+    for key in ("total_num", "total", "count"):
+        if isinstance(data, dict) and data.get(key) is not None:
+            try:
+                return int(str(data[key]).strip())
+            except ValueError:
+                return None
+    return None
+
+
+CAPABILITIES_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS server_capabilities (
+        server TEXT PRIMARY KEY,
+        count_variant TEXT,
+        library_form TEXT,
+        version TEXT,
+        major INTEGER,
+        page_size INTEGER,
+        page_ceiling INTEGER,
+        page_ceiling_at TEXT,
+        updated TEXT
+    )
+"""
+
+
+def ensure_table(conn):
+    """Create server_capabilities, or add the columns later versions introduced. The caller commits."""
+    conn.execute(CAPABILITIES_TABLE_SQL)
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(server_capabilities)")}
+    for column, kind in (("page_size", "INTEGER"), ("page_ceiling", "INTEGER"), ("page_ceiling_at", "TEXT")):
+        if column not in columns:
+            conn.execute(f"ALTER TABLE server_capabilities ADD COLUMN {column} {kind}")
+
+
+def upsert(conn, server, fields):
+    """
+    Insert or update fields of a server's row; used by CapabilityCache and SitesWriter. The caller commits.
+
+    Args:
+        conn (sqlite3.Connection): sites.db, with the table in place.
+        server (str): scheme://host:port.
+        fields (dict): Column values, including updated.
+    """
+    cols = ["server"] + list(fields)
+    updates = ", ".join(f"{c} = excluded.{c}" for c in fields)
+    conn.execute(
+        f"INSERT INTO server_capabilities ({', '.join(cols)}) VALUES ({', '.join('?' for _ in cols)}) "
+        f"ON CONFLICT(server) DO UPDATE SET {updates}",
+        [server] + list(fields.values()),
+    )
+
+
+class CapabilityCache:
+    """
+    server_capabilities rows in sites.db, one per scheme://host:port.
+
+    Args:
+        db_path (str | Path): Path to sites.db.
+        writer (SitesWriter, optional): Queue writes on it instead of committing them here.
+    """
+
+    def __init__(self, db_path, writer=None):
+        self.db_path = str(db_path)
+        self.writer = writer
+        # Library counts answered by the remembered form / that had to probe the others
+        self.hits = 0
+        self.probes = 0
+        self._rows = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._rows is not None:
+                return self._rows
+            self._rows = {}
+            try:
+                conn = sqlite3.connect(self.db_path, timeout=60)
+                try:
+                    with conn:
+                        ensure_table(conn)
+                    conn.row_factory = sqlite3.Row
+                    for row in conn.execute("SELECT * FROM server_capabilities"):
+                        self._rows[row["server"]] = dict(row)
+                finally:
+                    conn.close()
+            except sqlite3.Error as e:
+                logging.warning("Could not read server capabilities from %s: %s", self.db_path, e)
+            return self._rows
+
+    def get(self, url):
+        """Return the cached capabilities of url's server as a dict, or None."""
+        row = self._load().get(origin(url))
+        return dict(row) if row is not None else None
+
+    def put(self, url, **fields):
+        """Insert or update fields (count_variant, library_form, version, major, page_size, page_ceiling, page_ceiling_at) for url's server."""
+        server = origin(url)
+        fields["updated"] = datetime.datetime.utcnow().isoformat()
+        rows = self._load()
+        with self._lock:
+            rows.setdefault(server, {"server": server}).update(fields)
+        if self.writer is not None:
+            self.writer.save_capabilities(server, fields)
+            return
+        try:
+            conn = sqlite3.connect(self.db_path, timeout=60)
+            try:
+                with conn:
+                    upsert(conn, server, fields)
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            logging.warning("Could not save capabilities of %s: %s", server, e)
+
+    def forget(self, url=None):
+        """Drop the entry of url's server, or every entry when url is None."""
+        rows = self._load()
+        with self._lock:
+            if url is None:
+                rows.clear()
+            else:
+                rows.pop(origin(url), None)
+        conn = sqlite3.connect(self.db_path, timeout=60)
+        try:
+            with conn:
+                if url is None:
+                    conn.execute("DELETE FROM server_capabilities")
+                else:
+                    conn.execute("DELETE FROM server_capabilities WHERE server = ?", (origin(url),))
+        finally:
+            conn.close()
+
+    def report(self):
+        """One-line summary of how often the remembered count form answered."""
+        total = self.hits + self.probes
+        return f"count endpoint: {self.hits}/{total} libraries answered on the remembered form, {self.probes} probed"
@@ -0,0 +1,207 @@
+"""
+Per-format sizes of a site database, one row per (book, format).
+
+Books used to be saved with insert_all(alter=True) and one column per format
+holding its size, so every format string a server had never sent before (epub,
+azw3, cbz...) added a column to ebooks, and get_stats/build_index probed
+ebook[f] row by row. ebook_formats(uuid, format, size) holds them instead,
+indexed on (format, size) so a per-format total such as the bytes of every
+epub is one aggregate read from the index.
+
+A site database from before the table is migrated by ensure(): sizes are copied
+from the per-format columns, which are then dropped. ALTER TABLE DROP COLUMN
+keeps the rowids that the incremental index build relies on.
+
+format_stats(format, files, bytes) holds the totals of the site database per
+format, maintained by triggers on ebook_formats in the same transaction as the
+rows themselves (deleting a book from ebooks deletes its formats). get_stats
+only reads these few rows per site database. recompute() rebuilds them from
+ebook_formats, for get_stats(recompute=True) / calishot.py --recompute-stats.
+
+Configuration (environment variables):
+    CALISHOT_STATS_WORKERS  processes recomputing site databases, 0 runs inline (default: CPUs - 1)
+"""
+
+import json
+import os
+
+from sqlite_utils import Database
+
+import calishot_pipeline
+import calishot_procpool
+
+TABLE = "ebook_formats"
+STATS = "format_stats"
+WORKERS = int(os.getenv("CALISHOT_STATS_WORKERS", str(max(0, (os.cpu_count() or 1) - 1))))
+# ebooks columns of init_site_db; any other column is a per-format size of a former schema
+BASE_COLUMNS = {"uuid", "id", "library", "title", "authors", "series", "series_index", "language", "desc",
+                "identifiers", "tags", "publisher", "pubdate", "last_modified", "timestamp", "formats", "cover"}
+
+
+def ensure(db):
+    """
+    Create ebook_formats, moving the sizes of per-format ebooks columns into it.
+
+    Args:
+        db (Database): A site database, with its ebooks table.
+
+    Returns:
+        list[str]: The per-format columns migrated (and dropped), usually none.
+    """
+    conn = db.conn
+    with conn:
+        conn.execute(f"CREATE TABLE IF NOT EXISTS [{TABLE}] (uuid TEXT NOT NULL, format TEXT NOT NULL, "
+                     "size INTEGER, PRIMARY KEY (uuid, format)) WITHOUT ROWID")
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{TABLE}_format ON [{TABLE}](format, size)")
+        if STATS not in db.table_names():
+            conn.execute(f"CREATE TABLE [{STATS}] (format TEXT PRIMARY KEY, files INTEGER NOT NULL, "
+                         "bytes INTEGER NOT NULL)")
+            _recompute(conn)
+        for sql in _triggers_sql():
+            conn.execute(sql)
+    extra = [c.name for c in db["ebooks"].columns if c.name not in BASE_COLUMNS]
+    if not extra:
+        return []
+    formats = {f for (f,) in conn.execute(
+        "SELECT DISTINCT j.value FROM ebooks, json_each(ebooks.formats) j WHERE json_valid(ebooks.formats)")}
+    legacy = [c for c in extra if c in formats]
+    if not legacy:
+        return []
+    sizes = " ".join(f"WHEN {_quote(c)} THEN e.[{c}]" for c in legacy)
+    with conn:
+        conn.execute(f"INSERT OR IGNORE INTO [{TABLE}] (uuid, format, size) "
+                     f"SELECT e.uuid, j.value, CASE j.value {sizes} ELSE NULL END "
+                     "FROM ebooks e, json_each(e.formats) j WHERE json_valid(e.formats)")
+        for c in legacy:
+            conn.execute(f"ALTER TABLE ebooks DROP COLUMN [{c}]")
+    return legacy
+
+
+def _quote(value):
+    return "'" + value.replace("'", "''") + "'"
+
+
+def _triggers_sql():
+    add = (f"INSERT INTO [{STATS}] (format, files, bytes) VALUES (new.format, 1, COALESCE(new.size, 0)) "
+           "ON CONFLICT(format) DO UPDATE SET files = files + 1, bytes = bytes + excluded.bytes;")
+    remove = (f"UPDATE [{STATS}] SET files = files - 1, bytes = bytes - COALESCE(old.size, 0) "
+              "WHERE format = old.format;")
+    return [
+        f"CREATE TRIGGER IF NOT EXISTS {STATS}_ai AFTER INSERT ON [{TABLE}] BEGIN {add} END",
+        f"CREATE TRIGGER IF NOT EXISTS {STATS}_ad AFTER DELETE ON [{TABLE}] BEGIN {remove} END",
+        f"CREATE TRIGGER IF NOT EXISTS {STATS}_au AFTER UPDATE ON [{TABLE}] BEGIN {remove} {add} END",
+        f"CREATE TRIGGER IF NOT EXISTS ebooks_formats_ad AFTER DELETE ON ebooks BEGIN "
+        f"DELETE FROM [{TABLE}] WHERE uuid = old.uuid; END",
+    ]
+
+
+def split(books):
+    """
+    Take the per-format sizes out of ebooks rows (calishot_transform.book_from_calibre).
+
+    The rows are changed in place: book[f] is removed for each format f.
+
+    Returns:
+        list[tuple]: (uuid, format, size) rows for ebook_formats.
+    """
+    rows = []
+    for book in books:
+        formats = book.get("formats") or []
+        if isinstance(formats, str):
+            formats = json.loads(formats)
+        for f in formats:
+            rows.append((book["uuid"], f, book.pop(f, None)))
+    return rows
+
+
+def save(db, rows, replace=False):
+    """
+    Bulk-insert ebook_formats rows in one transaction.
+
+    Args:
+        db (Database): The site database.
+        rows (list[tuple]): (uuid, format, size) rows, see split().
+        replace (bool): The books were replaced: drop their previous formats first.
+    """
+    conn = db.conn
+    with conn:
+        if replace:
+            conn.executemany(f"DELETE FROM [{TABLE}] WHERE uuid = ?", sorted({(r[0],) for r in rows}))
+        # An upsert, not REPLACE, whose implicit delete would skip the format_stats triggers
+        conn.executemany(f"INSERT INTO [{TABLE}] (uuid, format, size) VALUES (?, ?, ?) "
+                         "ON CONFLICT(uuid, format) DO UPDATE SET size = excluded.size", rows)
+
+
+def sizes(db, where="1", params=()):
+    """
+    {uuid: {format: size}} of the ebooks rows matching where.
+
+    Args:
+        db (Database): The site database.
+        where (str), params (list): Filter on ebooks (e.g. a rowid range).
+    """
+    found = {}
+    for uuid, f, size in db.execute(
+            f"SELECT uuid, format, size FROM [{TABLE}] WHERE uuid IN (SELECT uuid FROM ebooks WHERE {where})",
+            list(params)):
+        found.setdefault(uuid, {})[f] = size
+    return found
+
+
+def totals(db):
+    """{format: (files, bytes)} of a site database, from format_stats."""
+    return {f: (files, size) for f, files, size in db.execute(
+        f"SELECT format, files, bytes FROM [{STATS}] WHERE files > 0 ORDER BY format")}
+
+
+def _recompute(conn):
+    conn.execute(f"DELETE FROM [{STATS}]")
+    conn.execute(f"INSERT INTO [{STATS}] (format, files, bytes) "
+                 f"SELECT format, COUNT(*), COALESCE(SUM(size), 0) FROM [{TABLE}] GROUP BY format")
+
+
+def recompute(path):
+    """
+    Rebuild the format_stats of one site database from its ebook_formats rows.
+
+    Args:
+        path (str): The site database.
+
+    Returns:
+        dict: Its totals, as totals().
+    """
+    db = Database(path)
+    try:
+        ensure(db)
+        with db.conn:
+            _recompute(db.conn)
+        return totals(db)
+    finally:
+        db.conn.close()
+
+
+def recompute_all(paths, workers=None):
+    """
+    Run recompute() over site databases on a pool of worker processes.
+
+    Args:
+        paths (list): Site database paths.
+        workers (int, optional): Worker processes, 0 runs inline. Defaults to CALISHOT_STATS_WORKERS.
+
+    Returns:
+        dict: {path: totals, or the exception raised for it}.
+    """
+    pool = calishot_procpool.ProcessPool(recompute, WORKERS if workers is None else workers, name="Stats")
+
+    def run(path):
+        # Errors travel as values: an exception would end the Prefetcher's iteration
+        try:
+            return pool.call(str(path))
+        except Exception as e:
+            return e
+
+    try:
+        with calishot_pipeline.Prefetcher(run, paths, depth=pool.workers) as prefetch:
+            return {path: result for path, result in prefetch}
+    finally:
+        pool.close()
@@ -0,0 +1,89 @@
+"""
+Full-text index of index.db's books (read through the summary view).
+
+summary_fts used to be created by sqlite-utils' enable_fts over nine columns,
+including the raw title JSON with its href, so every URL of every book was
+tokenized, and build_index repopulated it from scratch after each run. It is
+now an FTS5 table with the books table as its external content, kept in step
+by triggers on books: every insert, upsert and delete updates the index for
+that row only. books holds the title label alone, without the link
+(calishot_indexlayout), so no URL is indexed. Datasette searches the summary
+view through the fts_table of metadata.json. Rows are matched by books.id, an
+INTEGER PRIMARY KEY, so VACUUM cannot renumber them under the index.
+
+The index is only filled from books when it is created or its definition
+changes (another tokenizer or prefix setting, or an index.db from before the
+triggers); ensure() takes care of that.
+
+Configuration (environment variables):
+    CALISHOT_FTS_TOKENIZE  FTS5 tokenizer (default 'unicode61 remove_diacritics 2')
+    CALISHOT_FTS_PREFIX    prefix index lengths, e.g. '2 3' (default none)
+"""
+
+import os
+
+TABLE = "summary_fts"
+CONTENT = "books"
+COLUMNS = ("title", "authors", "series", "language", "identifiers", "tags", "publisher", "formats", "year")
+TOKENIZE = os.getenv("CALISHOT_FTS_TOKENIZE", "unicode61 remove_diacritics 2")
+PREFIX = os.getenv("CALISHOT_FTS_PREFIX", "").strip()
+# Triggers of former layouts, dropped on migration: sqlite-utils' enable_fts and the summary table's
+_OLD_TRIGGERS = ("summary_ai", "summary_ad", "summary_au")
+TRIGGERS = ("summary_fts_ai", "summary_fts_ad", "summary_fts_au")
+
+
+def _quote(value):
+    return "'" + value.replace("'", "''") + "'"
+
+
+def create_sql(tokenize=TOKENIZE, prefix=PREFIX):
+    """CREATE VIRTUAL TABLE statement of summary_fts for the given settings."""
+    options = [f"content={_quote(CONTENT)}", f"tokenize={_quote(tokenize)}"]
+    if prefix:
+        options.append(f"prefix={_quote(prefix)}")
+    columns = ", ".join(f"[{c}]" for c in COLUMNS)
+    return f"CREATE VIRTUAL TABLE [{TABLE}] USING FTS5 ({columns}, {', '.join(options)})"
+
+
+def _text(row):
+    """Indexed values of a books row (new, old or books), in COLUMNS order."""
+    return ", ".join(f"{row}.[{c}]" for c in COLUMNS)
+
+
+def _triggers_sql():
+    columns = ", ".join(f"[{c}]" for c in COLUMNS)
+    insert = f"INSERT INTO [{TABLE}] (rowid, {columns}) VALUES (new.rowid, {_text('new')});"
+    delete = f"INSERT INTO [{TABLE}] ([{TABLE}], rowid, {columns}) VALUES ('delete', old.rowid, {_text('old')});"
+    return [
+        f"CREATE TRIGGER [{TRIGGERS[0]}] AFTER INSERT ON [{CONTENT}] BEGIN {insert} END",
+        f"CREATE TRIGGER [{TRIGGERS[1]}] AFTER DELETE ON [{CONTENT}] BEGIN {delete} END",
+        f"CREATE TRIGGER [{TRIGGERS[2]}] AFTER UPDATE ON [{CONTENT}] BEGIN {delete} {insert} END",
+    ]
+
+
+def ensure(db):
+    """
+    Create summary_fts and its triggers, or recreate them when their definition changed.
+
+    Args:
+        db (Database): index.db, with its books table.
+
+    Returns:
+        bool: True when the index was (re)built from the books rows.
+    """
+    rows = {name: sql for name, sql in db.execute(
+        "SELECT name, sql FROM sqlite_master WHERE name IN (?, ?, ?, ?)", [TABLE, *TRIGGERS]).fetchall()}
+    if rows.get(TABLE) == create_sql() and all(rows.get(t) == sql for t, sql in zip(TRIGGERS, _triggers_sql())):
+        return False
+    conn = db.conn
+    with conn:
+        for trigger in _OLD_TRIGGERS + TRIGGERS:
+            conn.execute(f"DROP TRIGGER IF EXISTS [{trigger}]")
+        # Also drops the shadow tables (summary_fts_data, _idx, _docsize, _config)
+        conn.execute(f"DROP TABLE IF EXISTS [{TABLE}]")
+        conn.execute(create_sql())
+        for sql in _triggers_sql():
+            conn.execute(sql)
+        columns = ", ".join(f"[{c}]" for c in COLUMNS)
+        conn.execute(f"INSERT INTO [{TABLE}] (rowid, {columns}) SELECT rowid, {_text(CONTENT)} FROM [{CONTENT}]")
+    return True
@@ -0,0 +1,186 @@
+"""
+Shared HTTP session registry for all crawler network calls.
+
+Every request used to go through a bare requests.get(), paying a fresh TCP
+(and TLS) handshake each time, including the dozen-plus count probes per
+library. get() routes requests through one keep-alive requests.Session per
+scheme://host:port, with a configurable connection pool, a retry adapter and
+eviction of sessions that have been idle for too long.
+
+Configuration (environment variables):
+    CALISHOT_HTTP_SESSIONS      "off" to disable pooling (plain requests.get)
+    CALISHOT_HTTP_POOL_SIZE     max pooled connections per host (default 10)
+    CALISHOT_HTTP_RETRIES       retries for 502/503/504 and dropped keep-alive connections (default 2)
+    CALISHOT_HTTP_IDLE_SECONDS  close sessions unused for this long (default 120)
+"""
+
+import logging
+import os
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+def origin(url):
+    """Return scheme://host:port for url, with the default port filled in."""
+    parts = urlsplit(url)
+    scheme = (parts.scheme or "http").lower()
+    port = parts.port or (443 if scheme == "https" else 80)
+    return f"{scheme}://{(parts.hostname or '').lower()}:{port}"
+
+
+class SessionRegistry:
+    """
+    Keep-alive requests.Session objects keyed by scheme://host:port.
+
+    Args:
+        pool_maxsize (int): Max pooled connections per host.
+        retries (int): Retries on 502/503/504 and on read errors of reused connections.
+            Connect errors are never retried so dead hosts fail fast.
+        backoff (float): urllib3 backoff factor between retries.
+        idle_seconds (float): Sessions unused for longer than this are closed.
+        enabled (bool): When False, get() is a plain requests.get().
+    """
+
+    def __init__(self, pool_maxsize=10, retries=2, backoff=0.5, idle_seconds=120, enabled=True):
+        self.pool_maxsize = pool_maxsize
+        self.retries = retries
+        self.backoff = backoff
+        self.idle_seconds = idle_seconds
+        self.enabled = enabled
+        self._sessions = {}
+        self._last_used = {}
+        self._last_sweep = time.monotonic()
+        self._lock = threading.Lock()
+        self.stats = {"sessions_created": 0, "sessions_evicted": 0, "requests": 0}
+
+    def _new_session(self):
+        retry = Retry(
+            total=self.retries,
+            connect=0,
+            read=min(1, self.retries),
+            status=self.retries,
+            backoff_factor=self.backoff,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset(["GET", "HEAD"]),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize, max_retries=retry)
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def session_for(self, url):
+        """Return the shared session for url's scheme://host:port, creating it if needed."""
+        key = origin(url)
+        now = time.monotonic()
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None:
+                session = self._sessions[key] = self._new_session()
+                self.stats["sessions_created"] += 1
+            self._last_used[key] = now
+            sweep = now - self._last_sweep >= self.idle_seconds / 2
+        if sweep:
+            self.evict_idle()
+        return session
+
+    def get(self, url, **kwargs):
+        """Drop-in replacement for requests.get() that reuses pooled connections."""
+        self.stats["requests"] += 1
+        if not self.enabled:
+            return requests.get(url, **kwargs)
+        return self.session_for(url).get(url, **kwargs)
+
+    def evict_idle(self):
+        """Close sessions that have not been used for idle_seconds. Returns how many were closed."""
+        now = time.monotonic()
+        with self._lock:
+            self._last_sweep = now
+            stale = [k for k, t in self._last_used.items() if now - t >= self.idle_seconds]
+            sessions = [self._sessions.pop(k) for k in stale]
+            for k in stale:
+                del self._last_used[k]
+            self.stats["sessions_evicted"] += len(stale)
+        for session in sessions:
+            session.close()
+        if stale:
+            logging.debug("Evicted %s idle HTTP sessions", len(stale))
+        return len(stale)
+
+    def close_all(self):
+        """Close every pooled session (e.g. at the end of a crawl stage)."""
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions.clear()
+            self._last_used.clear()
+        for session in sessions:
+            session.close()
+
+
+registry = SessionRegistry(
+    pool_maxsize=int(os.getenv("CALISHOT_HTTP_POOL_SIZE", "10")),
+    retries=int(os.getenv("CALISHOT_HTTP_RETRIES", "2")),
+    idle_seconds=float(os.getenv("CALISHOT_HTTP_IDLE_SECONDS", "120")),
+    enabled=os.getenv("CALISHOT_HTTP_SESSIONS", "on").strip().lower() != "off",
+)
+
+
+def get(url, **kwargs):
+    """requests.get() through the process-wide session registry."""
+    return registry.get(url, **kwargs)
+
+
+def overloaded(error):
+    """
+    Whether a failed request is one a smaller request could get through: a timeout, a dropped connection or a 5xx.
+
+    Args:
+        error (requests.RequestException): The error.
+
+    Returns:
+        bool: False for the other errors, such as a 4xx (a missing library, a URL too long).
+    """
+    if isinstance(error, (requests.Timeout, requests.ConnectionError, requests.exceptions.ChunkedEncodingError)):
+        return True
+    response = getattr(error, "response", None)
+    return isinstance(error, requests.HTTPError) and response is not None and response.status_code >= 500
+
+
+def get_with_backoff(url, attempts=3, backoff=1.0, **kwargs):
+    """
+    get() that also retries connection errors, timeouts and HTTP errors, with jittered exponential backoff.
+
+    The adapter retries only reused-connection read errors and 502/503/504; this
+    is for callers that would otherwise abandon a long-running job on one
+    failure. Waits backoff * 2**n * uniform(0.5, 1.5) seconds between attempts.
+
+    Args:
+        url (str): URL to fetch.
+        attempts (int): Total number of tries.
+        backoff (float): Base delay in seconds.
+        **kwargs: Passed to requests.
+
+    Returns:
+        requests.Response: A response with a successful status.
+
+    Raises:
+        requests.RequestException: The last error once all attempts have failed.
+    """
+    for attempt in range(attempts):
+        try:
+            r = get(url, **kwargs)
+            r.raise_for_status()
+            return r
+        except requests.RequestException as e:
+            if attempt == attempts - 1:
+                raise
+            delay = backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+            logging.warning("GET %s failed (%s); retry %s/%s in %.1fs", url, e, attempt + 1, attempts - 1, delay)
+            time.sleep(delay)
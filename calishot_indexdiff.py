@@ -0,0 +1,112 @@
+"""
+Set-based diff of two index.db snapshots into diff.db.
+
+diff used to walk every row of the new summary, look its uuid up in the old
+snapshot one query at a time, treat any exception as NEW and insert into
+diff.db row by row; removed books were never reported. Both snapshots are now
+ATTACHed to the diff.db connection and compared on their books tables in a
+few joins on uuid:
+
+    NEW      in the new snapshot only
+    REMOVED  in the old snapshot only
+    MOVED    in both, with a different location (the description URL, the href
+             of summary.title); old_location holds the old one
+    CHANGED  in both, same location, different content_hash (see
+             calishot_indexlayout); when either side has no hash (a book
+             written by an older build, or changed through the summary view)
+             the content columns are compared instead
+
+The uuids and statuses go into a temp table, from which the diff.db summary
+rows are bulk-inserted out of each snapshot's summary view (the old one for
+REMOVED). Each run replaces the previous diff.
+"""
+
+import os
+
+import calishot_indexlayout
+
+STATUSES = ("NEW", "MOVED", "CHANGED", "REMOVED")
+TABLE = "summary"
+# Columns of diff.db's summary (functions.init_diff_db) taken from the snapshots
+COLUMNS = ("uuid", "title", "authors", "year", "series", "language", "links", "publisher", "tags", "identifiers",
+           "formats")
+BOOKS = calishot_indexlayout.BOOKS
+SITES = calishot_indexlayout.SITES
+
+
+def _check(conn, schema, path):
+    names = {name for (name,) in conn.execute(f"SELECT name FROM {schema}.sqlite_master")}
+    if BOOKS not in names or SITES not in names:
+        raise ValueError(f"{path} has no {BOOKS} table: run build_index on it first")
+    return {row[1] for row in conn.execute(f"PRAGMA {schema}.table_info([{BOOKS}])")}
+
+
+def _delta_sql(hashed):
+    location_n = calishot_indexlayout.location_sql("nb", "ns")
+    location_o = calishot_indexlayout.location_sql("ob", "os")
+    columns = " OR ".join(f"nb.[{c}] IS NOT ob.[{c}]" for c in calishot_indexlayout.CONTENT_COLUMNS)
+    if hashed:
+        changed = (f"CASE WHEN nb.content_hash IS NULL OR ob.content_hash IS NULL THEN {columns} "
+                   "ELSE nb.content_hash != ob.content_hash END")
+    else:
+        changed = columns
+    return f"""INSERT INTO temp.delta (uuid, status, old_location)
+SELECT uuid, CASE WHEN moved THEN 'MOVED' ELSE 'CHANGED' END, CASE WHEN moved THEN old_location END
+FROM (
+    SELECT nb.uuid AS uuid, {location_o} AS old_location,
+        ({location_n}) IS NOT ({location_o}) AS moved, {changed} AS changed
+    FROM n.[{BOOKS}] nb
+    JOIN o.[{BOOKS}] ob ON ob.uuid = nb.uuid
+    LEFT JOIN n.[{SITES}] ns ON ns.site_id = nb.site_id
+    LEFT JOIN o.[{SITES}] os ON os.site_id = ob.site_id
+)
+WHERE moved OR changed"""
+
+
+def compare(db_diff, old, new):
+    """
+    Write the differences between two index.db snapshots into diff.db's summary table.
+
+    Args:
+        db_diff (Database): diff.db (functions.init_diff_db).
+        old (str): Path of the old index.db.
+        new (str): Path of the new index.db.
+
+    Returns:
+        dict: {status: books} for each of STATUSES.
+
+    Raises:
+        ValueError: A snapshot is missing or has no books table (built before the compact layout).
+    """
+    for path in (old, new):
+        # ATTACH would create an empty database
+        if not os.path.exists(path):
+            raise ValueError(f"{path} does not exist")
+    conn = db_diff.conn
+    conn.execute("ATTACH DATABASE ? AS o", [str(old)])
+    conn.execute("ATTACH DATABASE ? AS n", [str(new)])
+    try:
+        hashed = all("content_hash" in _check(conn, schema, path) for schema, path in (("o", old), ("n", new)))
+        names = ", ".join(f"[{c}]" for c in COLUMNS)
+        selected = ", ".join(f"v.[{c}]" for c in COLUMNS)
+        with conn:
+            conn.execute("DROP TABLE IF EXISTS temp.delta")
+            conn.execute("CREATE TEMP TABLE delta (uuid TEXT PRIMARY KEY, status TEXT NOT NULL, old_location TEXT) "
+                         "WITHOUT ROWID")
+            conn.execute(f"INSERT INTO temp.delta (uuid, status) SELECT nb.uuid, 'NEW' FROM n.[{BOOKS}] nb "
+                         f"WHERE NOT EXISTS (SELECT 1 FROM o.[{BOOKS}] ob WHERE ob.uuid = nb.uuid)")
+            conn.execute(f"INSERT INTO temp.delta (uuid, status) SELECT ob.uuid, 'REMOVED' FROM o.[{BOOKS}] ob "
+                         f"WHERE NOT EXISTS (SELECT 1 FROM n.[{BOOKS}] nb WHERE nb.uuid = ob.uuid)")
+            conn.execute(_delta_sql(hashed))
+            conn.execute(f"DELETE FROM main.[{TABLE}]")
+            for schema, where in (("n", "d.status != 'REMOVED'"), ("o", "d.status = 'REMOVED'")):
+                conn.execute(f"INSERT INTO main.[{TABLE}] ({names}, status, old_location) "
+                             f"SELECT {selected}, d.status, d.old_location FROM temp.delta d "
+                             f"JOIN {schema}.[{TABLE}] v ON v.uuid = d.uuid WHERE {where} ORDER BY d.uuid")
+        counts = dict.fromkeys(STATUSES, 0)
+        counts.update(conn.execute("SELECT status, COUNT(*) FROM temp.delta GROUP BY status").fetchall())
+        conn.execute("DROP TABLE temp.delta")
+        return counts
+    finally:
+        conn.execute("DETACH DATABASE o")
+        conn.execute("DETACH DATABASE n")
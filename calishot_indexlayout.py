@@ -0,0 +1,271 @@
+"""
+Compact layout of index.db: books, per-format sizes and sites, read through a summary view.
+
+summary used to be a table whose rows carried every URL of their book fully
+expanded: the title as {"href", "label"} JSON, the cover thumbnail and one
+download link per format, each repeating the site's http://ip:port prefix.
+Those URLs were most of index.db. They are now stored once per site database,
+as URL templates in the sites table (see calishot_siteurls.templates), and a
+book only keeps its site_id, Calibre book_id and library:
+
+    sites         site_id, source (site database), url, host, port, major, URL templates
+    books         id, uuid, site_id, book_id, library, title (the label), authors, year,
+                  series, language, publisher, tags, identifiers, formats, content_hash
+    book_sites    uuid, site_id, book_id, library
+    book_formats  uuid, site_id, format, size
+
+A book found on several sites (mirrors) has one books row, written by the last
+site read, and a book_sites row per site with that site's formats in
+book_formats. When a site drops the book, only its location goes; books is
+pointed at a remaining one (calishot_indexsync) and deleted with the last.
+
+The summary view renders the old columns (title, cover and links JSON, source)
+from them when it is read, so datasette, demeter, index_to_json and diff keep
+reading summary as before. INSERT into summary (demeter's download bookkeeping)
+goes through an INSTEAD OF trigger that upserts into books: the columns given
+replace the stored ones, the others are kept. The trigger also appends the
+row given to summary_writes, so that a shadow build can replay into its copy
+what was written to the live index.db meanwhile (calishot_indexswap).
+
+content_hash is a 64-bit hash of a book's content (everything but its
+location), written by build_index (calishot_indexsync.book_row) for diff to
+compare snapshots by; a book changed through the view has none.
+
+book_locations is a view with one row per (host, port, uuid, format, href,
+size): where each copy of a book (book_sites) can be downloaded, the href
+rendered from its site's format template. It is not a table so that index.db
+does not store every download URL again. sites is indexed on (host, port), so
+the books of one server (demeter's scrape planning) are an index range read
+through idx_book_sites_site rather than a LIKE scan of every summary.links.
+
+books.id is an explicit INTEGER PRIMARY KEY: summary_fts (calishot_fts) uses
+books as its external content and addresses rows by rowid, and SQLite only
+keeps rowids across VACUUM (compaction, shadow builds' VACUUM INTO) when they
+are declared.
+
+An index.db with a summary table is migrated by dropping that table and its
+marks (index_sources), so the next build_index reads every site again.
+"""
+
+
+SITES = "sites"
+BOOKS = "books"
+BOOK_SITES = "book_sites"
+FORMATS = "book_formats"
+VIEW = "summary"
+LOCATIONS = "book_locations"
+WRITES = "summary_writes"
+BOOK_COLUMNS = ("uuid", "site_id", "book_id", "library", "title", "authors", "year", "series", "language",
+                "publisher", "tags", "identifiers", "formats", "content_hash")
+# Columns hashed into content_hash, with the format sizes
+CONTENT_COLUMNS = ("title", "authors", "year", "series", "language", "publisher", "tags", "identifiers", "formats")
+
+_BOOKS_SQL = f"""CREATE TABLE IF NOT EXISTS [{BOOKS}] (
+    id INTEGER PRIMARY KEY,
+    uuid TEXT NOT NULL UNIQUE,
+    site_id INTEGER REFERENCES [{SITES}](site_id),
+    book_id INTEGER,
+    library TEXT,
+    title TEXT,
+    authors TEXT,
+    year TEXT,
+    series TEXT,
+    language TEXT,
+    publisher TEXT,
+    tags TEXT,
+    identifiers TEXT,
+    formats TEXT,
+    content_hash INTEGER
+)"""
+
+_FORMATS_SQL = f"""CREATE TABLE IF NOT EXISTS [{FORMATS}] (
+    uuid TEXT NOT NULL,
+    site_id INTEGER NOT NULL,
+    format TEXT NOT NULL,
+    size INTEGER,
+    PRIMARY KEY (uuid, site_id, format)
+) WITHOUT ROWID"""
+
+_DELETE_TRIGGER = f"""CREATE TRIGGER IF NOT EXISTS books_formats_ad AFTER DELETE ON [{BOOKS}] BEGIN
+    DELETE FROM [{FORMATS}] WHERE uuid = old.uuid;
+    DELETE FROM [{BOOK_SITES}] WHERE uuid = old.uuid;
+END"""
+
+_WRITES_SQL = f"""CREATE TABLE IF NOT EXISTS [{WRITES}] (
+    id INTEGER PRIMARY KEY,
+    uuid TEXT,
+    {", ".join(f"[{c}] TEXT" for c in CONTENT_COLUMNS)}
+)"""
+
+_TABLES = [
+    f"""CREATE TABLE IF NOT EXISTS [{SITES}] (
+    site_id INTEGER PRIMARY KEY,
+    source TEXT NOT NULL UNIQUE,
+    url TEXT,
+    host TEXT,
+    port INTEGER,
+    major INTEGER,
+    desc_template TEXT,
+    img_template TEXT,
+    format_template TEXT
+)""",
+    _BOOKS_SQL,
+    f"CREATE INDEX IF NOT EXISTS idx_books_site ON [{BOOKS}](site_id)",
+    f"CREATE INDEX IF NOT EXISTS idx_sites_host ON [{SITES}](host, port)",
+    f"""CREATE TABLE IF NOT EXISTS [{BOOK_SITES}] (
+    uuid TEXT NOT NULL,
+    site_id INTEGER NOT NULL,
+    book_id INTEGER,
+    library TEXT,
+    PRIMARY KEY (uuid, site_id)
+) WITHOUT ROWID""",
+    f"CREATE INDEX IF NOT EXISTS idx_book_sites_site ON [{BOOK_SITES}](site_id)",
+    _FORMATS_SQL,
+    _DELETE_TRIGGER,
+    _WRITES_SQL,
+]
+
+
+def _render(template, **values):
+    """SQL filling the {name} placeholders of a template column."""
+    sql = template
+    for name, value in values.items():
+        sql = f"replace({sql}, '{{{name}}}', {value})"
+    return sql
+
+
+def size_label_sql(size):
+    """SQL rendering a size in bytes like humanize.naturalsize ('1 Byte', '12 Bytes', '1.2 MB', ...), halves rounded up."""
+    units = "".join(f" WHEN {size} < 1e{3 * (i + 2)} THEN printf('%.1f {unit}', {size} / 1e{3 * (i + 1)})"
+                    for i, unit in enumerate(("kB", "MB", "GB", "TB", "PB")))
+    return (f"CASE WHEN {size} = 1 THEN '1 Byte' WHEN {size} < 1000 THEN {size} || ' Bytes'{units} "
+            f"ELSE printf('%.1f EB', {size} / 1e18) END")
+
+
+def location_sql(b="b", s="s"):
+    """SQL rendering the description URL of a book (alias b) of a site (alias s), the href of summary.title."""
+    return _render(f"{s}.desc_template", id=f"{b}.book_id", library=f"COALESCE({b}.library, '')")
+
+
+def view_sql():
+    """CREATE VIEW statement of summary."""
+    ids = {"id": "b.book_id", "library": "COALESCE(b.library, '')"}
+    desc = location_sql()
+    img = _render("s.img_template", **ids)
+    link = _render("s.format_template", format="j.value", **ids)
+    label = f"j.value || CASE WHEN f.size IS NULL THEN '' ELSE ' (' || {size_label_sql('f.size')} || ')' END"
+    # Columns of the former summary table, in its order, then rowid for datasette's fts_pk
+    return f"""CREATE VIEW [{VIEW}] AS SELECT
+    b.uuid AS uuid,
+    CASE WHEN s.site_id IS NULL THEN NULL ELSE json_object('img_src', {img}, 'width', 90) END AS cover,
+    CASE WHEN s.site_id IS NULL THEN b.title ELSE json_object('href', {desc}, 'label', b.title) END AS title,
+    b.authors AS authors,
+    b.year AS year,
+    b.series AS series,
+    b.language AS language,
+    CASE WHEN s.site_id IS NULL OR NOT json_valid(b.formats) THEN NULL ELSE (
+        SELECT json_group_array(json_object('href', {link}, 'label', {label}))
+        FROM json_each(b.formats) j LEFT JOIN [{FORMATS}] f
+            ON f.uuid = b.uuid AND f.site_id = b.site_id AND f.format = j.value
+    ) END AS links,
+    b.publisher AS publisher,
+    b.tags AS tags,
+    b.identifiers AS identifiers,
+    b.formats AS formats,
+    s.source AS source,
+    b.rowid AS rowid
+FROM [{BOOKS}] b LEFT JOIN [{SITES}] s ON s.site_id = b.site_id"""
+
+
+def locations_view_sql():
+    """CREATE VIEW statement of book_locations."""
+    href = _render("s.format_template", format="f.format", id="l.book_id", library="COALESCE(l.library, '')")
+    return f"""CREATE VIEW [{LOCATIONS}] AS SELECT
+    s.host AS host,
+    s.port AS port,
+    l.uuid AS uuid,
+    f.format AS format,
+    {href} AS href,
+    f.size AS size
+FROM [{SITES}] s
+JOIN [{BOOK_SITES}] l ON l.site_id = s.site_id
+JOIN [{FORMATS}] f ON f.uuid = l.uuid AND f.site_id = l.site_id"""
+
+
+def _log_sql():
+    """Trigger statement appending the summary row given to summary_writes."""
+    columns = ("uuid",) + CONTENT_COLUMNS
+    return (f"INSERT INTO [{WRITES}] ({', '.join(f'[{c}]' for c in columns)}) "
+            f"VALUES ({', '.join(f'new.[{c}]' for c in columns)});")
+
+
+def insert_trigger_sql():
+    """INSTEAD OF INSERT trigger of summary: an upsert into books of the columns given, logged in summary_writes."""
+    columns = ("uuid",) + CONTENT_COLUMNS
+    values = ["CASE WHEN json_valid(new.title) THEN COALESCE(json_extract(new.title, '$.label'), new.title) "
+              "ELSE new.title END" if c == "title" else f"new.[{c}]" for c in columns]
+    # The stored hash no longer describes the row
+    updates = ", ".join([f"[{c}] = COALESCE(excluded.[{c}], [{c}])" for c in CONTENT_COLUMNS] + ["content_hash = NULL"])
+    return (f"CREATE TRIGGER [{VIEW}_ii] INSTEAD OF INSERT ON [{VIEW}] BEGIN "
+            f"INSERT INTO [{BOOKS}] ({', '.join(f'[{c}]' for c in columns)}) VALUES ({', '.join(values)}) "
+            f"ON CONFLICT(uuid) DO UPDATE SET {updates}; {_log_sql()} END")
+
+
+def track_writes(conn):
+    """
+    Log the writes to the summary of a live index.db that ensure() has not upgraded yet, for a shadow build to replay.
+
+    Args:
+        conn (sqlite3.Connection): The live index.db.
+    """
+    kind = conn.execute("SELECT type FROM sqlite_master WHERE name = ?", [VIEW]).fetchone()
+    with conn:
+        conn.execute(_WRITES_SQL)
+        if kind == ("view",):
+            trigger = conn.execute("SELECT sql FROM sqlite_master WHERE name = ?", [f"{VIEW}_ii"]).fetchone()
+            if trigger != (insert_trigger_sql(),):
+                conn.execute(f"DROP TRIGGER IF EXISTS [{VIEW}_ii]")
+                conn.execute(insert_trigger_sql())
+        elif kind == ("table",):
+            # summary from before the compact layout
+            conn.execute(f"CREATE TRIGGER IF NOT EXISTS [{VIEW}_writes_ai] AFTER INSERT ON [{VIEW}] BEGIN {_log_sql()} END")
+
+
+def trim_writes(conn):
+    """Empty summary_writes but for its last row, the mark replays start after."""
+    with conn:
+        conn.execute(f"DELETE FROM [{WRITES}] WHERE id < (SELECT MAX(id) FROM [{WRITES}])")
+
+
+def ensure(db):
+    """
+    Create the compact tables and the summary view, migrating an index.db whose summary is a table.
+
+    Args:
+        db (Database): index.db.
+
+    Returns:
+        bool: True when a summary table was dropped and every site database has to be read again.
+    """
+    conn = db.conn
+    kinds = dict(conn.execute("SELECT name, type FROM sqlite_master WHERE name IN (?, ?)",
+                              [VIEW, "index_sources"]).fetchall())
+    migrated = kinds.get(VIEW) == "table"
+    with conn:
+        if migrated:
+            conn.execute(f"DROP TABLE [{VIEW}]")
+            if "index_sources" in kinds:
+                conn.execute("DELETE FROM index_sources")
+        for sql in _TABLES:
+            conn.execute(sql)
+        current = dict(conn.execute("SELECT name, sql FROM sqlite_master WHERE name IN (?, ?, ?)",
+                                    [VIEW, f"{VIEW}_ii", LOCATIONS]).fetchall())
+        if current.get(LOCATIONS) != locations_view_sql():
+            conn.execute(f"DROP VIEW IF EXISTS [{LOCATIONS}]")
+            conn.execute(locations_view_sql())
+        if current.get(VIEW) != view_sql() or current.get(f"{VIEW}_ii") != insert_trigger_sql():
+            # Also drops the view's INSTEAD OF trigger
+            conn.execute(f"DROP VIEW IF EXISTS [{VIEW}]")
+            conn.execute(view_sql())
+            conn.execute(insert_trigger_sql())
+    return migrated
@@ -0,0 +1,237 @@
+"""
+Shadow builds of index.db, swapped in atomically.
+
+build_index used to write straight into the live data/index.db, so Demeter and
+datasette saw half-built summary/FTS tables and waited on its write locks. In
+shadow mode it builds into index.db.building instead: a VACUUM INTO snapshot
+of the live index (so the incremental marks carry over) that nothing else
+opens. When the build is done the copy is ANALYZEd, its FTS index optimized
+and fsynced, and moved over index.db with os.replace, an atomic rename on
+every platform (no symlink, so it works on Windows and on Docker bind mounts).
+
+The live index.db stays writable during the build: Demeter records downloads
+by inserting into summary. Every such insert is also appended to
+summary_writes (calishot_indexlayout), and swap() replays into the new file,
+in order, the rows appended since the snapshot: once while the live file is
+still open to writers, then again holding its write lock, right before the
+rename. The previous index.db is hard-linked to a generation file
+(index.db.<YYYYmmdd-HHMMSS>) and replayed from once more after the rename,
+for the writes Windows lets in between (a file SQLite has open cannot be
+replaced there, so the lock is released first).
+
+-journal, -wal and -shm files are named after index.db, not after the file,
+so the live index is switched to a rollback journal before the swap, and the
+write lock makes sure no transaction is half-way through one. A writer whose
+connection was opened before the swap gets SQLITE_READONLY_DBMOVED instead of
+writing into the previous file. Readers that already have index.db open keep
+reading the previous one until they reconnect.
+
+The newest CALISHOT_INDEX_GENERATIONS (default 2) previous index.db files are
+kept; to roll back, stop the readers and copy one over index.db.
+"""
+
+import datetime
+import os
+import re
+import shutil
+import sqlite3
+import time
+
+import calishot_indexlayout
+
+GENERATIONS = int(os.getenv("CALISHOT_INDEX_GENERATIONS", "2"))
+SUFFIX = ".building"
+# Seconds to wait for the live index.db's locks
+TIMEOUT = 60
+_GENERATION = re.compile(r"\.\d{8}-\d{6}(-\d+)?$")
+
+
+def building_path(path):
+    return f"{path}{SUFFIX}"
+
+
+def _remove(path):
+    for p in (path, f"{path}-journal", f"{path}-wal", f"{path}-shm"):
+        try:
+            os.remove(p)
+        except FileNotFoundError:
+            pass
+
+
+def start(path):
+    """
+    Create path.building as a consistent copy of the live index at path (empty when there is none).
+
+    Returns:
+        str: The path of the file to build into.
+    """
+    building = building_path(path)
+    # Leftover of an interrupted build
+    _remove(building)
+    if os.path.exists(path):
+        conn = sqlite3.connect(path, timeout=TIMEOUT)
+        try:
+            calishot_indexlayout.track_writes(conn)
+            conn.execute("VACUUM INTO ?", [building])
+        finally:
+            conn.close()
+        conn = sqlite3.connect(building)
+        try:
+            calishot_indexlayout.trim_writes(conn)
+        finally:
+            conn.close()
+    return building
+
+
+def prepare(conn):
+    """Settings for the connection filling a building file: it is thrown away, not repaired, after a crash."""
+    conn.execute("PRAGMA journal_mode=MEMORY")
+    conn.execute("PRAGMA synchronous=OFF")
+
+
+def finish(building, fts_tables=()):
+    """ANALYZE the building file, optimize its FTS tables, switch it to a rollback journal and fsync it."""
+    conn = sqlite3.connect(building)
+    try:
+        for table in fts_tables:
+            conn.execute(f"INSERT INTO [{table}] ([{table}]) VALUES ('optimize')")
+        conn.commit()
+        conn.execute("ANALYZE")
+        conn.commit()
+        conn.execute("PRAGMA journal_mode=DELETE")
+    finally:
+        conn.close()
+    fd = os.open(building, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _generation_name(path, when):
+    name = f"{path}.{when.strftime('%Y%m%d-%H%M%S')}"
+    candidate, n = name, 1
+    while os.path.lexists(candidate):
+        candidate = f"{name}-{n}"
+        n += 1
+    return candidate
+
+
+def generations(path):
+    """Generation files of path, oldest first."""
+    folder, base = os.path.split(os.path.abspath(path))
+    found = [os.path.join(folder, f) for f in os.listdir(folder)
+             if f.startswith(base) and _GENERATION.fullmatch(f[len(base):] or "x")]
+    return sorted(found, key=lambda p: (os.stat(p).st_mtime, p))
+
+
+def _last_write(path):
+    conn = sqlite3.connect(path, timeout=TIMEOUT)
+    try:
+        return conn.execute(f"SELECT MAX(id) FROM [{calishot_indexlayout.WRITES}]").fetchone()[0] or 0
+    finally:
+        conn.close()
+
+
+def replay(source, target, since=0):
+    """
+    Insert into the summary of target, in order, the rows logged in the summary_writes of source after id since.
+
+    Args:
+        source (str): The index.db that was written to.
+        target (str): The index.db to carry the writes over to.
+        since (int): The last summary_writes id of source already in target.
+
+    Returns:
+        tuple: (int: rows replayed, int: the last summary_writes id of source).
+    """
+    columns = ", ".join(f"[{c}]" for c in ("uuid",) + calishot_indexlayout.CONTENT_COLUMNS)
+    conn = sqlite3.connect(target, timeout=TIMEOUT)
+    try:
+        conn.execute("ATTACH DATABASE ? AS source", [source])
+        conn.execute("BEGIN")
+        count, last = conn.execute(f"SELECT COUNT(*), MAX(id) FROM source.[{calishot_indexlayout.WRITES}] "
+                                   f"WHERE id > ?", [since]).fetchone()
+        if count:
+            conn.execute(f"INSERT INTO main.[{calishot_indexlayout.VIEW}] ({columns}) SELECT {columns} "
+                         f"FROM source.[{calishot_indexlayout.WRITES}] WHERE id > ? AND id <= ? ORDER BY id",
+                         [since, last])
+        conn.commit()
+    finally:
+        conn.close()
+    return count, last or since
+
+
+def _keep(path, generation):
+    """Make generation a name of the file at path: a hard link, or a copy where there are none."""
+    try:
+        os.link(path, generation)
+    except OSError:
+        shutil.copy2(path, generation)
+
+
+def _replace(building, path):
+    # On Windows a file another process has open cannot be replaced: wait for it to be closed
+    deadline = time.monotonic() + TIMEOUT
+    while True:
+        try:
+            os.replace(building, path)
+            return
+        except PermissionError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def swap(path, building, keep=GENERATIONS):
+    """
+    Replace path by building with the summary writes made to path since start(), then prune old generations.
+
+    Args:
+        path (str): The live index.db.
+        building (str): Its finished copy.
+        keep (int): Previous index.db files kept. Defaults to CALISHOT_INDEX_GENERATIONS.
+
+    Returns:
+        tuple: (str: the previous index.db, kept as a generation file, or None when there was none,
+        int: writes replayed into building).
+    """
+    if not os.path.exists(path):
+        os.replace(building, path)
+        return None, 0
+    replayed, since = replay(path, building, _last_write(building))
+    generation = _generation_name(path, datetime.datetime.now())
+    conn = sqlite3.connect(path, timeout=TIMEOUT)
+    try:
+        mode = conn.execute("PRAGMA journal_mode=DELETE").fetchone()[0]
+        if mode.lower() != "delete":
+            raise sqlite3.OperationalError(f"{path} is in {mode} mode and open elsewhere, it cannot be swapped yet")
+        # Writers wait from here on; readers, replay() included, do not
+        conn.execute("BEGIN IMMEDIATE")
+        count, since = replay(path, building, since)
+        replayed += count
+        _keep(path, generation)
+        if os.name == "nt":
+            conn.close()
+        _replace(building, path)
+    finally:
+        conn.close()
+    # Writes that reached the previous file after the replay above, while it was unlocked (Windows)
+    replayed += replay(generation, path, since)[0]
+    prune(path, keep)
+    return generation, replayed
+
+
+def prune(path, keep=GENERATIONS):
+    """Delete all but the newest keep generations that index.db does not point at. Returns the deleted files."""
+    current = os.path.realpath(path)
+    old = [g for g in generations(path) if os.path.realpath(g) != current]
+    doomed = old[:max(0, len(old) - keep)]
+    for g in doomed:
+        _remove(g)
+    return doomed
+
+
+def discard(building):
+    """Drop a building file that is not worth swapping in."""
+    _remove(building)
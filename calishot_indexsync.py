@@ -0,0 +1,403 @@
+"""
+Per-site change tracking for incremental index.db builds.
+
+build_index used to re-read every site database and upsert every book into
+index.db, which takes hours on a large catalogue even when only a few sites
+changed. It now keeps a mark per
+site database in index.db (index_sources): the file's mtime, its row count,
+its largest rowid and last_modified, and the site's URL/major. A site whose
+file is untouched is skipped without opening it. For a changed site only the
+rows past the mark are rebuilt: rowids above the stored one (books inserted or
+replaced since, as REPLACE gives a new rowid) and last_modified above the
+stored one. Every site a book is on is recorded in book_sites, with its
+formats in book_formats (see calishot_indexlayout). A site database that no
+longer has a book, or is gone, loses its location of the book only: the book
+is deleted with its last location.
+
+summary_fts follows the books rows through its triggers (calishot_fts).
+
+A book present on several sites keeps the version of the last site that wrote
+it. If that site drops it while another still has it, books.site_id is
+pointed at the remaining site (the lowest site_id), with the formats that site
+has; the other columns stay as they are until that site writes the book again.
+
+The rows to read are cut into rowid chunks (plan_chunks) that build_index hands
+to reader processes running read_summaries; IndexWriter is the only thing
+writing index.db.
+
+Configuration (environment variables):
+    CALISHOT_INDEX_WORKERS   reader processes, 0 reads inline (default: CPUs - 1)
+    CALISHOT_INDEX_CHUNK     site rows per reader job (default 5000)
+    CALISHOT_INDEX_TXN_ROWS  books per index.db transaction (default 50000)
+"""
+
+import datetime
+import hashlib
+import json
+import os
+
+from sqlite_utils import Database
+
+import calishot_formats
+import calishot_indexlayout
+import calishot_siteurls
+
+WORKERS = int(os.getenv("CALISHOT_INDEX_WORKERS", str(max(0, (os.cpu_count() or 1) - 1))))
+CHUNK_ROWS = int(os.getenv("CALISHOT_INDEX_CHUNK", "5000"))
+TXN_ROWS = int(os.getenv("CALISHOT_INDEX_TXN_ROWS", "50000"))
+
+TABLE = "index_sources"
+BOOK_COLUMNS = calishot_indexlayout.BOOK_COLUMNS
+BOOKS = calishot_indexlayout.BOOKS
+BOOK_SITES = calishot_indexlayout.BOOK_SITES
+FORMATS = calishot_indexlayout.FORMATS
+CONTENT_COLUMNS = calishot_indexlayout.CONTENT_COLUMNS
+SITES = calishot_indexlayout.SITES
+
+
+def ensure(db_index):
+    """Add the marks table to an index.db built before it. Returns whether it was created."""
+    created = TABLE not in db_index.table_names()
+    if created:
+        db_index[TABLE].create({
+            "source": str,
+            "mtime": float,
+            "row_count": int,
+            "max_rowid": int,
+            "max_last_modified": str,
+            "site_key": str,
+            "updated": str,
+        }, pk="source")
+    db_index.conn.commit()
+    return created
+
+
+def load(db_index):
+    """Return {source: mark} for every site database indexed so far."""
+    if TABLE not in db_index.table_names():
+        return {}
+    return {row["source"]: dict(row) for row in db_index.query(f"SELECT * FROM {TABLE}")}
+
+
+def save(db_index, source, mtime, state):
+    """Record that source is indexed up to state (see site_state) as of file mtime."""
+    with db_index.conn:
+        _save(db_index, source, mtime, state)
+
+
+def _save(db_index, source, mtime, state):
+    db_index.execute(
+        f"INSERT OR REPLACE INTO {TABLE} (source, mtime, row_count, max_rowid, max_last_modified, site_key, updated) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        [source, mtime, state["row_count"], state["max_rowid"], state["max_last_modified"],
+         state["site_key"], datetime.datetime.utcnow().isoformat()])
+
+
+def up_to_date(db_index, paths):
+    """True when index.db has a mark for exactly the site databases in paths and none of them was touched since."""
+    marks = load(db_index)
+    if set(marks) != {p.stem for p in paths}:
+        return False
+    return all(marks[p.stem]["mtime"] == file_mtime(p) for p in paths)
+
+
+def file_mtime(path):
+    """Latest modification time of a site database, including its WAL file."""
+    mtime = os.stat(path).st_mtime
+    wal = f"{path}-wal"
+    if os.path.exists(wal):
+        mtime = max(mtime, os.stat(wal).st_mtime)
+    return mtime
+
+
+def site_state(db):
+    """Row count, max rowid, max last_modified and site URL/major of a site database."""
+    row_count, max_rowid, max_lm = db.execute(
+        "SELECT COUNT(*), COALESCE(MAX(rowid), 0), MAX(last_modified) FROM ebooks").fetchone()
+    site = list(db["site"].rows)[0]
+    return {
+        "row_count": row_count,
+        "max_rowid": max_rowid,
+        "max_last_modified": max_lm,
+        "site_key": json.dumps([json.loads(site["urls"])[0], site["major"]]),
+    }
+
+
+def unchanged(mark, state):
+    """True when a site database whose mtime moved still holds what mark describes."""
+    return bool(mark) and all(mark[k] == state[k] for k in ("row_count", "max_rowid", "max_last_modified", "site_key"))
+
+
+def changed_filter(mark, state):
+    """(where, params) selecting the ebooks rows added or modified since mark (every row without one)."""
+    if not mark or mark["site_key"] != state["site_key"]:
+        return "1", []
+    return "(rowid > ? OR last_modified > ?)", [mark["max_rowid"] or 0, mark["max_last_modified"] or ""]
+
+
+def plan_chunks(db, where, params, size):
+    """
+    Split the rows of ebooks matching where into rowid ranges of about size rows.
+
+    Returns:
+        list[tuple]: (lo, hi) pairs, each selecting rowid > lo AND rowid <= hi, in rowid order.
+    """
+    chunks = []
+    lo = count = last = 0
+    for (rowid,) in db.execute(f"SELECT rowid FROM ebooks WHERE {where} ORDER BY rowid", params):
+        count += 1
+        last = rowid
+        if count == size:
+            chunks.append((lo, rowid))
+            lo, count = rowid, 0
+    if count:
+        chunks.append((lo, last))
+    return chunks
+
+
+def _value(v):
+    if isinstance(v, (dict, list, tuple)):
+        return json.dumps(v, default=repr, ensure_ascii=False)
+    return v
+
+
+def ebook_summary(site_id, ebook, sizes=None):
+    """
+    Builds the index.db book row of one ebooks row of a site database.
+
+    Args:
+        site_id (int): The sites row of the site database in index.db.
+        ebook (dict): The ebooks row; its JSON columns are decoded in place.
+        sizes (dict, optional): {format: size} of the book, from ebook_formats.
+
+    Returns:
+        dict: The book (see calishot_indexlayout.BOOK_COLUMNS), with 'sizes' {format: size}.
+            Its URLs are rendered by the summary view from the site's templates.
+    """
+    for column in ("authors", "identifiers", "tags"):
+        if ebook[column]:
+            ebook[column] = json.loads(ebook[column])
+    ebook["formats"] = json.loads(ebook["formats"])
+    summary = {k: v for k, v in ebook.items() if k in ("uuid", "title", "authors", "series", "language", "formats",
+                                                       "tags", "publisher", "identifiers", "library")}
+    summary["site_id"] = site_id
+    summary["book_id"] = ebook["id"]
+    sizes = sizes or {}
+    summary["sizes"] = {f: sizes.get(f) for f in ebook["formats"]}
+    pubdate = ebook["pubdate"]
+    summary["year"] = pubdate[0:4] if pubdate else ""
+    return summary
+
+
+def read_summaries(path, site_id, lo, hi, where, params):
+    """
+    Builds the index.db rows of one rowid range of a site database.
+
+    Runs in the build_index reader processes (or inline without them).
+
+    Args:
+        path (str): The site database.
+        site_id (int): Its sites row in index.db (register_site).
+        lo (int), hi (int): Rows with lo < rowid <= hi are read.
+        where (str), params (list): Further filter, from changed_filter.
+
+    Returns:
+        list[tuple]: book_row() pairs in rowid order.
+    """
+    db = Database(path)
+    rows = []
+    where = f"rowid > ? AND rowid <= ? AND {where}"
+    params = [lo, hi] + list(params)
+    try:
+        sizes = calishot_formats.sizes(db, where, params)
+        for ebook in db.query(f"SELECT * FROM ebooks WHERE {where} ORDER BY rowid", params):
+            rows.append(book_row(ebook_summary(site_id, ebook, sizes.get(ebook["uuid"]))))
+    finally:
+        db.conn.close()
+    return rows
+
+
+def book_row(book):
+    """
+    A book dict (ebook_summary) as rows for index.db.
+
+    Returns:
+        tuple: (books tuple in BOOK_COLUMNS order with dict/list values as JSON,
+        list of (uuid, site_id, format, size) book_formats tuples).
+    """
+    sizes = [(book["uuid"], book.get("site_id"), f, size) for f, size in book.get("sizes", {}).items()]
+    values = {c: _value(book.get(c)) for c in BOOK_COLUMNS}
+    values["content_hash"] = content_hash([values[c] for c in CONTENT_COLUMNS], sorted(s[2:] for s in sizes))
+    return tuple(values[c] for c in BOOK_COLUMNS), sizes
+
+
+def content_hash(values, sizes):
+    """
+    Signed 64-bit hash (an SQLite INTEGER) of a book's content.
+
+    Args:
+        values (list): Its CONTENT_COLUMNS values, as stored.
+        sizes (list): Its (format, size) pairs, sorted.
+    """
+    data = json.dumps([values, sizes], ensure_ascii=False, default=repr).encode("utf-8")
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "big", signed=True)
+
+
+def register_site(db_index, source, ctx):
+    """
+    Insert or update the sites row of a site database.
+
+    Args:
+        db_index (Database): index.db.
+        source (str): The site database's name (file stem).
+        ctx (SiteContext): Its URL context (calishot_siteurls.from_site_db).
+
+    Returns:
+        int: The site_id of source.
+    """
+    urls = calishot_siteurls.templates(ctx)
+    host, port = calishot_siteurls.host_port(ctx.url)
+    with db_index.conn:
+        db_index.execute(
+            f"INSERT INTO {SITES} (source, url, host, port, major, desc_template, img_template, format_template) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(source) DO UPDATE SET url = excluded.url, "
+            "host = excluded.host, port = excluded.port, major = excluded.major, "
+            "desc_template = excluded.desc_template, img_template = excluded.img_template, "
+            "format_template = excluded.format_template",
+            [source, ctx.url, host, port, ctx.major, urls["desc_template"], urls["img_template"],
+             urls["format_template"]])
+    return site_id(db_index, source)
+
+
+def site_id(db_index, source):
+    """The site_id of a site database in index.db, or None."""
+    row = db_index.execute(f"SELECT site_id FROM {SITES} WHERE source = ?", [source]).fetchone()
+    return row[0] if row else None
+
+
+def upsert_books(db_index, rows):
+    """
+    Insert or update books, their locations and formats by uuid in one transaction.
+
+    Args:
+        db_index (Database): index.db.
+        rows (list[tuple]): book_row() pairs.
+    """
+    with db_index.conn:
+        _upsert(db_index, rows)
+
+
+def _upsert(db_index, rows):
+    if not rows:
+        return
+    # Every (uuid, site_id) is a location; a dict keeps the last version at its first position
+    located = list({book[:2]: (book, sizes) for book, sizes in rows}.values())
+    # A book on several sites keeps its last version; a dict keeps its first position (and rowid)
+    books = list({book[0]: book for book, _ in located}.values())
+    names = ", ".join(f"[{c}]" for c in BOOK_COLUMNS)
+    updates = ", ".join(f"[{c}] = excluded.[{c}]" for c in BOOK_COLUMNS if c != "uuid")
+    conn = db_index.conn
+    # An upsert, not REPLACE: the update keeps the rowid and fires summary_fts' update trigger
+    conn.executemany(
+        f"INSERT INTO {BOOKS} ({names}) VALUES ({', '.join('?' for _ in BOOK_COLUMNS)}) "
+        f"ON CONFLICT(uuid) DO UPDATE SET {updates}", books)
+    conn.executemany(
+        f"INSERT INTO {BOOK_SITES} (uuid, site_id, book_id, library) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT(uuid, site_id) DO UPDATE SET book_id = excluded.book_id, library = excluded.library",
+        [book[:4] for book, _ in located])
+    conn.executemany(f"DELETE FROM {FORMATS} WHERE uuid = ? AND site_id = ?", [book[:2] for book, _ in located])
+    conn.executemany(f"INSERT INTO {FORMATS} (uuid, site_id, format, size) VALUES (?, ?, ?, ?)",
+                     [size for _, sizes in located for size in sizes])
+
+
+class IndexWriter:
+    """
+    The one writer of index.db during a build.
+
+    Book rows arriving from the readers are buffered and written in
+    transactions of about txn_rows rows. A site's mark is queued with mark()
+    once all its rows have been added and committed in the same transaction as
+    the last of them, so an interrupted build never records rows it did not write.
+
+    Args:
+        db_index (Database): index.db.
+        txn_rows (int): Rows per transaction.
+    """
+
+    def __init__(self, db_index, txn_rows=50000):
+        self.db_index = db_index
+        self.txn_rows = txn_rows
+        self.rows = []
+        self.marks = []
+        self.written = 0
+        self.commits = 0
+
+    def add(self, rows):
+        self.rows.extend(rows)
+        if len(self.rows) >= self.txn_rows:
+            self.flush()
+
+    def mark(self, source, mtime, state):
+        self.marks.append((source, mtime, state))
+
+    def flush(self):
+        if not self.rows and not self.marks:
+            return
+        with self.db_index.conn:
+            _upsert(self.db_index, self.rows)
+            for source, mtime, state in self.marks:
+                _save(self.db_index, source, mtime, state)
+        self.written += len(self.rows)
+        self.commits += 1
+        self.rows = []
+        self.marks = []
+
+
+def delete_missing(db_index, source, path):
+    """
+    Drop the locations of source whose uuid is no longer in its site database.
+
+    Returns:
+        int: The books deleted, having no other location left.
+    """
+    conn = db_index.conn
+    conn.execute("ATTACH DATABASE ? AS site_src", [str(path)])
+    try:
+        return _delete(db_index, site_id(db_index, source), "uuid NOT IN (SELECT uuid FROM site_src.ebooks)")
+    finally:
+        conn.execute("DETACH DATABASE site_src")
+
+
+def delete_source(db_index, source):
+    """Drop every location of a site database that no longer exists, its sites row and its mark. Returns the books deleted."""
+    removed = _delete(db_index, site_id(db_index, source))
+    with db_index.conn:
+        db_index.execute(f"DELETE FROM {SITES} WHERE source = ?", [source])
+        db_index.execute(f"DELETE FROM {TABLE} WHERE source = ?", [source])
+    return removed
+
+
+def _delete(db_index, site, where="1"):
+    if site is None:
+        return 0
+    conn = db_index.conn
+    with conn:
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS gone (uuid TEXT PRIMARY KEY) WITHOUT ROWID")
+        conn.execute("DELETE FROM temp.gone")
+        conn.execute(f"INSERT INTO temp.gone SELECT uuid FROM {BOOK_SITES} WHERE site_id = ? AND {where}", [site])
+        conn.execute(f"DELETE FROM {FORMATS} WHERE site_id = ? AND uuid IN (SELECT uuid FROM temp.gone)", [site])
+        conn.execute(f"DELETE FROM {BOOK_SITES} WHERE site_id = ? AND uuid IN (SELECT uuid FROM temp.gone)", [site])
+        # Books written by this site that another site still has: point them at that one
+        other = f"(SELECT MIN(l.site_id) FROM {BOOK_SITES} l WHERE l.uuid = {BOOKS}.uuid)"
+        conn.execute(
+            f"UPDATE {BOOKS} SET (site_id, book_id, library) = "
+            f"(SELECT l.site_id, l.book_id, l.library FROM {BOOK_SITES} l WHERE l.uuid = {BOOKS}.uuid "
+            f"AND l.site_id = {other}), "
+            f"formats = (SELECT json_group_array(f.format) FROM {FORMATS} f "
+            f"WHERE f.uuid = {BOOKS}.uuid AND f.site_id = {other}), content_hash = NULL "
+            f"WHERE site_id = ? AND uuid IN (SELECT uuid FROM temp.gone) AND {other} IS NOT NULL", [site])
+        # The others had no location left; book_formats and book_sites rows go with them (books_formats_ad)
+        deleted = conn.execute(f"DELETE FROM {BOOKS} WHERE site_id = ? AND uuid IN (SELECT uuid FROM temp.gone)",
+                               [site]).rowcount
+        conn.execute("DELETE FROM temp.gone")
+    return deleted
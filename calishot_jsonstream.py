@@ -0,0 +1,112 @@
+"""
+Incremental decoding of a large top-level JSON object, one member at a time.
+
+A 1000-book /ajax/books response with full comments HTML can run to tens of
+MB. r.json() holds the raw bytes, the decoded text and the whole parsed tree
+at the same time. JSONObjectStream reads the body in chunks as it arrives and
+yields each "id": {book} member as soon as it is complete, keeping only about
+one record of undecoded text in memory. The response is parsed exactly once.
+
+Standard library only: members are cut out with json.JSONDecoder.raw_decode
+over a rolling buffer.
+"""
+
+import codecs
+import json
+import re
+
+_DECODER = json.JSONDecoder()
+_WS = re.compile(r"[ \t\n\r]*")
+# Characters to read ahead when a member is incomplete, beyond doubling the buffer
+_READ_AHEAD = 65536
+
+
+class JSONObjectStream:
+    """
+    Iterate over (key, value) members of a JSON object delivered as byte chunks.
+
+    Args:
+        chunks (iterable[bytes]): The UTF-8 body, e.g. response.iter_content(65536).
+
+    Attributes:
+        bytes (int): Body bytes consumed so far.
+
+    Raises:
+        ValueError: The body is not a JSON object (json.JSONDecodeError for syntax errors).
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._utf8 = codecs.getincrementaldecoder("utf-8")()
+        self._buf = ""
+        self._pos = 0
+        self._eof = False
+        self.bytes = 0
+
+    def _fill(self, want):
+        """Drop consumed text and read until want characters are buffered or the body ends."""
+        parts = [self._buf[self._pos:]]
+        have = len(parts[0])
+        while have < want and not self._eof:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                parts.append(self._utf8.decode(b"", final=True))
+                self._eof = True
+            elif chunk:
+                self.bytes += len(chunk)
+                text = self._utf8.decode(chunk)
+                parts.append(text)
+                have += len(text)
+        self._buf = "".join(parts)
+        self._pos = 0
+
+    def _peek(self):
+        """Skip whitespace and return the next character."""
+        while True:
+            self._pos = _WS.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if self._eof:
+                raise ValueError("unexpected end of JSON stream")
+            self._fill(1)
+
+    def _expect(self, char):
+        found = self._peek()
+        if found != char:
+            raise ValueError(f"expected {char!r} in JSON stream, found {found!r}")
+        self._pos += 1
+
+    def _value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = _DECODER.raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+                # Incomplete: at least double what is buffered so retries stay linear overall
+                self._fill(2 * (len(self._buf) - self._pos) + _READ_AHEAD)
+                continue
+            after = _WS.match(self._buf, end).end()
+            if not self._eof and (after == len(self._buf) or self._buf[after] not in ",:}]"):
+                # A number cut by a chunk boundary ('12' of '12.5') decodes early: wait for a delimiter
+                self._fill(2 * (len(self._buf) - self._pos) + _READ_AHEAD)
+                continue
+            self._pos = end
+            return value
+
+    def __iter__(self):
+        self._expect("{")
+        if self._peek() == "}":
+            self._pos += 1
+            return
+        while True:
+            key = self._value()
+            self._expect(":")
+            yield key, self._value()
+            separator = self._peek()
+            self._pos += 1
+            if separator == "}":
+                return
+            if separator != ",":
+                raise ValueError(f"expected ',' or '}}' in JSON stream, found {separator!r}")
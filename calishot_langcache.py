@@ -0,0 +1,149 @@
+"""
+Persistent cache of langid results, keyed by a fingerprint of the text.
+
+Mirrors and multi-library hosts carry the same books many times over, and
+every copy without a language used to cost a langid run over its comments.
+The cache maps a 16-byte BLAKE2 digest of the normalized text (NFKC,
+lowercased, whitespace collapsed) to the ISO 639-2 code and probability langid
+gave for it. It lives in its own SQLite file next to sites.db, is read and
+written in batches (one query per page of books, not one per book), and is
+kept under a maximum number of entries by evicting the least recently used.
+
+Configuration (environment variables):
+    CALISHOT_LANGID_CACHE_SIZE  maximum entries, 0 disables the cache (default 500000)
+"""
+
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+import unicodedata
+
+# SQLite's default limit on host parameters is 999
+_CHUNK = 500
+
+
+def text_key(text):
+    """Fingerprint of text, insensitive to case, Unicode form and whitespace."""
+    normalized = " ".join(unicodedata.normalize("NFKC", text or "").lower().split())
+    return hashlib.blake2b(normalized.encode("utf-8"), digest_size=16).digest()
+
+
+class LanguageCache:
+    """
+    lang_cache rows in a small SQLite file: key -> (language, prob).
+
+    The connection is opened on first use, so creating the object is free.
+
+    Args:
+        path (str | Path): The cache database file.
+        max_entries (int): Entries kept; the least recently used are evicted beyond this.
+    """
+
+    def __init__(self, path, max_entries=500000):
+        self.path = str(path)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._conn = None
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS lang_cache (
+                    key BLOB PRIMARY KEY,
+                    language TEXT,
+                    prob REAL,
+                    used REAL
+                ) WITHOUT ROWID
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS lang_cache_used ON lang_cache(used)")
+            self._count = conn.execute("SELECT COUNT(*) FROM lang_cache").fetchone()[0]
+            self._conn = conn
+        return self._conn
+
+    def get_many(self, keys):
+        """
+        Look up a batch of keys.
+
+        Args:
+            keys (iterable[bytes]): Keys from text_key().
+
+        Returns:
+            dict: key -> (language, prob) for the keys found.
+        """
+        keys = list(dict.fromkeys(keys))
+        if not keys:
+            return {}
+        found = {}
+        with self._lock:
+            try:
+                conn = self._connect()
+                for i in range(0, len(keys), _CHUNK):
+                    chunk = keys[i:i + _CHUNK]
+                    marks = ",".join("?" * len(chunk))
+                    for key, language, prob in conn.execute(
+                            f"SELECT key, language, prob FROM lang_cache WHERE key IN ({marks})", chunk):
+                        found[key] = (language, prob)
+                if found:
+                    now = time.time()
+                    with conn:
+                        conn.executemany("UPDATE lang_cache SET used = ? WHERE key = ?", [(now, k) for k in found])
+            except sqlite3.Error as e:
+                logging.warning("Language cache lookup failed: %s", e)
+                return {}
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, entries):
+        """
+        Store a batch of results and evict the least recently used entries above max_entries.
+
+        Args:
+            entries (dict): key -> (language, prob).
+        """
+        if not entries:
+            return
+        now = time.time()
+        with self._lock:
+            try:
+                conn = self._connect()
+                with conn:
+                    before = conn.total_changes
+                    conn.executemany(
+                        "INSERT OR IGNORE INTO lang_cache (key, language, prob, used) VALUES (?, ?, ?, ?)",
+                        [(k, language, prob, now) for k, (language, prob) in entries.items()],
+                    )
+                    self._count += conn.total_changes - before
+                    if self._count > self.max_entries:
+                        # Evict down to 90% so eviction does not run on every page
+                        excess = self._count - int(self.max_entries * 0.9)
+                        conn.execute("DELETE FROM lang_cache WHERE key IN "
+                                     "(SELECT key FROM lang_cache ORDER BY used LIMIT ?)", (excess,))
+                        self._count -= excess
+            except sqlite3.Error as e:
+                logging.warning("Language cache update failed: %s", e)
+
+    def hit_rate(self):
+        """Fraction of looked up texts found in the cache, 0.0 before any lookup."""
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def report(self):
+        """One line like 'langid cache: 1200/1900 hits (63%), 84211 entries'."""
+        return (f"langid cache: {self.hits}/{self.hits + self.misses} hits ({self.hit_rate():.0%}), "
+                f"{self._count} entries")
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
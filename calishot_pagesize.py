@@ -0,0 +1,149 @@
+"""
+Adaptive per-server page size for /ajax/search + /ajax/books paging.
+
+A fixed 1000 ids per page is too much for slow home servers, whose
+books?ids= call times out, and too little for fast ones, where every page is
+mostly round-trip latency. PageSizer starts from the size learned on the last
+run and adjusts it after every metadata request: it grows by half while full
+pages come back quickly and small enough, shrinks by a quarter when they are
+slow, and halves after a timeout or a 5xx, down to MIN_PAGE.
+
+The smallest size that failed is the server's ceiling. Growth stops an eighth
+under it, so the size settles just below a server's limit instead of hitting
+it again and again. The ceiling is kept with the size
+(server_capabilities.page_size, page_ceiling and page_ceiling_at in sites.db),
+so the next run starts under the limit without having to fail first. It is
+forgotten after CALISHOT_PAGE_CEILING_DAYS, and the server is then probed
+again. The size saved is the largest full page that came back quickly during
+the run, so a late failure or a slow page does not ratchet the next run down.
+
+Configuration (environment variables):
+    CALISHOT_PAGE_MAX             largest page size (default 4000)
+    CALISHOT_PAGE_TARGET_SECONDS  a books?ids= call faster than this may grow the page (default 8)
+    CALISHOT_PAGE_CEILING_DAYS    days a failed size is remembered (default 30)
+"""
+
+import datetime
+import os
+import threading
+
+MIN_PAGE = 50
+MAX_PAGE = int(os.getenv("CALISHOT_PAGE_MAX", "4000"))
+TARGET_SECONDS = float(os.getenv("CALISHOT_PAGE_TARGET_SECONDS", "8"))
+CEILING_DAYS = float(os.getenv("CALISHOT_PAGE_CEILING_DAYS", "30"))
+# Responses larger than this never grow the page (comments HTML can be large)
+MAX_BYTES = 32 * 1024 * 1024
+
+
+class PageSizer:
+    """
+    Current page size of one server and the rules that change it.
+
+    Args:
+        size (int): Starting size, e.g. the persisted one.
+        adaptive (bool): When False the size never changes (the old fixed paging).
+        min_size (int): Lower bound.
+        max_size (int): Upper bound.
+        ceiling (int, optional): Smallest size known to fail, e.g. the persisted one.
+        ceiling_at (str, optional): ISO time the ceiling was found.
+    """
+
+    def __init__(self, size=1000, adaptive=True, min_size=MIN_PAGE, max_size=MAX_PAGE, ceiling=None, ceiling_at=None):
+        self.adaptive = adaptive
+        self.min_size = min_size
+        self.max_size = max(min_size, max_size)
+        self.grown = 0
+        self.shrunk = 0
+        self.ceiling = ceiling if ceiling and ceiling > min_size else None
+        self.ceiling_at = ceiling_at if self.ceiling else None
+        self.size = min(self._cap(), max(self.min_size, int(size)))
+        # Largest full page that came back quickly; the size saved for the next run
+        self.best = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def learned(cls, capabilities, size, max_size=MAX_PAGE):
+        """
+        Adaptive sizer starting from a server_capabilities row (or None), else from size.
+
+        A ceiling older than CEILING_DAYS is dropped.
+        """
+        capabilities = capabilities or {}
+        ceiling, ceiling_at = capabilities.get("page_ceiling"), capabilities.get("page_ceiling_at")
+        if ceiling and ceiling_at:
+            try:
+                age = datetime.datetime.utcnow() - datetime.datetime.fromisoformat(ceiling_at)
+                if age > datetime.timedelta(days=CEILING_DAYS):
+                    ceiling = ceiling_at = None
+            except ValueError:
+                ceiling = ceiling_at = None
+        return cls(capabilities.get("page_size") or size, adaptive=True, max_size=max_size,
+                   ceiling=ceiling, ceiling_at=ceiling_at)
+
+    def state(self):
+        """The server_capabilities fields to save for the next run."""
+        with self._lock:
+            size = min(self.best or self.size, self._cap())
+            return {"page_size": size, "page_ceiling": self.ceiling, "page_ceiling_at": self.ceiling_at}
+
+    def _cap(self):
+        if self.ceiling is None:
+            return self.max_size
+        return max(self.min_size, min(self.max_size, self.ceiling - max(1, self.ceiling // 8)))
+
+    def observe(self, count, seconds, nbytes):
+        """Record a successful metadata request for count ids that took seconds and returned nbytes."""
+        if not self.adaptive:
+            return
+        with self._lock:
+            if seconds > 2 * TARGET_SECONDS:
+                self._resize(self.size * 3 // 4)
+            elif count >= self.size and seconds < TARGET_SECONDS and nbytes < MAX_BYTES / 1.5:
+                # Only full pages say anything about a bigger one
+                self.best = max(self.best or 0, count)
+                self._resize(self.size * 3 // 2)
+
+    def failed(self, count=None):
+        """
+        Record a metadata request for count ids (default: the current size) that timed out or got a 5xx.
+
+        With prefetching, the current size may already have been halved for
+        another page, so the ceiling is taken from count. Returns False when
+        count is already the minimum.
+        """
+        if not self.adaptive:
+            return False
+        with self._lock:
+            count = self.size if count is None else count
+            if count <= self.min_size:
+                return False
+            if self.ceiling is None or count < self.ceiling:
+                self.ceiling = count
+                self.ceiling_at = datetime.datetime.utcnow().isoformat()
+            if self.best is not None and self.best >= self.ceiling:
+                self.best = None
+            self._resize(min(self.size, count // 2))
+            return True
+
+    def _resize(self, size):
+        size = min(self._cap(), max(self.min_size, size))
+        if size > self.size:
+            self.grown += 1
+        elif size < self.size:
+            self.shrunk += 1
+        self.size = size
+
+    def plan(self, offset, total, first_page=None):
+        """
+        Yield (offset, count) pages from offset to total.
+
+        Each page is read from the current size when the job is taken, so a
+        prefetching consumer follows adjustments a few pages later. first_page
+        starts small (incremental passes) and doubles until it reaches the size.
+        """
+        page = first_page or self.size
+        while offset < total:
+            count = min(page, self.size, total - offset)
+            yield offset, count
+            offset += count
+            page *= 2
@@ -0,0 +1,309 @@
+"""
+Asyncio health-check engine for Calibre sites.
+
+Alternative to functions.check_calibre_list/check_calibre_site for large host
+lists: every probe request goes through one aiohttp session, bounded by a
+global concurrency limit and a per-IP limit, and the per-library counts of a
+site are fetched concurrently instead of one after another. Each probe
+produces the same result dict check_calibre_site builds, so results are saved
+exactly like the gevent engine's.
+
+aiohttp is optional; is_available() tells callers whether they have to fall
+back to the gevent engine.
+"""
+
+import asyncio
+import concurrent.futures
+import contextlib
+import datetime
+import ipaddress
+import logging
+import socket
+from urllib.parse import urlparse, quote
+
+try:
+    import aiohttp
+except ImportError:  # optional dependency, see is_available()
+    aiohttp = None
+
+# Sites with this many consecutive failures are deleted instead of probed
+MAX_FAILED_ATTEMPTS = 5
+
+
+def is_available() -> bool:
+    """Return True when aiohttp is installed and the async engine can run."""
+    return aiohttp is not None
+
+
+class HostLimiter:
+    """
+    Global and per-IP concurrency limits shared by all probe requests.
+
+    Hostnames are resolved once, on their first request, and keyed by their
+    first address, so names that point at the same server share its limit.
+    A name that cannot be resolved keeps a limit of its own; its requests fail
+    on connect anyway.
+    """
+
+    def __init__(self, concurrency: int, per_ip: int):
+        self._global = asyncio.Semaphore(concurrency)
+        self._per_ip = per_ip
+        self._ips = {}
+        self._addresses = {}
+
+    async def _address(self, host: str):
+        task = self._addresses.get(host)
+        if task is None:
+            task = self._addresses[host] = asyncio.ensure_future(self._resolve(host))
+        return await task
+
+    @staticmethod
+    async def _resolve(host: str):
+        try:
+            return str(ipaddress.ip_address(host))
+        except ValueError:
+            pass
+        try:
+            infos = await asyncio.get_running_loop().getaddrinfo(host, None, type=socket.SOCK_STREAM)
+            return infos[0][4][0]
+        except (OSError, IndexError) as e:
+            logging.info("Could not resolve %s, limiting it on its own: %s", host, e)
+            return host
+
+    @contextlib.asynccontextmanager
+    async def slot(self, host: str):
+        ip = await self._address(host)
+        sem = self._ips.get(ip)
+        if sem is None:
+            sem = self._ips[ip] = asyncio.Semaphore(self._per_ip)
+        async with sem:
+            async with self._global:
+                yield
+
+
+async def _get_json(client, limiter, url, host, connect_timeout, read_timeout=30):
+    """GET url and decode JSON, raising aiohttp.ClientResponseError on HTTP errors."""
+    timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+    async with limiter.slot(host):
+        async with client.get(url, timeout=timeout, ssl=False) as r:
+            r.raise_for_status()
+            return await r.json(content_type=None)
+
+
+def _apply_book_count(ret, site, current_book_count):
+    """Fill ret with the online/book-count fields exactly as check_calibre_site does."""
+    now = ret['last_check']
+    previous_book_count = site.get('book_count', 0) or 0
+    previous_last_book_count = site.get('last_book_count', 0) or 0
+
+    new_books = max(0, current_book_count - previous_book_count)
+    last_book_count = previous_book_count if previous_book_count > 0 else 0
+    if previous_book_count == 0 and previous_last_book_count == 0:
+        # First time seeing this site, initialize counts
+        new_books = 0
+        last_book_count = current_book_count
+
+    ret.update({
+        'book_count': current_book_count,
+        'last_book_count': last_book_count,
+        'new_books': new_books,
+        'status': 'online',
+        'last_online': now,
+        'last_success': now,
+        'error': None,
+        'error_message': None
+    })
+    if ret['failed_attempts'] > 0:
+        ret['failed_attempts'] = 0
+
+
+async def probe_site(client, limiter, site, timeout=15):
+    """
+    Probe one site: total count, library list and per-library counts.
+
+    Args:
+        client (aiohttp.ClientSession): Shared HTTP client.
+        limiter (HostLimiter): Concurrency limits.
+        site (dict): Row from the sites table.
+        timeout (int): Connect timeout in seconds.
+
+    Returns:
+        tuple: (result, library_counts). result is the check_calibre_site dict,
+        or None when the site has reached MAX_FAILED_ATTEMPTS and must be deleted.
+        library_counts maps library name to its book count.
+    """
+    now = str(datetime.datetime.now())
+    failed_attempts = site.get('failed_attempts', 0) or 0
+    ret = {
+        'uuid': site.get('uuid'),
+        'last_check': now,
+        'status': 'unknown',
+        'last_online': site.get('last_online'),
+        'last_success': site.get('last_success'),
+        'error': None,
+        'error_message': None,
+        'failed_attempts': failed_attempts
+    }
+    library_counts = {}
+
+    if failed_attempts >= MAX_FAILED_ATTEMPTS:
+        return None, library_counts
+
+    url_value = site.get('url')
+    if not isinstance(url_value, str) or not url_value.strip():
+        error_msg = f"Invalid site url: {url_value!r}"
+        ret.update({
+            'status': 'error',
+            'error': error_msg,
+            'failed_attempts': failed_attempts + 1,
+            'last_failed': now,
+            'error_message': error_msg
+        })
+        return ret, library_counts
+
+    api = url_value.rstrip('/') + '/ajax/'
+    host = urlparse(url_value).hostname or url_value
+
+    try:
+        data = await _get_json(client, limiter, api + 'search?num=0', host, timeout)
+    except aiohttp.ClientResponseError as e:
+        ret.update({
+            'error': f"HTTP error {e.status}",
+            'status': 'unauthorized' if e.status == 401 else 'down',
+            'failed_attempts': failed_attempts + 1,
+            'last_failed': now,
+            'error_message': str(e)
+        })
+        return ret, library_counts
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        ret.update({
+            'status': 'down',
+            'error': f"Request failed: {str(e) or type(e).__name__}",
+            'failed_attempts': failed_attempts + 1,
+            'last_failed': now,
+            'error_message': str(e)
+        })
+        return ret, library_counts
+    except Exception as e:
+        ret.update({
+            'status': 'error',
+            'error': f"Unexpected error: {str(e)}",
+            'failed_attempts': failed_attempts + 1,
+            'last_failed': now,
+            'error_message': str(e)
+        })
+        return ret, library_counts
+
+    try:
+        _apply_book_count(ret, site, int(data["total_num"]))
+    except Exception as e:
+        ret.update({
+            'book_count': 0,
+            'libraries_count': 0,
+            'status': 'error',
+            'error': f"Error processing response from {url_value}: {str(e)}",
+            'failed_attempts': failed_attempts + 1,
+            'last_failed': now,
+            'error_message': str(e)
+        })
+        return ret, library_counts
+
+    # Library list; like get_libs_from_site, any failure means "no libraries"
+    try:
+        info = await _get_json(client, limiter, api + 'library-info', host, 30)
+        libraries = list((info.get("library_map") or {}).keys())
+        if not libraries and isinstance(info.get("libraries"), list):
+            libraries = info.get("libraries")
+    except Exception as e:
+        logging.info("library-info failed for %s: %s", url_value, e)
+        libraries = []
+    ret['libraries_count'] = len(libraries)
+
+    async def count_library(library):
+        lib_data = await _get_json(client, limiter, f"{api}search/{quote(str(library))}?num=0", host, timeout)
+        return int(lib_data.get("total_num", 0))
+
+    wanted = [library for library in libraries if library]
+    counts = await asyncio.gather(*(count_library(l) for l in wanted), return_exceptions=True)
+    for library, count in zip(wanted, counts):
+        if isinstance(count, BaseException):
+            logging.warning("Error getting book count for library '%s' at %s: %s", library, url_value, count)
+            continue
+        library_counts[library] = count
+
+    if len(libraries) > 1:
+        ret['book_count'] = sum(library_counts.values())
+    elif library_counts:
+        ret['book_count'] = next(iter(library_counts.values()))
+
+    if not libraries:
+        ret.update({
+            'status': 'unknown',
+            'book_count': 0,
+            'error': None,
+            'error_message': None
+        })
+    return ret, library_counts
+
+
+async def probe_sites(sites, on_result=None, concurrency=500, per_ip=4, timeout=15):
+    """
+    Probe many sites concurrently.
+
+    Args:
+        sites (iterable[dict]): Rows from the sites table.
+        on_result (callable, optional): Called as on_result(site, result, library_counts)
+            as soon as each site finishes. Runs in one thread of its own, one call at a
+            time, so it may block (e.g. on sqlite) without holding up the probes.
+        concurrency (int): Maximum number of requests in flight overall.
+        per_ip (int): Maximum number of requests in flight per IP address.
+        timeout (int): Connect timeout in seconds.
+
+    Returns:
+        int: Number of sites probed.
+    """
+    limiter = HostLimiter(concurrency, per_ip)
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+    done = 0
+    loop = asyncio.get_running_loop()
+    results = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="probe-results")
+
+    connector = aiohttp.TCPConnector(limit=concurrency, limit_per_host=per_ip, ssl=False)
+    with results:
+        async with aiohttp.ClientSession(connector=connector) as client:
+
+            async def worker():
+                nonlocal done
+                while True:
+                    site = await queue.get()
+                    try:
+                        if site is None:
+                            return
+                        try:
+                            ret, library_counts = await probe_site(client, limiter, site, timeout=timeout)
+                        except Exception as e:
+                            logging.error("Probe crashed for %s: %s", site.get('url'), e, exc_info=True)
+                            continue
+                        done += 1
+                        if on_result:
+                            try:
+                                await loop.run_in_executor(results, on_result, site, ret, library_counts)
+                            except Exception as e:
+                                logging.error("Saving the result for %s failed: %s", site.get('url'), e, exc_info=True)
+                    finally:
+                        queue.task_done()
+
+            workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+            for site in sites:
+                await queue.put(dict(site))
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+    return done
+
+
+def run_probe(sites, on_result=None, concurrency=500, per_ip=4, timeout=15):
+    """Synchronous entry point for probe_sites(); see there for the arguments."""
+    if not is_available():
+        raise RuntimeError("aiohttp is not installed; the async engine is unavailable")
+    return asyncio.run(probe_sites(sites, on_result=on_result, concurrency=concurrency, per_ip=per_ip, timeout=timeout))
@@ -0,0 +1,115 @@
+"""
+A pool of worker processes that run one function, on concurrent.futures.ProcessPoolExecutor.
+
+Workers are started with the forkserver method where the platform has it and
+spawn elsewhere (Windows), never with a bare fork: a forked worker would
+inherit the parent's open sqlite connections (functions.site_conn) and its
+gevent hub. A fresh worker imports the module of the function, so the function
+must be a top-level one of a module that does not import functions.
+
+Under gevent, threading is patched and the executor's feeder thread is a
+greenlet whose blocking pipe writes stop the hub. With large arguments on the
+way to a worker and a large result on the way back, both pipes fill and the
+process deadlocks. The arguments of every call are therefore pickled to a
+file in a temporary directory, and the worker is only sent its name. Results
+come back through the executor, which the hub keeps reading.
+
+An exception raised by the function in a worker is raised by call(), with
+the worker's traceback as its cause. A worker that dies breaks the executor:
+call() raises BrokenProcessPool and the next call starts a new one. Nothing is
+run again in the calling process.
+"""
+
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+
+
+def _context():
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+
+def _run(func, path):
+    """Body of a worker call: read the arguments from path, delete it, return func(*args)."""
+    with open(path, "rb") as f:
+        args = pickle.load(f)
+    os.remove(path)
+    return func(*args)
+
+
+class ProcessPool:
+    """
+    Runs func(*args) on worker processes started on first use.
+
+    Calls are made from threads (greenlets under gevent); the caller waits for
+    its result without holding the others up.
+
+    Args:
+        func (callable): A top-level function, run by every worker.
+        workers (int): Worker processes; 0 runs every call inline.
+        init (callable, optional): Top-level function run once in each worker, e.g. to load a model.
+        name (str): Used in log messages.
+    """
+
+    def __init__(self, func, workers=0, init=None, name="worker"):
+        self.func = func
+        self.init = init
+        self.name = name
+        self.workers = max(0, workers)
+        self._executor = None
+        self._folder = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self._executor is None:
+                if self._folder is None:
+                    self._folder = tempfile.mkdtemp(prefix="calishot-pool-")
+                self._executor = concurrent.futures.ProcessPoolExecutor(
+                    self.workers, mp_context=_context(), initializer=self.init)
+            return self._executor, self._folder
+
+    def call(self, *args):
+        """
+        Return func(*args), computed by a worker; blocks (yields under gevent) until it is done.
+
+        Raises:
+            Exception: What func raised in the worker.
+            concurrent.futures.process.BrokenProcessPool: A worker died.
+        """
+        if self.workers <= 0:
+            return self.func(*args)
+        executor, folder = self._start()
+        fd, path = tempfile.mkstemp(dir=folder, suffix=".args")
+        with open(fd, "wb") as f:
+            pickle.dump(args, f, protocol=pickle.HIGHEST_PROTOCOL)
+        try:
+            return executor.submit(_run, self.func, path).result()
+        except concurrent.futures.process.BrokenProcessPool as e:
+            logging.error("%s process died: %s", self.name, e)
+            with self._lock:
+                if self._executor is executor:
+                    self._executor = None
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        finally:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def close(self):
+        """Stop the workers and remove the argument files. The pool starts new workers if called again."""
+        with self._lock:
+            executor, self._executor = self._executor, None
+            folder, self._folder = self._folder, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+        if folder is not None:
+            shutil.rmtree(folder, ignore_errors=True)
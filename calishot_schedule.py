@@ -0,0 +1,142 @@
+"""
+Due-time scheduling of site health checks.
+
+check_calibre_list used to re-probe every row of sites on every run, including
+hosts that were checked minutes ago and hosts that have failed four times in a
+row. Each site now gets a next_check_at computed from its history:
+
+- never checked: due immediately
+- failing: last_failed + FAILURE_BASE * 2 ** (failed_attempts - 1), capped at FAILURE_MAX
+- healthy: last_success + an interval between HEALTHY_MIN and HEALTHY_MAX,
+  shorter the more often book_count has been changing (change_rate)
+
+change_rate is an exponential moving average (0..1) of "book_count changed on
+this check", stored in sites next to next_check_at. due_sites() recomputes the
+due time of every site, pushes it onto a priority queue and hands the engine
+only the sites that are due, most overdue first.
+
+Intervals (hours) can be tuned with CALISHOT_CHECK_HEALTHY_MIN,
+CALISHOT_CHECK_HEALTHY_MAX, CALISHOT_CHECK_FAILURE_BASE and
+CALISHOT_CHECK_FAILURE_MAX.
+"""
+
+import datetime
+import heapq
+import logging
+import os
+import sqlite3
+
+HEALTHY_MIN = datetime.timedelta(hours=float(os.getenv("CALISHOT_CHECK_HEALTHY_MIN", "6")))
+HEALTHY_MAX = datetime.timedelta(hours=float(os.getenv("CALISHOT_CHECK_HEALTHY_MAX", "24")))
+FAILURE_BASE = datetime.timedelta(hours=float(os.getenv("CALISHOT_CHECK_FAILURE_BASE", "1")))
+FAILURE_MAX = datetime.timedelta(hours=float(os.getenv("CALISHOT_CHECK_FAILURE_MAX", "48")))
+
+# Weight of the latest observation in the change_rate moving average
+CHANGE_RATE_ALPHA = 0.5
+
+SCHEDULE_COLUMNS = (("next_check_at", "TEXT"), ("change_rate", "REAL"))
+
+
+def parse_time(value):
+    """Parse a timestamp as stored in sites (str(datetime) or isoformat). Returns None if unusable."""
+    if not value:
+        return None
+    if isinstance(value, datetime.datetime):
+        return value
+    try:
+        return datetime.datetime.fromisoformat(str(value).strip().replace("Z", ""))
+    except ValueError:
+        return None
+
+
+def next_check_at(site, now=None):
+    """
+    Compute when a site should be probed next.
+
+    Args:
+        site (dict): Row from the sites table (or a probe result merged over one).
+        now (datetime, optional): Reference time for sites without usable history.
+
+    Returns:
+        datetime: The due time; sites that were never checked are due at now.
+    """
+    now = now or datetime.datetime.now()
+    failed_attempts = int(site.get("failed_attempts") or 0)
+
+    if failed_attempts > 0:
+        base = parse_time(site.get("last_failed")) or parse_time(site.get("last_check"))
+        if base is None:
+            return now
+        backoff = FAILURE_BASE * (2 ** (failed_attempts - 1))
+        return base + min(backoff, FAILURE_MAX)
+
+    base = parse_time(site.get("last_success")) or parse_time(site.get("last_check"))
+    if base is None:
+        return now
+    rate = min(1.0, max(0.0, float(site.get("change_rate") or 0.0)))
+    return base + HEALTHY_MAX - (HEALTHY_MAX - HEALTHY_MIN) * rate
+
+
+def update_schedule(site, result):
+    """
+    Add change_rate and next_check_at to a probe result before it is saved.
+
+    Args:
+        site (dict): The sites row as it was before the probe.
+        result (dict): The result of check_calibre_site / calishot_probe.probe_site.
+
+    Returns:
+        dict: result, updated in place.
+    """
+    rate = float(site.get("change_rate") or 0.0)
+    if result.get("status") == "online":
+        changed = (result.get("book_count") or 0) != (site.get("book_count") or 0)
+        rate = (1 - CHANGE_RATE_ALPHA) * rate + CHANGE_RATE_ALPHA * (1.0 if changed else 0.0)
+    merged = dict(site)
+    merged.update(result)
+    merged["change_rate"] = rate
+    result["change_rate"] = round(rate, 4)
+    result["next_check_at"] = next_check_at(merged).isoformat(sep=" ")
+    return result
+
+
+def due_sites(sites, now=None):
+    """
+    Select the sites that are due for a check, most overdue first.
+
+    Args:
+        sites (iterable[dict]): Rows from the sites table.
+        now (datetime, optional): Defaults to datetime.now().
+
+    Returns:
+        tuple: (due, skipped) where due is a list of site dicts in priority order
+        and skipped is the number of sites not due yet.
+    """
+    now = now or datetime.datetime.now()
+    heap = []
+    for i, site in enumerate(sites):
+        site = dict(site)
+        due_at = next_check_at(site, now)
+        # i breaks ties so dicts are never compared
+        heapq.heappush(heap, (due_at, i, site))
+
+    due = []
+    while heap and heap[0][0] <= now:
+        due.append(heapq.heappop(heap)[2])
+    logging.info("Scheduler: %s sites due, %s not due yet", len(due), len(heap))
+    return due, len(heap)
+
+
+def ensure_columns(db_path):
+    """Add the next_check_at and change_rate columns to sites if they are missing."""
+    conn = sqlite3.connect(str(db_path))
+    try:
+        existing = {row[1] for row in conn.execute("PRAGMA table_info(sites)")}
+        if not existing:
+            return
+        for column, col_type in SCHEDULE_COLUMNS:
+            if column not in existing:
+                conn.execute(f"ALTER TABLE sites ADD COLUMN {column} {col_type}")
+        conn.commit()
+    finally:
+        conn.close()
@@ -0,0 +1,79 @@
+"""
+Links to a book on its Calibre server.
+
+build_index needs three kinds of URL per book: the description page, the cover
+thumbnail and one download link per format. They only depend on the site's
+base URL and Calibre major version, which used to be re-read from the site
+table (and its urls JSON decoded) for every URL of every book. SiteContext
+holds them, resolved once per site database, and the builders below are pure
+functions of a context and a book row.
+
+index.db stores templates() per site instead of the URLs of every book; its
+summary view fills in the placeholders when it is read (calishot_indexlayout).
+"""
+
+import json
+import urllib.parse
+from collections import namedtuple
+
+SiteContext = namedtuple("SiteContext", "url major")
+
+
+def context(url, major):
+    """Context of a site served at url by Calibre major version major."""
+    return SiteContext(url, major or 0)
+
+
+def host_port(url):
+    """
+    (host, port) of a server URL, the port defaulting to the scheme's.
+
+    Returns:
+        tuple: (lower-case host name or None, port or None).
+    """
+    try:
+        parts = urllib.parse.urlparse(url or "")
+        port = parts.port or {"http": 80, "https": 443}.get(parts.scheme)
+    except ValueError:
+        return None, None
+    return parts.hostname, port
+
+
+def from_site_db(db):
+    """Context of the site described by the 'site' table of a site database."""
+    site = list(db["site"].rows)[0]
+    return context(json.loads(site["urls"])[0], site["major"])
+
+
+def desc_url(ctx, book):
+    """Description page of book (a row with 'id' and 'library')."""
+    if ctx.major >= 3:
+        return f"{ctx.url}#book_id={book['id']}&library_id={book['library']}&panel=book_details"
+    return f"{ctx.url}/browse/book/{book['id']}"
+
+
+def img_url(ctx, book):
+    """Cover thumbnail of book."""
+    if ctx.major >= 3:
+        return f"{ctx.url}/get/thumb/{book['id']}/{book['library']}?sz=600x800"
+    return f"{ctx.url}/get/thumb_90_120/{book['id']}"
+
+
+def format_url(ctx, book, fmt):
+    """Download link of book in format fmt."""
+    return f"{ctx.url}/get/{fmt}/{book['id']}/{book['library']}"
+
+
+def templates(ctx):
+    """
+    The three URLs of a site with {id}, {library} and {format} placeholders.
+
+    Returns:
+        dict: desc_template, img_template and format_template.
+    """
+    book = {"id": "{id}", "library": "{library}"}
+    return {
+        "desc_template": desc_url(ctx, book),
+        "img_template": img_url(ctx, book),
+        "format_template": format_url(ctx, book, "{format}"),
+    }
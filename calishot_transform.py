@@ -0,0 +1,279 @@
+"""
+Process-pool transform stage: raw /ajax/books records -> ebooks rows.
+
+Turning a book into a row means unidecode over the title, authors, tags and
+series and, when the server gives no language, langid over the comments. That
+is pure CPU work, and running it inside the indexing greenlets serialises it
+on the GIL across every site being crawled. TransformStage sends batches of
+records to a pool of worker processes instead; the greenlet waiting for a
+batch yields, so the other sites keep downloading in the meantime.
+
+The langid model is loaded the first time a process needs it (once per worker,
+right after it starts), not when this module is imported.
+
+Configuration (environment variables):
+    CALISHOT_TRANSFORM_WORKERS  worker processes, 0 transforms inline (default: CPUs - 1)
+    CALISHOT_TRANSFORM_BATCH    records per batch sent to a worker (default 100)
+    CALISHOT_LANGID_CACHE_SIZE  entries of the langid cache, data/langid_cache.db (calishot_langcache);
+                                0 disables it (default 500000)
+
+The cache is created the first time a stage transforms books, so importing
+this module (or functions) touches nothing on disk.
+"""
+
+import concurrent.futures
+import os
+import threading
+import time
+
+import iso639
+import unidecode
+
+import calishot_procpool
+from calishot_langcache import LanguageCache, text_key
+
+CACHE_SIZE = int(os.getenv("CALISHOT_LANGID_CACHE_SIZE", "500000"))
+# Relative to the working directory when first used, like functions.data_dir
+CACHE_PATH = os.path.join(".", "data", "langid_cache.db")
+
+# Minimum langid probability for a detected language to be kept
+MIN_LANGUAGE_PROB = 0.85
+
+_identifier = None
+
+
+def _load_identifier():
+    """Return the langid identifier of this process, loading the model on first use."""
+    global _identifier
+    if _identifier is None:
+        from langid.langid import LanguageIdentifier, model
+        _identifier = LanguageIdentifier.from_modelstring(model, norm_probs=True)
+    return _identifier
+
+
+def classify(text):
+    """Return (language, probability) for text, as langid's classify."""
+    return _load_identifier().classify(text)
+
+
+def _init_worker():
+    _load_identifier()
+
+
+def detection_text(r_book):
+    """Text langid is run on for r_book, or None when the server gave its language."""
+    if r_book['languages']:
+        return None
+    return r_book['comments'] or r_book['title'] + ". "
+
+
+def detect_language(text):
+    """Return (ISO 639-2 code, probability) for text."""
+    s_language, prob = classify(text)
+    return iso639.to_iso639_2(s_language), prob
+
+
+def book_from_calibre(id, r_book, lib, detected=None):
+    """
+    Converts one /ajax/books record into an ebooks row.
+
+    Parameters:
+        id (str): The Calibre book id.
+        r_book (dict): The book as returned by /ajax/books.
+        lib (str): Library name stored with the book.
+        detected (tuple, optional): (language, prob) already known for the book's text,
+            e.g. from the language cache; langid is only run when this is None.
+
+    Returns:
+        dict: The row for the ebooks table, or None if the book has no uuid or no formats.
+    """
+    if not r_book['uuid'] or not r_book['formats']:
+        return None
+
+    book = {}
+    book['uuid'] = r_book['uuid']
+    book['id'] = id
+    book['library'] = lib
+
+    book['title'] = unidecode.unidecode(r_book['title'])
+
+    if r_book['authors']:
+        book['authors'] = [unidecode.unidecode(s) for s in r_book['authors']]
+
+    book['desc'] = r_book['comments']
+
+    if r_book['series']:
+        book['series'] = unidecode.unidecode(r_book['series'])
+    s_i = r_book['series_index']
+    if s_i:
+        book['series_index'] = int(s_i)
+
+    book['identifiers'] = r_book['identifiers']
+
+    if r_book['tags']:
+        book['tags'] = [unidecode.unidecode(s) for s in r_book['tags']]
+
+    book['publisher'] = r_book['publisher']
+
+    book['pubdate'] = r_book['pubdate']
+
+    if not r_book['languages']:
+        language, prob = detected or detect_language(detection_text(r_book))
+        if prob >= MIN_LANGUAGE_PROB:
+            book['language'] = language
+        else:
+            book['language'] = ''
+    else:
+        book['language'] = iso639.to_iso639_2(r_book['languages'][0])
+
+    if r_book['cover']:
+        book['cover'] = True
+    else:
+        book['cover'] = False
+
+    book['last_modified'] = r_book['last_modified']
+    book['timestamp'] = r_book['timestamp']
+
+    book['formats'] = []
+    for f in r_book['formats']:
+        size = None
+        if 'size' in r_book['format_metadata'].get(f, {}):
+            size = int(r_book['format_metadata'][f]['size'])
+        book[f] = size
+        book['formats'].append(f)
+    return book
+
+
+def transform_batch(items, lib, known=None):
+    """
+    Rows for a list of (id, r_book) pairs; records without uuid or formats are dropped.
+
+    Args:
+        items (list): (id, r_book) pairs from /ajax/books.
+        lib (str): Library name stored with each book.
+        known (dict, optional): text_key() -> (language, prob) from the language cache.
+            None disables the cache lookups.
+
+    Returns:
+        tuple: (rows, detected) where detected holds the languages langid had to
+        compute, by text_key(), for the caller to add to the cache.
+    """
+    rows = []
+    detected = {}
+    for id, r_book in items:
+        if not r_book['uuid'] or not r_book['formats']:
+            continue
+        result = None
+        text = detection_text(r_book) if known is not None else None
+        if text is not None:
+            key = text_key(text)
+            result = known.get(key) or detected.get(key)
+            if result is None:
+                result = detected[key] = detect_language(text)
+        rows.append(book_from_calibre(id, r_book, lib, detected=result))
+    return rows, detected
+
+
+class TransformStage:
+    """
+    Runs transform_batch on worker processes started on first use and counts throughput.
+
+    Batches go to a calishot_procpool.ProcessPool, dispatched by a thread pool
+    (greenlets under gevent) so a page's batches run on every worker at once.
+
+    Args:
+        workers (int): Worker processes; 0 transforms inline.
+        batch_size (int): Records per batch sent to a worker.
+        cache (LanguageCache, optional): Consulted, one query per run() call, before langid.
+        cache_path (str, optional): File of the LanguageCache created on the first run() when cache is None.
+        cache_size (int): Its max_entries; 0 creates none.
+    """
+
+    def __init__(self, workers=0, batch_size=100, cache=None, cache_path=None, cache_size=0):
+        self._pool = calishot_procpool.ProcessPool(transform_batch, workers, init=_init_worker, name="Transform")
+        self.workers = self._pool.workers
+        self.batch_size = max(1, batch_size)
+        self.cache = cache
+        self.cache_path = cache_path
+        self.cache_size = cache_size
+        self.books = 0
+        self.rows = 0
+        self.batches = 0
+        self.seconds = 0.0
+        self._dispatch = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self._dispatch is None and self.workers > 0:
+                self._dispatch = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers,
+                                                                       thread_name_prefix="transform")
+            return self._dispatch
+
+    def _language_cache(self):
+        with self._lock:
+            if self.cache is None and self.cache_path and self.cache_size > 0:
+                self.cache = LanguageCache(self.cache_path, max_entries=self.cache_size)
+            return self.cache
+
+    def run(self, items, lib):
+        """
+        Transform (id, r_book) pairs into ebooks rows, in order.
+
+        Args:
+            items (list): (id, r_book) pairs from /ajax/books.
+            lib (str): Library name stored with each book.
+
+        Returns:
+            list[dict]: The rows, ready for save_books_metadata_from_site.
+        """
+        items = list(items)
+        start = time.perf_counter()
+        batches = [items[i:i + self.batch_size] for i in range(0, len(items), self.batch_size)]
+        known = None
+        cache = self._language_cache()
+        if cache is not None:
+            texts = (detection_text(r_book) for _, r_book in items)
+            known = cache.get_many(text_key(t) for t in texts if t is not None)
+        dispatch = self._start()
+        if dispatch is None:
+            results = [transform_batch(batch, lib, known) for batch in batches]
+        else:
+            results = list(dispatch.map(self._pool.call, batches, [lib] * len(batches), [known] * len(batches)))
+        rows = []
+        detected = {}
+        for batch_rows, batch_detected in results:
+            rows.extend(batch_rows)
+            detected.update(batch_detected)
+        if cache is not None:
+            cache.put_many(detected)
+        with self._lock:
+            self.books += len(items)
+            self.rows += len(rows)
+            self.batches += len(batches)
+            self.seconds += time.perf_counter() - start
+        return rows
+
+    def report(self):
+        """One line like 'transform: 12000 books -> 11950 rows in 120 batches, 3.10s (3871 books/s, 3 workers)'."""
+        rate = self.books / self.seconds if self.seconds else 0.0
+        line = (f"transform: {self.books} books -> {self.rows} rows in {self.batches} batches, "
+                f"{self.seconds:.2f}s ({rate:.0f} books/s, {self.workers} workers)")
+        if self.cache is not None:
+            line += "; " + self.cache.report()
+        return line
+
+    def close(self):
+        with self._lock:
+            dispatch, self._dispatch = self._dispatch, None
+        if dispatch is not None:
+            dispatch.shutdown(wait=True)
+        self._pool.close()
+
+
+stage = TransformStage(
+    workers=int(os.getenv("CALISHOT_TRANSFORM_WORKERS", str(max(0, (os.cpu_count() or 1) - 1)))),
+    batch_size=int(os.getenv("CALISHOT_TRANSFORM_BATCH", "100")),
+    cache_path=CACHE_PATH,
+    cache_size=CACHE_SIZE,
+)
@@ -0,0 +1,256 @@
+"""
+Single-writer sink for sites.db.
+
+During a health check every probe used to open its own sqlite handle and
+commit row by row (save_site, upsert_library_count, the libraries_count update
+in get_libs_from_site). SitesWriter owns the only write connection instead:
+probes put results on a bounded queue and one background thread applies them
+in batched transactions, flushed when either the row count or the time window
+is reached, and always on close().
+
+Works the same whether threads are real OS threads or gevent greenlets.
+"""
+
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+import calishot_capabilities
+
+_STOP = object()
+
+LIBRARIES_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS libraries_per_server (
+        url TEXT NOT NULL,
+        library TEXT NOT NULL,
+        book_count_per_library INTEGER DEFAULT 0,
+        last_book_count_per_library INTEGER DEFAULT 0,
+        new_books_per_library INTEGER DEFAULT 0,
+        last_updated TEXT,
+        PRIMARY KEY (url, library)
+    )
+"""
+
+
+def upsert_library(conn, url, library, count):
+    """
+    Record the book count of one library in libraries_per_server, keeping the previous one.
+
+    The caller commits; used by SitesWriter and by functions.upsert_library_count.
+
+    Args:
+        conn (sqlite3.Connection): sites.db.
+        url (str): Server base URL.
+        library (str): Library name.
+        count (int): Its current book count (None counts as 0).
+
+    Returns:
+        tuple: (previous count, current count, new books).
+    """
+    row = conn.execute(
+        "SELECT book_count_per_library FROM libraries_per_server WHERE url = ? AND library = ?",
+        (url, library),
+    ).fetchone()
+    prev = int(row[0]) if row and row[0] is not None else 0
+    current = int(count) if count is not None else 0
+    new_books = max(0, current - prev)
+    conn.execute(
+        """
+        INSERT INTO libraries_per_server (
+            url, library, book_count_per_library, last_book_count_per_library, new_books_per_library, last_updated
+        ) VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(url, library) DO UPDATE SET
+            last_book_count_per_library = excluded.last_book_count_per_library,
+            book_count_per_library = excluded.book_count_per_library,
+            new_books_per_library = excluded.new_books_per_library,
+            last_updated = excluded.last_updated
+        """,
+        (url, library, current, prev, new_books, datetime.utcnow().isoformat()),
+    )
+    return prev, current, new_books
+
+
+class SitesWriter:
+    """
+    Batched writer for the sites, libraries_per_server and server_capabilities tables.
+
+    Args:
+        db_path (str | Path): Path to sites.db.
+        max_queue (int): Queue capacity; producers block when it is full.
+        batch_rows (int): Commit once this many operations are pending.
+        batch_seconds (float): Commit at least this often while operations are pending.
+    """
+
+    def __init__(self, db_path, max_queue=2000, batch_rows=500, batch_seconds=2.0):
+        self.db_path = str(db_path)
+        self.batch_rows = batch_rows
+        self.batch_seconds = batch_seconds
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._columns = None
+        self._metrics = {
+            "queued": 0,
+            "written": 0,
+            "failed": 0,
+            "commits": 0,
+            "max_queue_depth": 0,
+            "commit_seconds_total": 0.0,
+            "commit_seconds_max": 0.0,
+        }
+
+    # -- producer side -------------------------------------------------
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="sites-writer", daemon=True)
+            self._thread.start()
+        return self
+
+    def save_site(self, site):
+        """Queue an upsert of a sites row keyed by uuid (same effect as functions.save_site)."""
+        self._put(("site", dict(site)))
+
+    def upsert_library_count(self, url, library, count):
+        """Queue a per-library count update (same effect as functions.upsert_library_count)."""
+        self._put(("library", (url, library, count)))
+
+    def delete_site(self, uuid):
+        """Queue deletion of a sites row."""
+        self._put(("delete", uuid))
+
+    def save_capabilities(self, server, fields):
+        """Queue an update of a server_capabilities row (see calishot_capabilities.CapabilityCache.put)."""
+        self._put(("capabilities", (server, dict(fields))))
+
+    def _put(self, item):
+        if self._thread is None:
+            self.start()
+        self._queue.put(item)
+        self._metrics["queued"] += 1
+        depth = self._queue.qsize()
+        if depth > self._metrics["max_queue_depth"]:
+            self._metrics["max_queue_depth"] = depth
+
+    def close(self):
+        """Flush everything still queued, stop the writer thread and log the metrics."""
+        if self._thread is not None:
+            self._queue.put(_STOP)
+            self._thread.join()
+            self._thread = None
+        m = self.stats()
+        logging.info(
+            "SitesWriter closed: %s/%s operations written (%s failed) in %s commits; "
+            "max queue depth %s; commit latency avg %.1f ms, max %.1f ms",
+            m["written"], m["queued"], m["failed"], m["commits"], m["max_queue_depth"],
+            m["commit_ms_avg"], m["commit_ms_max"],
+        )
+
+    def stats(self):
+        """Return a snapshot of queue-depth and commit-latency metrics."""
+        m = dict(self._metrics)
+        m["queue_depth"] = self._queue.qsize()
+        m["commit_ms_avg"] = (m["commit_seconds_total"] / m["commits"] * 1000) if m["commits"] else 0.0
+        m["commit_ms_max"] = m["commit_seconds_max"] * 1000
+        return m
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    # -- writer side ---------------------------------------------------
+
+    def _run(self):
+        conn = sqlite3.connect(self.db_path, timeout=60)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+        except sqlite3.Error as e:
+            logging.warning("SitesWriter could not enable WAL on %s: %s", self.db_path, e)
+        self._ensure_tables(conn)
+
+        batch = []
+        deadline = None
+        try:
+            while True:
+                timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    item = None
+                if item is _STOP:
+                    break
+                if item is not None:
+                    batch.append(item)
+                    if deadline is None:
+                        deadline = time.monotonic() + self.batch_seconds
+                if batch and (len(batch) >= self.batch_rows or time.monotonic() >= deadline):
+                    self._commit(conn, batch)
+                    batch = []
+                    deadline = None
+            if batch:
+                self._commit(conn, batch)
+        finally:
+            conn.close()
+
+    def _ensure_tables(self, conn):
+        conn.execute(LIBRARIES_TABLE_SQL)
+        calishot_capabilities.ensure_table(conn)
+        conn.commit()
+        self._columns = {row[1] for row in conn.execute("PRAGMA table_info(sites)")}
+
+    def _commit(self, conn, batch):
+        start = time.perf_counter()
+        try:
+            with conn:
+                for item in batch:
+                    self._apply(conn, item)
+            self._metrics["written"] += len(batch)
+        except sqlite3.Error as e:
+            # Replay one by one so a single bad row does not drop the whole batch
+            logging.warning("SitesWriter batch of %s failed (%s); retrying row by row", len(batch), e)
+            for item in batch:
+                try:
+                    with conn:
+                        self._apply(conn, item)
+                    self._metrics["written"] += 1
+                except sqlite3.Error as row_err:
+                    self._metrics["failed"] += 1
+                    logging.error("SitesWriter dropped %s: %s", item, row_err)
+        elapsed = time.perf_counter() - start
+        self._metrics["commits"] += 1
+        self._metrics["commit_seconds_total"] += elapsed
+        self._metrics["commit_seconds_max"] = max(self._metrics["commit_seconds_max"], elapsed)
+        logging.debug("SitesWriter committed %s operations in %.1f ms (queue depth %s)",
+                      len(batch), elapsed * 1000, self._queue.qsize())
+
+    def _apply(self, conn, item):
+        kind, payload = item
+        if kind == "site":
+            self._upsert_site(conn, payload)
+        elif kind == "library":
+            upsert_library(conn, *payload)
+        elif kind == "delete":
+            conn.execute("DELETE FROM sites WHERE uuid = ?", (payload,))
+        elif kind == "capabilities":
+            calishot_capabilities.upsert(conn, *payload)
+
+    def _upsert_site(self, conn, site):
+        for col, value in site.items():
+            if col not in self._columns:
+                col_type = "INTEGER" if isinstance(value, (int, bool)) else "REAL" if isinstance(value, float) else "TEXT"
+                conn.execute(f'ALTER TABLE sites ADD COLUMN "{col}" {col_type}')
+                self._columns.add(col)
+        cols = list(site.keys())
+        values = [json.dumps(v) if isinstance(v, (list, dict)) else v for v in site.values()]
+        placeholders = ", ".join("?" for _ in cols)
+        updates = ", ".join(f'"{c}" = excluded."{c}"' for c in cols if c != "uuid")
+        col_list = ", ".join(f'"{c}"' for c in cols)
+        sql = f"INSERT INTO sites ({col_list}) VALUES ({placeholders})"
+        sql += f" ON CONFLICT(uuid) DO UPDATE SET {updates}" if updates else " ON CONFLICT(uuid) DO NOTHING"
+        conn.execute(sql, values)
@@ -9,6 +9,9 @@ from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
 import re
 import calishot_logging
+import calishot_http
+import calishot_indexlayout
+import calishot_siteurls
 
 # --- Build Info ---
 VERSION = "1.0.0"
@@ -32,12 +35,24 @@ def get_sites_db_conn():
     return sqlite3.connect(SITES_DB_PATH, timeout=30, check_same_thread=False)
 
 def get_index_db_conn():
-    conn = sqlite3.connect(INDEX_DB_PATH, timeout=30, check_same_thread=False)
-    try:
-        conn.execute('PRAGMA journal_mode=WAL;')
-    except Exception:
-        pass
-    return conn
+    # No WAL: a shadow build replaces index.db, and -wal/-shm files would outlive it (see calishot_indexswap)
+    return sqlite3.connect(INDEX_DB_PATH, timeout=30, check_same_thread=False)
+
+def write_index_db(sql, params):
+    """Run one write on index.db, again on a new connection if a shadow build replaced the file meanwhile."""
+    for attempt in (1, 2):
+        conn = get_index_db_conn()
+        try:
+            conn.execute(sql, params)
+            conn.commit()
+            return
+        except sqlite3.OperationalError as e:
+            # SQLITE_READONLY_DBMOVED: the connection still has the previous index.db
+            if attempt == 2 or getattr(e, "sqlite_errorcode", None) != getattr(sqlite3, "SQLITE_READONLY_DBMOVED", 1032):
+                raise
+            logging.debug("index.db was replaced, writing again: %s", e)
+        finally:
+            conn.close()
 
 # --- CLI Handlers ---
 def handle_version(args):
@@ -434,101 +449,42 @@ def handle_scrape_run(args):
 
     import urllib.parse
     def get_book_ids(host_url, extension):
-        import urllib.parse
-        host = urllib.parse.urlparse(host_url).hostname
+        host, port = calishot_siteurls.host_port(host_url)
+        if not host:
+            logging.error("Could not parse the host of %s", host_url)
+            return []
+        wanted = str(extension).strip().lower()
+        ext_all = wanted in ('all', '*', 'any', '')
+        # Same label as the summary view's links, e.g. 'epub (1.2 MB)'
+        label = (f"l.format || CASE WHEN l.size IS NULL THEN '' "
+                 f"ELSE ' (' || {calishot_indexlayout.size_label_sql('l.size')} || ')' END")
+        # An index range read of the host's copies (sites(host, port) -> book_sites -> book_formats)
+        sql = (f"SELECT l.uuid, l.href, {label} FROM {calishot_indexlayout.LOCATIONS} l "
+               f"JOIN {calishot_indexlayout.BOOKS} b ON b.uuid = l.uuid WHERE l.host = ? AND l.port IS ?")
+        params = [host, port]
+        if not ext_all:
+            sql += " AND lower(l.format) = ?"
+            params.append(wanted)
+        if authors_pattern:
+            sql += " AND b.authors LIKE ?"
+            params.append(authors_pattern)
+        if titles_pattern:
+            sql += " AND b.title LIKE ?"
+            params.append(titles_pattern)
+        sql += " ORDER BY l.uuid, l.format"
         conn = get_index_db_conn()
         try:
-            cur = conn.cursor()
-            # Prefilter by host; optional authors LIKE filter; do extension filtering in Python for robustness
-            sql = "SELECT uuid, links FROM summary WHERE links LIKE ?"
-            params = [f"%{host}%"]
-            if authors_pattern:
-                sql += " AND authors LIKE ?"
-                params.append(authors_pattern)
-            if titles_pattern:
-                sql += " AND title LIKE ?"
-                params.append(titles_pattern)
-            cur.execute(sql, tuple(params))
-            rows = cur.fetchall()
+            book_links = conn.execute(sql, params).fetchall()
+        except sqlite3.OperationalError as e:
+            # An index.db from before book_locations, until build_index runs on it
+            logging.error("Could not read book_locations from index.db: %s", e)
+            return []
         finally:
             conn.close()
-        print(f"[DEBUG] Host: {host_url}")
-        print(f"[DEBUG] Querying index.db for links LIKE '%{host}%' ...")
-        if authors_pattern:
-            print(f"[DEBUG] Applying authors LIKE filter: {authors_pattern}")
-        if titles_pattern:
-            print(f"[DEBUG] Applying title LIKE filter: {titles_pattern}")
-        print(f"[DEBUG] Found book UUIDs and links: {rows}")
-        import json
-        book_links = []
-        for uuid, links_json in rows:
-            try:
-                links = json.loads(links_json)
-                # Determine if we should collect all formats
-                ext_all = str(extension).strip().lower() in ('all', '*', 'any', '')
-                if ext_all:
-                    # Collect all available formats (dedupe by a robust format key) for this book on this host
-                    import os
-                    from urllib.parse import urlparse
-                    def token_from_label(lbl: str) -> str | None:
-                        if not lbl:
-                            return None
-                        tokens = {
-                            'epub','epub2','epub3','pdf','mobi','azw','azw1','azw3','kf8','kfx','pdb','prc','tpz',
-                            'txt','rtf','html','m4b','mp3','aac','flac','wma','ogg','wav','cbr','cbz','cb7','cbt','cba'
-                        }
-                        low = str(lbl).lower()
-                        for t in sorted(tokens, key=len, reverse=True):
-                            if f".{t}" in low or f" {t}" in low or f"-{t}" in low or f"_{t}" in low or low.endswith(t):
-                                return t
-                        return None
-                    seen_keys = set()
-                    queued = []
-                    host_mismatch = 0
-                    for link in links:
-                        label = (link.get('label') or '')
-                        href = (link.get('href') or '')
-                        if not href:
-                            continue
-                        # Do NOT require same host when selecting ALL; many sites serve formats via CDNs
-                        if host not in href:
-                            host_mismatch += 1
-                        # Prefer extension from href path
-                        try:
-                            path = urlparse(href).path
-                            ext = os.path.splitext(path)[-1].lower().lstrip('.')
-                        except Exception:
-                            ext = ''
-                        # If no ext, try to infer from label tokens
-                        fmt = ext or token_from_label(label) or None
-                        # Build a dedupe key; if we still don't have a format token, use href itself
-                        key = (fmt or '').strip() or href
-                        if key in seen_keys:
-                            continue
-                        seen_keys.add(key)
-                        queued.append((uuid, href, label, fmt or ''))
-                        book_links.append((uuid, href, label))
-                    try:
-                        dbg = ', '.join([f"{q[3] or 'unknown'}" for q in queued])
-                        print(f"[DEBUG] [ALL] uuid={uuid} queued {len(queued)} item(s) formats=[{dbg}] keys={len(seen_keys)} host_mismatch={host_mismatch}")
-                    except Exception:
-                        print(f"[DEBUG] [ALL] uuid={uuid} queued {len(queued)} item(s)")
-                else:
-                    # Specific extension requested: pick the first matching link on this host
-                    wanted = str(extension).strip().lower()
-                    for link in links:
-                        label = (link.get('label') or '')
-                        href = (link.get('href') or '')
-                        if not href or host not in href:
-                            continue
-                        label_ok = wanted in label.lower()
-                        href_ok = href.lower().endswith(f".{wanted}")
-                        if label_ok or href_ok:
-                            book_links.append((uuid, href, label))
-                            break
-            except Exception as e:
-                print(f"[DEBUG] Could not parse links for {uuid}: {e}")
-        print(f"[DEBUG] Download targets (uuid, href, label): {book_links}")
+        logging.debug("%s (%s:%s): %d download target(s), formats %s, authors LIKE %s, title LIKE %s",
+                      host_url, host, port, len(book_links), 'all' if ext_all else wanted,
+                      authors_pattern, titles_pattern)
+        logging.debug("Download targets (uuid, href, label) of %s: %s", host_url, book_links)
         return book_links
 
     def download_book(host_url, book_tuple):
@@ -548,7 +504,7 @@ def handle_scrape_run(args):
                 # Always download and overwrite the file, even if uuid is present in index.db
                 # Download book file using the actual href
                 print(f"[DEBUG] Downloading book {uuid} from href: {href}")
-                rf = requests.get(href, headers={"User-Agent": user_agent}, timeout=timeout)
+                rf = calishot_http.get(href, headers={"User-Agent": user_agent}, timeout=timeout)
                 if rf.status_code == 200:
                     # Determine correct file extension using multiple strategies
                     import os
@@ -719,9 +675,8 @@ def handle_scrape_run(args):
                         f.write(rf.content)
                     
                     # Update the summary with the proper title if it wasn't already set
-                    thread_index_cur.execute("INSERT OR REPLACE INTO summary (uuid, title, authors, formats) VALUES (?, ?, ?, ?)",
-                                     (uuid, book_title, book_authors, file_ext))
-                    thread_index_conn.commit()
+                    write_index_db("INSERT OR REPLACE INTO summary (uuid, title, authors, formats) VALUES (?, ?, ?, ?)",
+                                   (uuid, book_title, book_authors, file_ext))
                     return (uuid, 'downloaded')
                 else:
                     return (uuid, f"download_failed_{rf.status_code}")
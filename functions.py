@@ -1,10 +1,20 @@
+import os
+from gevent import monkey
+
+# Patch sockets, ssl, DNS and sleep before requests/urllib3 are imported so the
+# gevent pools in check_calibre_list and index_site_list overlap their network
+# waits instead of running one blocking request after another.
+# Set CALISHOT_CONCURRENCY=off to fall back to plain blocking I/O (debugging).
+CONCURRENCY_MODE = os.getenv("CALISHOT_CONCURRENCY", "gevent").strip().lower()
+if CONCURRENCY_MODE == "gevent" and not monkey.is_module_patched("socket"):
+    monkey.patch_all()
+
 import requests
 from pathlib import Path
 from urllib.parse import *
 import uuid
 import datetime
 import gevent
-from gevent import monkey
 from gevent import Timeout
 from gevent.pool import Pool
 import ipaddress
@@ -21,7 +31,6 @@ from typing import Dict
 import json
 from humanize import naturalsize as hsize
 import humanize
-from langid.langid import LanguageIdentifier, model
 import iso639
 import time
 import unidecode
@@ -30,6 +39,26 @@ import urllib3
 import logging
 import configparser
 import calishot_logging
+import calishot_capabilities
+import calishot_checkpoint
+import calishot_formats
+import calishot_fts
+import calishot_http
+import calishot_indexdiff
+import calishot_indexlayout
+import calishot_indexswap
+import calishot_indexsync
+import calishot_jsonstream
+import calishot_pagesize
+import calishot_pipeline
+import calishot_preprobe
+import calishot_probe
+import calishot_procpool
+import calishot_schedule
+import calishot_siteurls
+import calishot_transform
+import calishot_watermark
+import calishot_writer
 
 # Configure project-wide logging and pin to project CWD
 calishot_logging.init_logging(logging.INFO, log_file=Path.cwd() / 'calishot.log')
@@ -62,10 +91,10 @@ except Exception as e:
     sys.exit(1)
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-identifier = LanguageIdentifier.from_modelstring(model, norm_probs=True)
 
 global site_conn
 data_dir = "./data/"
+
 site_conn = sqlite3.connect(data_dir + "sites.db")
 site_cursor = site_conn.cursor()
 ########################
@@ -196,20 +225,22 @@ def save_site(db: Database, site):
 ##########################
 # Validate Site and save #
 ##########################
-def check_and_save_site(db, site):
+def check_and_save_site(db, site, sink=None):
         """
         Check and save a site.
 
         Args:
             db (database): The database object.
             site (str): The site to be checked and saved.
+            sink (SitesWriter, optional): Writer that applies the result in a batch instead of
+                writing to db directly.
 
         Returns:
             bool: True if the site was processed successfully, False if it was deleted
         """
         logging.info("****Check and Save Function****")
 
-        res = check_calibre_site(site)
+        res = check_calibre_site(site, sink=sink)
         
         # If check_calibre_site returns None, the site was deleted due to too many failures
         if res is None:
@@ -226,7 +257,12 @@ def check_and_save_site(db, site):
             if site_record:
                 res['uuid'] = site_record['uuid']
         
+        calishot_schedule.update_schedule(site, res)
+
         # Save the site with updated information
+        if sink is not None:
+            sink.save_site(res)
+            return True
         save_site(db, res)
         
         # Verify the data was saved correctly
@@ -242,7 +278,7 @@ def check_and_save_site(db, site):
 ######################
 # Check Calibre Site #
 ######################
-def check_calibre_site(site):
+def check_calibre_site(site, sink=None):
     """
     Check the calibre site.
 
@@ -250,6 +286,8 @@ def check_calibre_site(site):
                  It should have the following keys:
                  - "uuid" (str): The UUID of the site.
                  - "url" (str): The URL of the site.
+    :param sink: Optional SitesWriter; deletions and per-library counts are queued on it
+                 instead of being written to sites.db directly.
     :return: A dictionary containing the result of the check.
              It has the following keys:
              - "uuid" (str): The UUID of the site.
@@ -263,6 +301,7 @@ def check_calibre_site(site):
     
     logging.info("****Check Calibre Site Function****")
     now = str(datetime.datetime.now())
+    save_library_count = sink.upsert_library_count if sink is not None else upsert_library_count
     
     # Normalize site to a dict (sqlite_utils Row can be dict-like but not a real dict)
     try:
@@ -293,7 +332,9 @@ def check_calibre_site(site):
         
         try:
             # Delete the site from the database
-            if 'uuid' in site:
+            if 'uuid' in site and sink is not None:
+                sink.delete_site(site['uuid'])
+            elif 'uuid' in site:
                 db = init_sites_db()
                 db["sites"].delete(site['uuid'])
                 print(f"Successfully deleted site {site.get('url')}")
@@ -339,7 +380,7 @@ def check_calibre_site(site):
     logging.info("URL: %s", url)
     
     try:
-        r=requests.get(url, verify=False, timeout=(timeout, 30))
+        r=calishot_http.get(url, verify=False, timeout=(timeout, 30))
         r.raise_for_status()
     except requests.exceptions.HTTPError as e:
         status_code = getattr(e.response, 'status_code', 0) if 'e' in locals() else 0
@@ -457,7 +498,7 @@ def check_calibre_site(site):
         
         # Get library count and calculate total books when site is online
         try:
-            libraries = get_libs_from_site(site['url'])
+            libraries = get_libs_from_site(site['url'], update_db=sink is None)
             libraries_count = len(libraries)
             ret['libraries_count'] = libraries_count
             print(f"Found {libraries_count} libraries at {site['url']}")
@@ -475,7 +516,7 @@ def check_calibre_site(site):
                             continue
 
                         lib_url = f"{api}search/{library}?num=0"
-                        lib_r = requests.get(lib_url, verify=False, timeout=(timeout, 30))
+                        lib_r = calishot_http.get(lib_url, verify=False, timeout=(timeout, 30))
                         lib_r.raise_for_status()
                         lib_count = int(lib_r.json().get("total_num", 0))
                         total_books += lib_count
@@ -483,7 +524,7 @@ def check_calibre_site(site):
                         logging.info(f"Library '{library}': {lib_count} books")
                         # Update per-library tracking in sites.db
                         try:
-                            upsert_library_count(site['url'], library, lib_count)
+                            save_library_count(site['url'], library, lib_count)
                         except Exception as uple:
                             logging.warning("Failed upserting per-library count for %s/%s: %s", site['url'], library, uple)
 
@@ -503,12 +544,12 @@ def check_calibre_site(site):
                         if not library:
                             continue
                         lib_url = f"{api}search/{library}?num=0"
-                        lib_r = requests.get(lib_url, verify=False, timeout=(timeout, 30))
+                        lib_r = calishot_http.get(lib_url, verify=False, timeout=(timeout, 30))
                         lib_r.raise_for_status()
                         lib_count = int(lib_r.json().get("total_num", 0))
                         ret['book_count'] = lib_count
                         try:
-                            upsert_library_count(site['url'], library, lib_count)
+                            save_library_count(site['url'], library, lib_count)
                         except Exception as uple:
                             logging.warning("Failed upserting per-library count for %s/%s: %s", site['url'], library, uple)
                     except Exception as lib_e:
@@ -777,12 +818,14 @@ def import_urls_from_file(filepath, dir=data_dir, country=None):
 ###################################
 # Get list of libraries from site #
 ###################################
-def get_libs_from_site(site):
+def get_libs_from_site(site, update_db=True):
     """
     Retrieves libraries from a specified website.
 
     Args:
         site (str): The URL of the website to retrieve libraries from.
+        update_db (bool, optional): Also store libraries_count in sites.db. Callers that
+            save the count themselves (e.g. through a SitesWriter) pass False. Defaults to True.
 
     Returns:
         list[str]: A list of libraries retrieved from the website.
@@ -806,7 +849,7 @@ def get_libs_from_site(site):
     # print(url)
 
     try:
-        r=requests.get(url, verify=False, timeout=(timeout, 30))
+        r=calishot_http.get(url, verify=False, timeout=(timeout, 30))
         r.raise_for_status()
     except requests.RequestException as e: 
         print("Unable to open site:", url)
@@ -830,6 +873,9 @@ def get_libs_from_site(site):
     logging.info("Libraries: %s", libraries)
     print("Libraries:", ", ".join(libraries))
     
+    if not update_db:
+        return libraries
+
     # Update libraries count in sites database
     try:
         sites_db = Database(Path(data_dir) / "sites.db")
@@ -863,47 +909,9 @@ def upsert_library_count(url: str, library: str, count: int, dir=data_dir):
     try:
         db_path = Path(dir) / "sites.db"
         conn = sqlite3.connect(db_path)
-        cur = conn.cursor()
         # Ensure table exists (migration should create it, but be defensive)
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS libraries_per_server (
-                url TEXT NOT NULL,
-                library TEXT NOT NULL,
-                book_count_per_library INTEGER DEFAULT 0,
-                last_book_count_per_library INTEGER DEFAULT 0,
-                new_books_per_library INTEGER DEFAULT 0,
-                last_updated TEXT,
-                PRIMARY KEY (url, library)
-            )
-            """
-        )
-
-        # Fetch previous count
-        cur.execute(
-            "SELECT book_count_per_library FROM libraries_per_server WHERE url = ? AND library = ?",
-            (url, library),
-        )
-        row = cur.fetchone()
-        prev = int(row[0]) if row and row[0] is not None else 0
-        current = int(count) if count is not None else 0
-        new_books = max(0, current - prev)
-        now = datetime.datetime.utcnow().isoformat()
-
-        # Upsert with conflict handling
-        cur.execute(
-            """
-            INSERT INTO libraries_per_server (
-                url, library, book_count_per_library, last_book_count_per_library, new_books_per_library, last_updated
-            ) VALUES (?, ?, ?, ?, ?, ?)
-            ON CONFLICT(url, library) DO UPDATE SET
-                last_book_count_per_library = excluded.last_book_count_per_library,
-                book_count_per_library = excluded.book_count_per_library,
-                new_books_per_library = excluded.new_books_per_library,
-                last_updated = excluded.last_updated
-            """,
-            (url, library, current, prev, new_books, now),
-        )
+        conn.execute(calishot_writer.LIBRARIES_TABLE_SQL)
+        prev, current, new_books = calishot_writer.upsert_library(conn, url, library, count)
         conn.commit()
         logging.info("Upserted library count %s/%s: prev=%d current=%d new=%d", url, library, prev, current, new_books)
     except Exception as e:
@@ -937,7 +945,7 @@ def create_library_records_for_servers(server_urls):
             try:
                 # Fetch library info from server
                 api = server_url.rstrip('/') + '/ajax/library-info'
-                r = requests.get(api, verify=False, timeout=(30, 30))
+                r = calishot_http.get(api, verify=False, timeout=(30, 30))
                 r.raise_for_status()
                 lib_map = r.json().get('library_map', {})
                 for lib_name, lib_info in lib_map.items():
@@ -972,29 +980,186 @@ def create_library_records_for_servers(server_urls):
         conn.close()
     print("Library records created/updated for all servers.")
 
+#####################
+# Greenlet Pool      #
+#####################
+def make_pool(size):
+    """
+    Create a gevent pool for network-bound work.
+
+    The pool only overlaps requests when gevent has patched the socket module
+    (see CONCURRENCY_MODE at the top of this file); otherwise every greenlet
+    blocks the whole process and the pool runs its jobs one after another.
+
+    Args:
+        size (int): Maximum number of concurrent greenlets.
+
+    Returns:
+        Pool: The gevent pool.
+    """
+    if size > 1 and not monkey.is_module_patched("socket"):
+        logging.warning("Sockets are not gevent-patched (CALISHOT_CONCURRENCY=%s); Pool(%s) will run serially", CONCURRENCY_MODE, size)
+    else:
+        logging.info("Using gevent pool of size %s (concurrency mode: %s)", size, CONCURRENCY_MODE)
+    return Pool(size)
+
+###########################
+# Report sites.db writer  #
+###########################
+def print_writer_stats(sink):
+    """
+    Print the queue-depth and commit-latency metrics of a SitesWriter.
+
+    Args:
+        sink (SitesWriter): The writer used for the sweep.
+
+    Returns:
+        None
+    """
+    m = sink.stats()
+    print(f"sites.db writer: {m['written']} writes in {m['commits']} commits, "
+          f"max queue depth {m['max_queue_depth']}, "
+          f"commit latency avg {m['commit_ms_avg']:.1f} ms / max {m['commit_ms_max']:.1f} ms")
+
 ###################################
 # Check the list of sites in file #
 ###################################
-def check_calibre_list(dir=data_dir):    
+def check_calibre_list(dir=data_dir, pool_size=100, engine="gevent", check_all=False, preprobe=True):    
     """
-    Generates a comment for the given function body in a markdown code block with the correct language syntax.
+    Checks the sites in the sites database that are due for a check and saves the results.
 
     Parameters:
         dir (str): The directory to search for the sites database. Defaults to the current directory.
+        pool_size (int): Number of sites probed at the same time. Defaults to 100.
+        engine (str): "gevent" (default) or "async" to use the asyncio engine in calishot_probe.
+        check_all (bool): Probe every site, ignoring next_check_at. Defaults to False.
+        preprobe (bool): Mark hosts that refuse a TCP connect as down before any HTTP request.
+            Defaults to True.
 
     Returns:
         None
     """
     logging.info("****Check Calibre List Function****")
+    if engine == "async":
+        if calishot_probe.is_available():
+            return check_calibre_list_async(dir, check_all=check_all, preprobe=preprobe)
+        print("aiohttp is not installed; falling back to the gevent engine")
+        logging.warning("aiohttp is not installed; falling back to the gevent engine")
     db=init_sites_db(dir)
     sites=[]
-    for row in db["sites"].rows:
+    for row in get_sites_to_check(db, dir, check_all):
         logging.info("Queueing: %s", row['url'])
         print(f"Queueing:{row['url']}")
         sites.append(row)
     print(sites)
-    pool = Pool(100)
-    pool.map(lambda s: check_and_save_site (db, s), sites)
+    pool = make_pool(pool_size)
+    # One writer owns sites.db for the whole sweep; results are committed in batches
+    with calishot_writer.SitesWriter(Path(dir) / "sites.db") as sink:
+        if preprobe:
+            sites = preprobe_sites(sites, sink)
+        pool.map(lambda s: check_and_save_site (db, s, sink=sink), sites)
+    print_writer_stats(sink)
+
+######################
+# Sites due to check #
+######################
+def get_sites_to_check(db, dir=data_dir, check_all=False):
+    """
+    Returns the sites a health check should probe, in priority order.
+
+    Parameters:
+        db (Database): The sites database.
+        dir (str): The directory containing the sites database.
+        check_all (bool): Return every site instead of only the due ones.
+
+    Returns:
+        list: Site rows, most overdue first.
+    """
+    calishot_schedule.ensure_columns(Path(dir) / "sites.db")
+    sites=[dict(row) for row in db["sites"].rows]
+    if check_all:
+        return sites
+    due, skipped=calishot_schedule.due_sites(sites)
+    print(f"Scheduler: {len(due)} sites due for a check, {skipped} not due yet")
+    return due
+
+#######################
+# TCP connect preprobe #
+#######################
+def preprobe_sites(sites, sink, timeout=3.0, concurrency=500):
+    """
+    Marks the sites whose host does not accept a TCP connection as down.
+
+    The down results are queued on sink exactly as a failed HTTP probe would be
+    (failed_attempts + 1, last_failed), so only reachable sites go on to the HTTP engine.
+
+    Parameters:
+        sites (list): Site rows to check.
+        sink (SitesWriter): Writer that saves the down results.
+        timeout (float): Connect timeout in seconds. Defaults to 3.
+        concurrency (int): Maximum number of connects in flight. Defaults to 500.
+
+    Returns:
+        list: The sites that still need the full HTTP probe.
+    """
+    start=time.time()
+    reachable, down=calishot_preprobe.run_preprobe(sites, concurrency=concurrency, timeout=timeout)
+    for site, res in down:
+        logging.info("Pre-probe down: %s (%s)", site.get('url'), res['error_message'])
+        sink.save_site(calishot_schedule.update_schedule(site, res))
+    print(f"Pre-probe: {len(reachable)} reachable, {len(down)} down in {time.time()-start:.1f}s")
+    return reachable
+
+###########################################
+# Check the list of sites (asyncio engine) #
+###########################################
+def check_calibre_list_async(dir=data_dir, concurrency=500, per_ip=4, check_all=False, preprobe=True):
+    """
+    Checks the due sites in the sites database with the asyncio engine and saves the results.
+
+    Produces the same site updates as check_calibre_list, but all requests share one
+    aiohttp session and per-library counts are fetched concurrently.
+
+    Parameters:
+        dir (str): The directory containing the sites database.
+        concurrency (int): Maximum number of requests in flight overall. Defaults to 500.
+        per_ip (int): Maximum number of requests in flight per IP address. Defaults to 4.
+        check_all (bool): Probe every site, ignoring next_check_at. Defaults to False.
+        preprobe (bool): Mark hosts that refuse a TCP connect as down before any HTTP request.
+            Defaults to True.
+
+    Returns:
+        None
+    """
+    logging.info("****Check Calibre List Async Function****")
+    db=init_sites_db(dir)
+    sites=get_sites_to_check(db, dir, check_all)
+    print(f"Probing {len(sites)} sites with the async engine")
+    logging.info("Probing %s sites with the async engine (concurrency=%s, per_ip=%s)", len(sites), concurrency, per_ip)
+
+    sink=calishot_writer.SitesWriter(Path(dir) / "sites.db").start()
+
+    def on_result(site, res, library_counts):
+        if res is None:
+            print(f"Deleting site {site.get('url')} due to {site.get('failed_attempts')} failed attempts")
+            logging.info(f"Deleting site {site.get('url')} due to {site.get('failed_attempts')} failed attempts")
+            sink.delete_site(site['uuid'])
+            return
+        for library, count in library_counts.items():
+            sink.upsert_library_count(site['url'], library, count)
+        logging.info("Result: %s", res)
+        sink.save_site(calishot_schedule.update_schedule(site, res))
+
+    start=time.time()
+    try:
+        if preprobe:
+            sites=preprobe_sites(sites, sink)
+        done=calishot_probe.run_probe(sites, on_result=on_result, concurrency=concurrency, per_ip=per_ip)
+    finally:
+        sink.close()
+    print(f"Async engine probed {done} sites in {time.time()-start:.1f}s")
+    logging.info("Async engine probed %s sites in %.1fs", done, time.time()-start)
+    print_writer_stats(sink)
 
 #################
 # Get site UUID #
@@ -2236,7 +2401,7 @@ def index_ebooks_from_library(site, _uuid="", library='', start=0, stop=0, dir=d
                 text=r_book['title']+". "
                 if r_book['comments']:
                     text=r_book['comments']                    
-                s_language, prob=identifier.classify(text)
+                s_language, prob=calishot_transform.classify(text)
                 if prob >= 0.85:
                     language =  iso639.to_iso639_2(s_language)
                     book['language']=language
@@ -2482,8 +2647,195 @@ def init_site_db(site, _uuid="", dir=data_dir):
         # db.table("ebooks", pk="id")
         # db.table("ebooks", pk="id", alter=True
 
+    # Per-format sizes live in ebook_formats; moves them out of the columns of older site dbs
+    migrated=calishot_formats.ensure(db)
+    if migrated:
+        print(f"{s_uuid}: format columns {migrated} moved to ebook_formats")
+        logging.info("%s: format columns %s moved to ebook_formats", s_uuid, migrated)
+
     return db
 
+##############################
+# Compact Duplicate Site DBs #
+##############################
+def site_db_paths(dir=data_dir):
+    """
+    Lists the per-site ebook databases in dir.
+
+    Parameters:
+        dir (str): The data directory.
+
+    Returns:
+        list: Paths of the .db files that have both a 'site' and an 'ebooks' table.
+    """
+    paths=[]
+    for f in sorted(os.listdir(dir)):
+        if not f.endswith(".db") or f in ("index.db", "sites.db", "diff.db"):
+            continue
+        p=Path(dir) / f
+        try:
+            tables=Database(p).table_names()
+        except Exception as e:
+            logging.info("Pb with: %s (%s)", f, e)
+            continue
+        if "site" in tables and "ebooks" in tables:
+            paths.append(p)
+    return paths
+
+#####################
+# Index Checkpoints #
+#####################
+def list_checkpoints(dir=data_dir):
+    """
+    Prints the unfinished indexing passes recorded in the site databases.
+
+    Parameters:
+        dir (str): The data directory.
+
+    Returns:
+        list: One dict per checkpoint with the site uuid, url, library, offset, total and time.
+    """
+    logging.info("****List Checkpoints Function****")
+    found=[]
+    for p in site_db_paths(dir):
+        db=Database(p)
+        for cp in calishot_checkpoint.list_all(db):
+            url=json.loads(list(db['site'].rows)[0]['urls'])[0]
+            found.append(dict(cp, site=p.stem, url=url))
+            print(f"{p.stem}  {url}  library='{cp['library']}'  {cp['offset']}/{cp['total']}  {cp['updated']}")
+    print(f"{len(found)} checkpoint(s)")
+    return found
+
+def reset_checkpoints(dir=data_dir, site=None, library=None):
+    """
+    Deletes indexing checkpoints so the next pass starts from offset 0.
+
+    Parameters:
+        dir (str): The data directory.
+        site (str, optional): Only this site (sites.uuid or URL). Defaults to every site.
+        library (str, optional): Only this library. Defaults to every library.
+
+    Returns:
+        int: Number of checkpoints removed.
+    """
+    logging.info("****Reset Checkpoints Function****")
+    removed=0
+    for p in site_db_paths(dir):
+        db=Database(p)
+        if site:
+            urls=[u.rstrip('/') for u in json.loads(list(db['site'].rows)[0]['urls'])]
+            if site != p.stem and site.rstrip('/') not in urls:
+                continue
+        removed+=calishot_checkpoint.clear(db, library)
+    print(f"Removed {removed} checkpoint(s)")
+    logging.info("Removed %s checkpoint(s)", removed)
+    return removed
+
+def compact_site_dbs(dir=data_dir, dry_run=False):
+    """
+    Merges the duplicate ebook databases left by earlier runs into one file per site.
+
+    Before site databases were keyed by sites.uuid, every index run created a new
+    <uuid4>.db for the same server. Files are grouped by the site URL stored in their
+    'site' table; each group is merged into <sites.uuid>.db (or the newest file when
+    the URL is not in sites.db), newer files winning for books present in several,
+    and the merged duplicates are deleted.
+
+    Parameters:
+        dir (str): The data directory.
+        dry_run (bool): Only report what would be merged. Defaults to False.
+
+    Returns:
+        dict: Counts of sites, merged files and bytes before/after.
+    """
+    logging.info("****Compact Site DBs Function****")
+    sites_by_url={}
+    sites_path=Path(dir) / "sites.db"
+    if sites_path.exists():
+        sites_db=Database(sites_path)
+        if "sites" in sites_db.table_names():
+            for row in sites_db.query("SELECT uuid, url FROM sites"):
+                if row['url']:
+                    sites_by_url[row['url'].rstrip('/')]=row['uuid']
+
+    groups={}
+    for p in site_db_paths(dir):
+        try:
+            site_row=list(Database(p)['site'].rows)[0]
+            url=json.loads(site_row['urls'])[0].rstrip('/')
+        except Exception as e:
+            print("Pb with:", p.name, e)
+            logging.info("Pb with: %s (%s)", p.name, e)
+            continue
+        groups.setdefault(url, []).append(p)
+
+    def db_size(paths):
+        return sum(f.stat().st_size for p in paths for f in (p, Path(str(p)+"-wal")) if f.exists())
+
+    stats={'sites': len(groups), 'merged_files': 0, 'bytes_before': 0, 'bytes_after': 0}
+    for url, paths in groups.items():
+        stats['bytes_before']+=db_size(paths)
+        paths.sort(key=lambda p: p.stat().st_mtime)
+        target_uuid=sites_by_url.get(url) or paths[-1].stem
+        target=Path(dir) / f"{target_uuid}.db"
+        sources=[p for p in paths if p != target]
+        if not sources:
+            stats['bytes_after']+=db_size(paths)
+            continue
+        print(f"{url}: merging {len(sources)} file(s) into {target.name}")
+        logging.info("%s: merging %s file(s) into %s", url, len(sources), target.name)
+        if dry_run:
+            stats['merged_files']+=len(sources)
+            stats['bytes_after']+=db_size(paths)
+            continue
+
+        target_db=init_site_db(url, _uuid=target_uuid, dir=dir)
+        target_mtime=target.stat().st_mtime if target in paths else 0
+        site_row=list(target_db['site'].rows)[0]
+        for src_path in sources:
+            src_db=Database(src_path)
+            calishot_formats.ensure(src_db)
+            # A book present in several files keeps its most recently indexed version
+            newer=src_path.stat().st_mtime > target_mtime
+            target_db.execute("ATTACH DATABASE ? AS src", [str(src_path)])
+            try:
+                # The books whose formats come from src, decided before the books are merged
+                with target_db.conn:
+                    target_db.execute("DROP TABLE IF EXISTS temp.merged")
+                    target_db.execute("CREATE TEMP TABLE merged AS SELECT uuid FROM src.ebooks"
+                                      + ("" if newer else " WHERE uuid NOT IN (SELECT uuid FROM main.ebooks)"))
+                rows=src_db['ebooks'].rows
+                target_db['ebooks'].insert_all(rows, pk='uuid', batch_size=1000, replace=newer, ignore=not newer)
+                # Formats go in after their books: replacing a book fires ebooks_formats_ad,
+                # which deletes the formats it had
+                with target_db.conn:
+                    target_db.execute("DELETE FROM ebook_formats WHERE uuid IN (SELECT uuid FROM temp.merged)")
+                    target_db.execute("INSERT INTO ebook_formats (uuid, format, size) "
+                                      "SELECT uuid, format, size FROM src.ebook_formats "
+                                      "WHERE uuid IN (SELECT uuid FROM temp.merged)")
+                    target_db.execute("DROP TABLE temp.merged")
+            finally:
+                target_db.execute("DETACH DATABASE src")
+            src_site=list(src_db['site'].rows)[0]
+            if newer and src_site.get('version'):
+                site_row['version']=src_site['version']
+                site_row['major']=src_site['major']
+            src_db.close()
+            for f in (src_path, Path(str(src_path)+"-wal"), Path(str(src_path)+"-shm")):
+                if f.exists():
+                    f.unlink()
+            stats['merged_files']+=1
+        target_db['site'].upsert(site_row, pk='uuid')
+        target_db.vacuum()
+        target_db.close()
+        stats['bytes_after']+=db_size([target])
+
+    print(f"Compacted {stats['merged_files']} duplicate files for {stats['sites']} sites: "
+          f"{hsize(stats['bytes_before'])} -> {hsize(stats['bytes_after'])}")
+    logging.info("Compacted %s duplicate files for %s sites: %s -> %s", stats['merged_files'], stats['sites'],
+                 hsize(stats['bytes_before']), hsize(stats['bytes_after']))
+    return stats
+
 ######################
 # Format the Get URL #
 ######################
@@ -2500,12 +2852,7 @@ def get_format_url(db, book, format):
         str: The URL for the specified format of the book.
     """
     logging.info("****Get Format URL Function****")
-    url = json.loads(list(db['site'].rows)[0]["urls"])[0]
-    library=book['library']
-    id_=str(book['id'])
-
-    f_url = url+"/get/"+format+"/"+id_+"/"+library
-    return f_url
+    return calishot_siteurls.format_url(calishot_siteurls.from_site_db(db), book, format)
     
 ########################
 # Get Book Description #
@@ -2522,32 +2869,19 @@ def get_desc_url(db, book):
         str: The description URL for the given book.
     """
     logging.info("****Get Description URL Function****")
-    url = json.loads(list(db['site'].rows)[0]["urls"])[0]
-
-    library=book['library']
-    id_=str(book['id'])
-
-    f_urls=[]
-
-    major=  list(db['site'].rows)[0]["major"]
-
-    if major >= 3:
-        d_url =url+"#book_id="+id_+"&library_id="+library+"&panel=book_details"
-    else:
-        d_url =url+"/browse/book/"+id_
-
-    return d_url
+    return calishot_siteurls.desc_url(calishot_siteurls.from_site_db(db), book)
 
 ###################################
 # Save Books Metadata to Database #
 ###################################
-def save_books_metadata_from_site(db, books):
+def save_books_metadata_from_site(db, books, replace=False):
     """
     Saves the metadata of books from a website into the database.
 
     Args:
         db (Database): The database object where the metadata will be saved.
         books (List[dict]): A list of dictionaries representing the metadata of the books.
+        replace (bool): Overwrite books already present (same uuid). Defaults to False.
 
     Returns:
         None
@@ -2566,7 +2900,10 @@ def save_books_metadata_from_site(db, books):
     #     ebooks_t.insert(b, alter=True)
 
     # ebooks_t.insert_all(books, alter=True)
-    ebooks_t.insert_all(books, alter=True,  pk='uuid', batch_size=1000)
+    # Sizes go to ebook_formats: no more one ebooks column per format
+    formats=calishot_formats.split(books)
+    ebooks_t.insert_all(books, pk='uuid', batch_size=1000, replace=replace)
+    calishot_formats.save(db, formats, replace=replace)
     # print([c[1] for c in ebooks_t.columns])
 
 #################
@@ -2634,41 +2971,51 @@ def index_site_list_seq(file):
 ###################
 # Index Site List #
 ###################
-def index_site_list(file):
+def index_site_list(file, pool_size=40):
     """
     Indexes a list of sites from a given file.
 
     Args:
         file (str): The path to the file containing the list of sites.
+        pool_size (int, optional): Number of sites indexed at the same time. Defaults to 40.
 
     Returns:
         None
     """
     logging.info("****Index Site List Function****")
-    pool = Pool(40)
+    pool = make_pool(pool_size)
 
     with open(file) as f:
         sites = f.readlines()
         sites= [s.rstrip() for s in sites]
         print(sites)
         logging.info("Sites: "+str(sites))
-        pool.map(index_ebooks_except, sites)
+        # One copy of server_capabilities for every site; its writes go through the sites.db writer
+        with calishot_writer.SitesWriter(Path(data_dir) / "sites.db") as sink:
+            capabilities=calishot_capabilities.CapabilityCache(Path(data_dir) / "sites.db", writer=sink)
+            pool.map(lambda site: index_ebooks_except(site, capabilities=capabilities), sites)
+    print(calishot_transform.stage.report())
+    logging.info(calishot_transform.stage.report())
+    print(capabilities.report())
+    logging.info(capabilities.report())
 
 ##########################
 # Index Ebooks Exception #
 ##########################
-def index_ebooks_except(site):
+def index_ebooks_except(site, capabilities=None):
     """
     Indexes ebooks on the given site, excluding any errors that occur during indexing.
 
     :param site: The site to index ebooks from.
     :type site: str
+    :param capabilities: Shared server_capabilities cache, see index_ebooks.
+    :type capabilities: CapabilityCache
 
     :return: None
     """
     logging.info("****Index Ebooks Exception Function****")
     try:
-        index_ebooks(site)
+        index_ebooks(site, capabilities=capabilities)
     except Exception as e:
         print(f"Error on site: {site} - {e}")
         logging.exception(f"Error on site: {site}")
@@ -2676,7 +3023,7 @@ def index_ebooks_except(site):
 ################
 # Index Ebooks #
 ################
-def index_ebooks(site, library='', start=0, stop=0, dir=data_dir, num=1000, force_refresh=False):
+def index_ebooks(site, library='', start=0, stop=0, dir=data_dir, num=1000, force_refresh=False, prefetch=2, adaptive=True, capabilities=None):
     """
     Generates a function comment for the given function body.
 
@@ -2688,6 +3035,9 @@ def index_ebooks(site, library='', start=0, stop=0, dir=data_dir, num=1000, forc
         dir (str, optional): The directory to save the indexed ebooks. Defaults to ".".
         num (int, optional): The number of ebooks to index. Defaults to 1000.
         force_refresh (bool, optional): Whether to force a refresh of the indexed ebooks. Defaults to False.
+        prefetch (int, optional): Pages fetched ahead while the current one is saved; 0 fetches sequentially. Defaults to 2.
+        adaptive (bool, optional): Adapt the page size to the server, starting from the size learned on earlier runs; False pages by num. Defaults to True.
+        capabilities (CapabilityCache, optional): server_capabilities cache shared by the sites of a run. Defaults to one for dir's sites.db.
     
     Returns:
         None
@@ -2703,18 +3053,22 @@ def index_ebooks(site, library='', start=0, stop=0, dir=data_dir, num=1000, forc
         print("old lib")
         logging.error("old lib: %s", site)
         
-    _uuid=str(uuid.uuid4())
+    # Site databases are keyed by the site's sites.uuid, which index_ebooks_from_library
+    # looks up from the URL, so every run upserts into the same <uuid>.db
+    _uuid=""
+    if capabilities is None:
+        capabilities=calishot_capabilities.CapabilityCache(Path(dir) / "sites.db")
     
     if libs:
         for lib in libs:
-            index_ebooks_from_library(site=site, _uuid=_uuid, library=lib, start=start, stop=stop, dir=dir, num=num, force_refresh=force_refresh)   
+            index_ebooks_from_library(site=site, _uuid=_uuid, library=lib, start=start, stop=stop, dir=dir, num=num, force_refresh=force_refresh, prefetch=prefetch, adaptive=adaptive, capabilities=capabilities)   
     else:
-            index_ebooks_from_library(site=site, _uuid=_uuid, start=start, stop=stop, dir=dir, num=num, force_refresh=force_refresh)   
+            index_ebooks_from_library(site=site, _uuid=_uuid, start=start, stop=stop, dir=dir, num=num, force_refresh=force_refresh, prefetch=prefetch, adaptive=adaptive, capabilities=capabilities)   
 
 #############################
 # Index Ebooks from Library #
 #############################
-def index_ebooks_from_library(site, _uuid="", library='', start=0, stop=0, dir=data_dir, num=1000, force_refresh=False):
+def index_ebooks_from_library(site, _uuid="", library='', start=0, stop=0, dir=data_dir, num=1000, force_refresh=False, prefetch=2, adaptive=True, capabilities=None):
     """
     Indexes ebooks from a library on a specific site.
     
@@ -2727,6 +3081,9 @@ def index_ebooks_from_library(site, _uuid="", library='', start=0, stop=0, dir=d
     - dir: The directory to save the indexed ebooks (optional).
     - num: The maximum number of ebooks to index (optional).
     - force_refresh: Whether to force a refresh of the indexed ebooks (optional).
+    - prefetch: Number of pages fetched ahead while the current page is transformed and saved; 0 disables the pipeline. Incremental passes (with a high-water mark) never fetch ahead (optional).
+    - adaptive: Grow/shrink the page size with the server's response times and errors, persisted per server (optional).
+    - capabilities: CapabilityCache holding the count form and page size of each server (optional).
     
     Returns:
     None
@@ -2762,98 +3119,23 @@ def index_ebooks_from_library(site, _uuid="", library='', start=0, stop=0, dir=d
     # Normalized library identifier to store with each book
     library_id = lib_segment.strip('/') if lib_segment else ''
 
-    # Some servers require sort params even for count queries
-    url=api+f'search{lib_segment}?num=0&sort=timestamp&sort_order=desc'
     print(f"\nGetting ebooks count of library: {lib} from server:{server} ")
     logging.info("Getting ebooks count of library: %s from server: %s ", lib, server)
-    print('URL = ',url)
-    
-    try:
-        r=requests.get(url, verify=False, timeout=(timeout, 30))
-        r.raise_for_status()
-    except requests.RequestException as e: 
-        print("Unable to open site:", url, "-", e)
-        logging.info("Unable to open site: %s - %s", url, e)
-        # Retry once without library segment if it was present
-        if lib_segment:
-            try:
-                fallback_url = api+f'search?num=0&sort=timestamp&sort_order=desc'
-                print('Retrying count without library segment: ', fallback_url)
-                logging.info('Retrying count without library segment: %s', fallback_url)
-                r=requests.get(fallback_url, verify=False, timeout=(timeout, 30))
-                r.raise_for_status()
-                url = fallback_url
-            except Exception as e2:
-                print("Fallback also failed:", e2)
-                logging.info("Fallback also failed: %s", e2)
-                return
-        else:
-            return
-        # pass
-    except Exception as e:
-        print ("Other issue:", e)
-        logging.error("Other issue: %s", e)
-        return
-    except :
-        print("Wazza !!!!")
-        logging.error("Wazza !!!!")
-        sys.exit(1)
-        
-
-    # Get the total number of books from the response
-    try:
-        response_data = r.json()
-        if "total_num" not in response_data:
-            error_msg = f"Invalid response format from {url}. Missing 'total_num' in response: {response_data}"
-            print(error_msg)
-            logging.error(error_msg)
-            return
-            
-        total_num = int(response_data["total_num"])
-        total_num = total_num if not stop else min(total_num, stop)
-        print()    
-        print(f"Total count={total_num} from {server}")
-        logging.info("Total count=%s from %s", total_num, server)
-    except (ValueError, TypeError) as e:
-        error_msg = f"Error parsing 'total_num' from response: {e}. URL: {url}. Response: {response_data}"
-        print(error_msg)
-        logging.error(error_msg)
-        # Retry parsing after requesting without library segment if applicable
-        if lib_segment:
-            try:
-                fallback_url = api+f'search?num=0&sort=timestamp&sort_order=desc'
-                print('Retrying parse with request without library segment: ', fallback_url)
-                logging.info('Retrying parse with request without library segment: %s', fallback_url)
-                r=requests.get(fallback_url, verify=False, timeout=(timeout, 30))
-                r.raise_for_status()
-                response_data = r.json()
-                total_num = int(response_data['total_num']) if 'total_num' in response_data else 0
-                print(f"Total count={total_num} from {server} (fallback)")
-                logging.info("Total count=%s from %s (fallback)", total_num, server)
-            except Exception as e2:
-                print("Fallback parse also failed:", e2)
-                logging.error("Fallback parse also failed: %s", e2)
-                return
-        else:
-            return
 
-    # If count is zero with library segment, try once without segment to accommodate servers
-    if total_num == 0 and lib_segment:
-        try:
-            fallback_url = api+f'search?num=0&sort=timestamp&sort_order=desc'
-            print('Count is 0; retrying count without library segment: ', fallback_url)
-            logging.info('Count is 0; retrying count without library segment: %s', fallback_url)
-            r=requests.get(fallback_url, verify=False, timeout=(timeout, 30))
-            r.raise_for_status()
-            response_data = r.json()
-            total_num = int(response_data['total_num']) if 'total_num' in response_data else 0
-            print(f"Total count (fallback)={total_num} from {server}")
-            logging.info("Total count (fallback)=%s from %s", total_num, server)
-        except Exception as e2:
-            print("Fallback count request failed:", e2)
-            logging.error("Fallback count request failed: %s", e2)
+    # Goes straight to the count endpoint form this server accepted last time
+    if capabilities is None:
+        capabilities=calishot_capabilities.CapabilityCache(Path(dir) / "sites.db")
+    total_num, r, variant=get_library_count(server, library_id, timeout=timeout, dir=dir, capabilities=capabilities)
+    if total_num is None:
+        return
+    library_form=calishot_capabilities.library_form(variant)
+    total_num = total_num if not stop else min(total_num, stop)
+    print()    
+    print(f"Total count={total_num} from {server}")
+    logging.info("Total count=%s from %s", total_num, server)
     
 
+
     # Update book count and calculate new books in sites database
     try:
         sites_db_path = Path(dir) / "sites.db"
@@ -3135,203 +3417,472 @@ def index_ebooks_from_library(site, _uuid="", library='', start=0, stop=0, dir=d
 
     db=init_site_db(site, _uuid=_uuid, dir=dir)
     r_site = (list(db['site'].rows)[0])
-    r_site['version']=r.headers['server']
-    r_site['major']=int(re.search(r'calibre.(\d).*', r.headers['server']).group(1))
+    r_site['version'], r_site['major']=calishot_capabilities.parse_version(r.headers.get('server'))
     db["site"].upsert(r_site, pk='uuid')
 
     print()
 
+    mark=None if force_refresh else calishot_watermark.load(db, lib)
+    tracker=calishot_watermark.Tracker(mark)
+    # Only a complete pass from the newest book may move the high-water mark
+    full_pass=not start and not stop
+    if mark:
+        print(f"High-water mark for library '{lib}': timestamp={mark['timestamp']} last_modified={mark['last_modified']}")
+        logging.info("High-water mark for library '%s': timestamp=%s last_modified=%s", lib, mark['timestamp'], mark['last_modified'])
+
+    checkpoint=calishot_checkpoint.load(db, lib) if full_pass and not force_refresh else None
+    if checkpoint:
+        offset=calishot_checkpoint.resume_offset(checkpoint)
+        if checkpoint['mark']:
+            tracker=calishot_watermark.Tracker(checkpoint['mark'])
+        print(f"Resuming library '{lib}' at offset {offset}/{total_num} (checkpoint of {checkpoint['updated']})")
+        logging.info("Resuming library '%s' at offset %s/%s (checkpoint of %s)", lib, offset, total_num, checkpoint['updated'])
+    # A batch that failed to save must be redone, so the checkpoint stops advancing
+    save_failed=False
+
     range=offset+1
-    while offset < total_num:
-        remaining_num = min(num, total_num - offset)
-        print ('\r {:180.180}'.format(f'Downloading ids: offset={str(offset)} count={str(remaining_num)} from {server}'), end='')
-        logging.info("Downloading ids: offset=%s count=%s from %s", str(offset), str(remaining_num), server)
-        # url=server+base_url+'?num='+str(remaining_num)+'&offset='+str(offset)+'&sort=timestamp&sort_order=desc'
-        url=api+'search'+library+'?num='+str(remaining_num)+'&offset='+str(offset)+'&sort=timestamp&sort_order=desc'
+    first_page=calishot_watermark.FIRST_PAGE if mark and not checkpoint else None
+    times=calishot_pipeline.StageTimes()
 
-        # print("->", url)
+    # Page size learned for this server on earlier runs
+    if adaptive:
+        sizer=calishot_pagesize.PageSizer.learned(capabilities.get(server), num)
+    else:
+        sizer=calishot_pagesize.PageSizer(num, adaptive=False, max_size=num)
+    initial_size=sizer.size
+
+    def fetch_page(job):
+        page_offset, count = job
+        print ('\r {:180.180}'.format(f'Downloading ids: offset={str(page_offset)} count={str(count)} from {server}'), end='')
+        logging.info("Downloading ids: offset=%s count=%s from %s", str(page_offset), str(count), server)
+        print ('\r {:180.180}'.format(f'Downloading metadata from {str(page_offset+1)} to {str(page_offset+count)}/{total_num} from {server}'), end='')
+        logging.info("Downloading metadata from %s to %s/%s from %s", str(page_offset+1), str(page_offset+count), total_num, server)
+        return get_book_range(api, library, page_offset, count, sizer, sort='timestamp', timeout=timeout, library_form=library_form)
+
+    # Books are transformed and saved as they are decoded, one transform batch per worker at a time
+    save_every=calishot_transform.stage.batch_size*max(1, calishot_transform.stage.workers)
+
+    def save_books(raw_books):
+        """Transform and save raw_books. Returns the number of rows saved, None if either failed."""
         try:
-            r=requests.get(url, verify=False, timeout=(timeout, 30))
-            r.raise_for_status()
-        except requests.RequestException as e: 
-            print ("Connection issue:", e)
-            logging.error("Connection issue: %s", e)
-            return
-            # pass
-        except Exception as e:
-            print ("Other issue:", e)
-            logging.error("Other issue: %s", e)
-            return
-            # pass
-        except :
-            print ("Wazza !!!!")
-            logging.error("Wazza !!!!")
-            return
+            with times.stage("transform"):
+                books=calishot_transform.stage.run(raw_books, lib)
+            with times.stage("write"):
+                save_books_metadata_from_site(db, books, replace=True)
+        except BaseException as err:
+            print (err)
+            logging.error(err)
+            return None
+        return len(books)
+
+    # The next pages are requested while the current one is read, transformed and written.
+    # Not on an incremental pass: it usually stops within the first page, and pages
+    # fetched ahead of the watermark would only be thrown away
+    depth=0 if mark else prefetch
+    pages=calishot_pipeline.Prefetcher(fetch_page, sizer.plan(offset, total_num, first_page), depth=depth, times=times)
+    with pages:
+        for (offset, remaining_num), page_books in pages:
+            if page_books is None:
+                if adaptive:
+                    capabilities.put(server, **sizer.state())
+                return
 
-        print ('\r {:180.180}'.format(f'Downloading metadata from {str(offset+1)} to {str(offset+remaining_num)}/{total_num} from {server}'), end='')
-        logging.info("Downloading metadata from %s to %s/%s from %s", str(offset+1), str(offset+remaining_num), total_num, server)
-        books_s=",".join(str(i) for i in r.json()['book_ids'])
-        url=api+'books'+library+'?ids='+books_s
+            ids=[]
+            raw_books=[]
+            saved=0
+            reached_known=False
+            broken=False
+            try:
+                for id, r_book in page_books:
+                    ids.append(id)
+                    uuid=r_book['uuid']
+                    if not uuid:
+                        print ("No uuid for ebook: ignored")
+                        logging.info("No uuid for ebook: ignored")
+                        continue 
+
+                    tracker.observe(r_book)
+                    if calishot_watermark.is_known(mark, r_book):
+                        # Sorted by timestamp desc: everything from here on is already indexed
+                        reached_known=True
+                        range+=1
+                        continue
 
-        try:
-            r = requests.get(url, verify=False, timeout=(60, 60))
-            r.raise_for_status()
-        except requests.RequestException as e:
-            error_msg = f"Error fetching book details from {url}: {str(e)}"
-            print(f"\n❌ {error_msg}")
-            logging.error(error_msg, exc_info=True)
-            return
-        print ('\r {:180.180}'.format(f'{len(r.json())} received'), end='')
-        logging.info("%s received", len(r.json()))        
-        
-        books=[]
-        for id, r_book in r.json().items():                
-            uuid=r_book['uuid']
-            if not uuid:
-                print ("No uuid for ebook: ignored")
-                logging.info("No uuid for ebook: ignored")
-                continue 
+                    if r_book['authors']:
+                        desc= f"({r_book['title']} / {r_book['authors'][0]})"
+                    else:
+                        desc= f"({r_book['title']})"
 
+                    print ('\r {:180.180} '.format(f'{range}/{total_num} ({server} : {uuid} --> {desc}'), end='')
+                    logging.info("%s/%s (%s : %s --> %s)", range, total_num, server, uuid, desc)
 
-            if r_book['authors']:
-                desc= f"({r_book['title']} / {r_book['authors'][0]})"
+                    if not force_refresh:
+                        try:
+                            book = load_metadata(dir, uuid)
+                        except Exception as e:
+                            error_msg = f"Error loading metadata for {uuid}: {str(e)}"
+                            print(f"\n❌ {error_msg}")
+                            logging.error(error_msg, exc_info=True)
+                            range += 1
+                            continue
+                        if book:
+                            print("Metadata already present for:", uuid)
+                            logging.error("Metadata already present for: %s", uuid)
+                            range+=1
+                            continue
+
+                    raw_books.append((id, r_book))
+                    range+=1
+                    if len(raw_books) >= save_every:
+                        count=save_books(raw_books)
+                        raw_books=[]
+                        if count is None:
+                            save_failed=True
+                        else:
+                            saved+=count
+            except (requests.RequestException, ValueError):
+                # Logged by get_book_page; what was decoded is still saved below
+                broken=True
+
+            print ('\r {:180.180}'.format(f'{len(ids)} received'), end='')
+            logging.info("%s received", len(ids))
+
+            print("Saving metadata")
+            logging.info("Saving metadata")
+            print ('\r {:180.180}'.format(f'Saving metadata from {server}'), end='')
+            logging.info("Saving metadata from %s", server)
+            count=save_books(raw_books)
+            if count is None:
+                save_failed=True
             else:
-                desc= f"({r_book['title']})"
+                saved+=count
+                print('\r {:180.180}'.format(f'--> Saved {range-1}/{total_num} ebooks from {server}'), end='')
+                logging.info("--> Saved %s/%s ebooks from %s", range-1, total_num, server)
+            if broken:
+                if adaptive:
+                    capabilities.put(server, **sizer.state())
+                return
+            if full_pass and not save_failed:
+                calishot_checkpoint.save(db, lib, offset+remaining_num, total_num, ids, tracker.mark())
 
-            print ('\r {:180.180} '.format(f'{range}/{total_num} ({server} : {uuid} --> {desc}'), end='')
-            logging.info("%s/%s (%s : %s --> %s)", range, total_num, server, uuid, desc)
+            print()
+            print()
 
-            if not force_refresh:
-                try:
-                    book = load_metadata(dir, uuid)
-                except Exception as e:
-                    error_msg = f"Error loading metadata for {uuid}: {str(e)}"
-                    print(f"\n❌ {error_msg}")
-                    logging.error(error_msg, exc_info=True)
-                    range += 1
-                    continue
-                if book:
-                    print("Metadata already present for:", uuid)
-                    logging.error("Metadata already present for: %s", uuid)
-                    range+=1
-                    continue
+            offset=offset+remaining_num
+            if reached_known:
+                print(f"Reached already indexed books of library '{lib}' at offset {offset}: {saved} new")
+                logging.info("Reached already indexed books of library '%s' at offset %s: %s new", lib, offset, saved)
+                break
 
-            if not r_book['formats']:
-                # print("No format found for {}".format(r_book['uuid']))
-                range+=1
-                continue
+    print(f"Library '{lib}' stage timings (prefetch={depth}): {times.report()}")
+    logging.info("Library '%s' stage timings (prefetch=%s): %s", lib, depth, times.report())
+    if adaptive:
+        print(f"Page size for {server}: {initial_size} -> {sizer.size} (grown {sizer.grown}x, shrunk {sizer.shrunk}x)")
+        logging.info("Page size for %s: %s -> %s (grown %sx, shrunk %sx)", server, initial_size, sizer.size, sizer.grown, sizer.shrunk)
+        capabilities.put(server, **sizer.state())
 
-            book={}
-            book['uuid']=r_book['uuid']
-            book['id']=id
-            book['library']=lib
+    if mark and not index_changed_books(db, api, library, lib, mark, tracker, num=sizer.size, timeout=timeout, library_form=library_form):
+        return
+    if full_pass and not save_failed:
+        calishot_watermark.save(db, lib, tracker.mark())
+        calishot_checkpoint.clear(db, lib)
 
-            # book['title']=r_book['title']
-            book['title']=unidecode.unidecode(r_book['title'])
-            # book['authors']=r_book['authors']
+##########################
+# Get Library Book Count #
+##########################
+def get_library_count(server, library='', timeout=15, dir=data_dir, capabilities=None):
+    """
+    Gets the number of books of a library, using the count endpoint form the server accepted before.
 
-            if r_book['authors']:
-                book['authors']=[unidecode.unidecode(s) for s in r_book['authors']]
-            # book['desc']=""
+    The forms (library in the path or as library_id=, with or without an explicit empty
+    query, global search) are only probed again when the remembered one fails. The form
+    that answers is saved in the server_capabilities table of sites.db with the server's
+    version. A global count standing in for a named library is used but never remembered,
+    since it is the default library's count.
 
-            book['desc']=r_book['comments']
+    Parameters:
+        server (str): The server base URL.
+        library (str): Library name, '' for the default library.
+        timeout (int): Connect timeout in seconds.
+        dir (str): The directory containing sites.db.
+        capabilities (CapabilityCache, optional): The cache to use. Defaults to one for dir's sites.db.
 
-            if r_book['series']:
-                book['series']=unidecode.unidecode(r_book['series'])
-                # book['series']=[unidecode.unidecode(s) for s in r_book['series']]
-            s_i=r_book['series_index']
-            if (s_i): 
-                book['series_index']=int(s_i)
+    Returns:
+        tuple: (total_num, response, variant), or (None, None, None) if no form answered.
+    """
+    logging.info("****Get Library Count Function****")
+    api=server.rstrip('/')+'/ajax/'
+    cache=capabilities or calishot_capabilities.CapabilityCache(Path(dir) / "sites.db")
+    entry=cache.get(server)
+    preferred=entry['count_variant'] if entry else None
+    if preferred:
+        logging.info("Using remembered count endpoint '%s' for %s", preferred, server)
+
+    for variant in calishot_capabilities.variants_for(library, preferred):
+        url=calishot_capabilities.count_url(api, library, variant)
+        print('URL = ',url)
+        try:
+            r=calishot_http.get(url, verify=False, timeout=(timeout, 30))
+            r.raise_for_status()
+            total_num=calishot_capabilities.total_from(r.json())
+        except (requests.ConnectionError, requests.Timeout) as e:
+            # The server itself is unreachable; other URL forms will not help
+            print("Unable to open site:", url, "-", e)
+            logging.info("Unable to open site: %s - %s", url, e)
+            return None, None, None
+        except (requests.RequestException, ValueError) as e:
+            print("Count request failed:", url, "-", e)
+            logging.info("Count request failed: %s - %s", url, e)
+            continue
+        if total_num is None:
+            logging.info("No total in response from %s", url)
+            continue
+        if total_num == 0 and library and variant not in calishot_capabilities.GLOBAL_VARIANTS:
+            # Some servers answer 0 for a library segment they do not understand
+            logging.info("Count is 0 for %s; trying the next endpoint form", url)
+            continue
 
-            # book['edition']=0
+        if variant == preferred:
+            cache.hits+=1
+        else:
+            cache.probes+=1
+        if variant != preferred and (not library or variant not in calishot_capabilities.GLOBAL_VARIANTS):
+            version, major=calishot_capabilities.parse_version(r.headers.get('server'))
+            cache.put(server, count_variant=variant, library_form=calishot_capabilities.library_form(variant),
+                      version=version, major=major)
+            logging.info("Remembered count endpoint '%s' for %s (%s)", variant, server, version)
+        return total_num, r, variant
+
+    print("Unable to determine total book count from any endpoint form:", server, library)
+    logging.error("All count endpoint forms failed for %s (lib=%s)", server, library)
+    return None, None, None
 
-            book['identifiers']=r_book['identifiers']
+########################
+# Index Changed Ebooks #
+########################
+def index_changed_books(db, api, library, lib, mark, tracker, num=1000, timeout=15, library_form='path'):
+    """
+    Re-fetches the already indexed books that were modified since the high-water mark.
 
-            # book['tags']=r_book['tags']
-            if r_book['tags']:
-                book['tags']=[unidecode.unidecode(s) for s in r_book['tags']]
+    Pages through the library sorted by last_modified desc and stops at the first
+    book that has not changed since mark, so an unchanged library costs one small page.
 
-            book['publisher']=r_book['publisher']
-            # book['publisher']=unidecode.unidecode(r_book['publisher'])
+    Parameters:
+        db (Database): The site database.
+        api (str): The server's /ajax/ base URL.
+        library (str): Library path segment ('/name' or '').
+        lib (str): Library name stored with each book.
+        mark (dict): High-water mark loaded from calishot_watermark.
+        tracker (Tracker): Collects the new mark.
+        num (int): Maximum page size.
+        timeout (int): Connect timeout in seconds.
+        library_form (str): How the server addresses libraries ('path' or 'library_id').
 
-            book['pubdate']=r_book['pubdate']
+    Returns:
+        bool: False if a request failed.
+    """
+    logging.info("****Index Changed Books Function****")
+    offset=0
+    page=calishot_watermark.FIRST_PAGE
+    changed=[]
+    while True:
+        page_books=get_book_page(api, library, offset, page, sort='last_modified', timeout=timeout, library_form=library_form)
+        if page_books is None:
+            return False
+        received=0
+        done=False
+        try:
+            for id, r_book in page_books:
+                received+=1
+                if not r_book.get('uuid'):
+                    continue
+                tracker.observe(r_book)
+                if not calishot_watermark.is_changed(mark, r_book):
+                    done=True
+                    continue
+                # New books were already saved by the timestamp pass
+                if not calishot_watermark.is_known(mark, r_book):
+                    continue
+                changed.append((id, r_book))
+        except (requests.RequestException, ValueError):
+            return False
+        if done or received < page:
+            break
+        offset+=page
+        page=min(num, page*2)
 
-            if not r_book['languages']:
-            # if True:
-                text=r_book['title']+". "
-                if r_book['comments']:
-                    text=r_book['comments']                    
-                s_language, prob=identifier.classify(text)
-                if prob >= 0.85:
-                    language =  iso639.to_iso639_2(s_language)
-                    book['language']=language
-                else:
-                    book['language']=''
-            else:
-                book['language']=iso639.to_iso639_2(r_book['languages'][0])
+    print(f"{len(changed)} modified books in library '{lib}'")
+    logging.info("%s modified books in library '%s'", len(changed), lib)
+    if changed:
+        try:
+            changed=calishot_transform.stage.run(changed, lib)
+            save_books_metadata_from_site(db, changed, replace=True)
+        except BaseException as err:
+            print (err)
+            logging.error(err)
+            return False
+    return True
 
-            if r_book['cover']:
-                book['cover']= True
-            else:
-                book['cover']= False
+#####################
+# Get a Page of Ids #
+#####################
+def get_book_page(api, library, offset, count, sort='timestamp', timeout=15, attempts=3, library_form='path', sizer=None):
+    """
+    Fetches one page of book ids and opens the request for their metadata.
 
-            book['last_modified']=r_book['last_modified']
-            book['timestamp']=r_book['timestamp']
+    Each request is retried with jittered exponential backoff before the page is given up.
+    The metadata is not read here: the books are decoded one by one as the caller iterates,
+    so a page is never held whole in memory.
 
-            book['formats']=[]
-            formats=r_book['formats']
-            for f in formats:                    
-                if 'size' in r_book['format_metadata'][f]:
-                    size=int(r_book['format_metadata'][f]['size'])
-                else:
-                    # print()
-                    # print(f"Size not found for format '{f}'  uuid={uuid}: skipped")
-                    pass
-                    #TODO query the size when the function to rebuild the full url is ready
-                    #   
-                    # print("Trying to get size online: {}".format('url'))
-                    # try:
-                    #     size=get_file_size(s['url'])
-                    # except:
-                    #     print("Unable to access size for format '{}' : {} skipped".format(f, uuid))
-                    #     continue
-                book[f]=(size)
-                book['formats'].append(f)
+    Parameters:
+        api (str): The server's /ajax/ base URL.
+        library (str): Library path segment ('/name' or '').
+        offset (int): Offset of the first id.
+        count (int): Number of ids to fetch.
+        sort (str): Sort field, always descending. Defaults to 'timestamp'.
+        timeout (int): Connect timeout in seconds.
+        attempts (int): Tries per request. Defaults to 3.
+        library_form (str): 'path' (/search/<lib>) or 'library_id' (?library_id=<lib>). Defaults to 'path'.
+        sizer (PageSizer, optional): Told how long the metadata request took, or that it timed out,
+            broke off or got a 5xx; an adaptive sizer also makes a too-large metadata request fail after one try.
 
-            if not book['formats']:
-            # if not c_format:
-                # print()
-                # print(f"No format found for {book['uuid']} id={book['id']} : skipped")
-                range+=1
-                # continue
+    Returns:
+        iterator: (id, book) pairs of the /ajax/books response, or None if a request failed.
+        Iterating raises requests.RequestException or ValueError if the response breaks off.
+    """
+    url=calishot_capabilities.library_url(api, 'search', library, library_form)+'num='+str(count)+'&offset='+str(offset)+'&sort='+sort+'&sort_order=desc'
+    try:
+        r=calishot_http.get_with_backoff(url, attempts=attempts, verify=False, timeout=(timeout, 30))
+    except requests.RequestException as e: 
+        print ("Connection issue:", e)
+        logging.error("Connection issue: %s", e)
+        return None
+    except Exception as e:
+        print ("Other issue:", e)
+        logging.error("Other issue: %s", e)
+        return None
 
+    book_ids=r.json()['book_ids']
+    if not book_ids:
+        return iter(())
+    books_s=",".join(str(i) for i in book_ids)
+    url=calishot_capabilities.library_url(api, 'books', library, library_form)+'ids='+books_s
 
-            books.append(book)
-            range+=1
+    # Shrinking the page is the better retry while it can still get smaller
+    if sizer is not None and sizer.adaptive and count > sizer.min_size:
+        attempts=1
+    start=time.perf_counter()
+    try:
+        r = calishot_http.get_with_backoff(url, attempts=attempts, verify=False, timeout=(60, 60), stream=True)
+    except requests.RequestException as e:
+        error_msg = f"Error fetching book details from {url[:200]}: {str(e)}"
+        print(f"\n❌ {error_msg}")
+        logging.error(error_msg, exc_info=True)
+        # A 4xx would fail at any size
+        if sizer is not None and calishot_http.overloaded(e):
+            sizer.failed(len(book_ids))
+        return None
+    return _stream_book_page(r, url, len(book_ids), time.perf_counter()-start, sizer)
 
-        # print()
-        print("Saving metadata")
-        logging.info("Saving metadata")
-        print ('\r {:180.180}'.format(f'Saving metadata from {server}'), end='')
-        logging.info("Saving metadata from %s", server)
-        try:
-            save_books_metadata_from_site(db, books)
-            print('\r {:180.180}'.format(f'--> Saved {range-1}/{total_num} ebooks from {server}'), end='')
-            logging.info("--> Saved %s/%s ebooks from %s", range-1, total_num, server)
-        except BaseException as err:
-            print (err)
-            logging.error(err)
+def _stream_book_page(r, url, count, elapsed, sizer):
+    """
+    Yields the (id, book) members of an /ajax/books response as they arrive, then closes it.
 
-        print()
-        print()
+    Parameters:
+        r (Response): The streamed response.
+        url (str): Its URL, for the error message.
+        count (int): Number of ids requested.
+        elapsed (float): Seconds until the response headers arrived.
+        sizer (PageSizer, optional): Told how long the request took, or that it failed.
+    """
+    # Books are decoded one by one as the body arrives; the response is parsed once
+    # and never held whole as bytes, text and tree at the same time
+    stream=calishot_jsonstream.JSONObjectStream(r.iter_content(chunk_size=65536))
+    members=iter(stream)
+    try:
+        while True:
+            # Only the time spent reading counts, not the caller's work between books
+            start=time.perf_counter()
+            member=next(members, None)
+            elapsed+=time.perf_counter()-start
+            if member is None:
+                break
+            yield member
+    except (requests.RequestException, ValueError) as e:
+        error_msg = f"Error fetching book details from {url[:200]}: {str(e)}"
+        print(f"\n❌ {error_msg}")
+        logging.error(error_msg, exc_info=True)
+        if sizer is not None:
+            sizer.failed(count)
+        raise
+    finally:
+        r.close()
+    if sizer is not None:
+        sizer.observe(count, elapsed, stream.bytes)
+
+#####################################
+# Get a Range of Ids, Adaptive Size #
+#####################################
+def _open_book_page(api, library, offset, end, sizer, **kwargs):
+    """Opens the page at offset at the sizer's size, smaller after each failure. Returns (page, size); page is None if it failed at the minimum size."""
+    while True:
+        size=min(sizer.size, end-offset)
+        page=get_book_page(api, library, offset, size, sizer=sizer, **kwargs)
+        if page is None and sizer.size < size:
+            logging.info("Retrying offset %s with page size %s", offset, sizer.size)
+            continue
+        return page, size
 
-        # try:
-        #     save_metadata(db, books)
-        # except:
-        #     print("Unable to save book metadata")
+def get_book_range(api, library, offset, count, sizer, sort='timestamp', timeout=15, library_form='path'):
+    """
+    Fetches count books from offset in pages of the sizer's current size.
+
+    A page whose metadata request times out or fails is retried at the reduced size
+    instead of repeating the same oversized request; only a failure at the minimum size gives up.
+    The first page is requested right away; the books are decoded as they are iterated.
+
+    Parameters:
+        api (str): The server's /ajax/ base URL.
+        library (str): Library path segment ('/name' or '').
+        offset (int): Offset of the first id.
+        count (int): Number of ids to fetch.
+        sizer (PageSizer): The server's page size.
+        sort (str): Sort field, always descending. Defaults to 'timestamp'.
+        timeout (int): Connect timeout in seconds.
+        library_form (str): 'path' or 'library_id'. Defaults to 'path'.
+
+    Returns:
+        iterator: (id, book) pairs of the whole range, each id once, or None if the first page failed
+        at the minimum size. Iterating raises requests.RequestException or ValueError if a later one does.
+    """
+    kwargs={"sort": sort, "timeout": timeout, "library_form": library_form}
+    end=offset+count
+    page, size=_open_book_page(api, library, offset, end, sizer, **kwargs)
+    if page is None:
+        return None
+    return _book_range(api, library, offset, end, sizer, page, size, kwargs)
+
+def _book_range(api, library, offset, end, sizer, page, size, kwargs):
+    """Yields the books of page, then of the following pages up to end (see get_book_range)."""
+    # A page that broke off is read again at a smaller size: its first books come twice
+    seen=set()
+    while True:
+        try:
+            for id, book in page:
+                if id not in seen:
+                    seen.add(id)
+                    yield id, book
+            offset+=size
+        except (requests.RequestException, ValueError):
+            if sizer.size >= size:
+                raise
+            logging.info("Retrying offset %s with page size %s", offset, sizer.size)
+        if offset >= end:
+            return
+        page, size=_open_book_page(api, library, offset, end, sizer, **kwargs)
+        if page is None:
+            raise requests.RequestException(f"Page at offset {offset} failed at page size {size}")
 
-        offset=offset+num
-        
 ###########################
 # Query Books in Database #
 ###########################
@@ -3367,93 +3918,91 @@ def query(query_str="", dir=data_dir):
 ###########################
 # Get Stats on EBook Type #
 ###########################
-def get_stats(dir=data_dir):
+def get_stats(dir=data_dir, recompute=False, workers=None):
     """
     Retrieves statistics about the ebooks in the specified directory.
 
+    Totals are read from each site database's format_stats table, kept up to
+    date by triggers as books are saved, so this reads a few rows per site
+    database instead of scanning every book.
+
     Parameters:
         dir (str): The directory to search for ebooks. Defaults to the current directory.
+        recompute (bool): Rebuild every format_stats from ebook_formats first, on a process pool. Defaults to False.
+        workers (int, optional): Processes for recompute, 0 runs inline. Defaults to CALISHOT_STATS_WORKERS.
 
     Returns:
-        None
+        dict: {format: (files, bytes)} over every site database.
     """
     logging.info("****Get Stats Function****")
-    dbs=[]
-    size=0
-    count=0
-    for f in os.listdir(dir):
-        if not f.endswith(".db"):
-            continue
-        if f == "index.db":
-            continue
-        path = Path(dir) / f 
-        dbs.append(Database(path))
+    paths=site_db_paths(dir)
+    if recompute:
+        start=time.perf_counter()
+        per_site=calishot_formats.recompute_all(paths, workers)
+        print(f"Statistics of {len(paths)} site database(s) recomputed in {time.perf_counter() - start:.1f}s")
+        logging.info("Statistics of %s site database(s) recomputed", len(paths))
+    else:
+        per_site={}
+        for path in paths:
+            try:
+                db=Database(path)
+                calishot_formats.ensure(db)
+                per_site[path]=calishot_formats.totals(db)
+                db.conn.close()
+            except Exception as e:
+                per_site[path]=e
 
-    for db in dbs:
-        for i, ebook in enumerate(db["ebooks"].rows):
-            uuid=ebook['uuid']
-            title=ebook['title']
-            formats=json.loads(ebook['formats'])
-            # print(formats)
-            for f in formats:
-                if f in ebook:
-                    if ebook[f]:
-                        size+=ebook[f]
-                        count+=1
-                        # print (f'\r{count} {f} --> {uuid}: {title}', end ='')
-                        # print (f'\r{count} : {uuid} --> {f}', end='')
-                        print (f'\r{count} formats - ebook : {uuid}', end='')
-                        logging.info("Found %s (%s)", title, uuid)
+    totals={}
+    for path, site_totals in per_site.items():
+        if isinstance(site_totals, Exception):
+            print("Pb with:", path.name)
+            logging.error("Pb with: %s (%s)", path.name, site_totals)
+            continue
+        for f, (count, size) in site_totals.items():
+            total_count, total_size=totals.get(f, (0, 0))
+            totals[f]=(total_count+count, total_size+size)
 
+    count=sum(c for c, _ in totals.values())
+    size=sum(b for _, b in totals.values())
     print()
+    for f, (f_count, f_size) in sorted(totals.items(), key=lambda t: -t[1][1]):
+        print(f"{f:>8}: {humanize.intcomma(f_count)} files, {hsize(f_size)}")
+    logging.info("Formats: %s", {f: (c, hsize(b)) for f, (c, b) in totals.items()})
     print("Total count of formats:", humanize.intcomma(count)) 
     logging.info("Total count of formats: %s", humanize.intcomma(count))
     print("Total size:", hsize(size)) 
     logging.info("Total size: %s", hsize(size))
     print()
+    return totals
 
 #######################
 # Initialize Index.db #
 #######################
-def init_index_db(dir=data_dir):
+def init_index_db(dir=data_dir, name="index.db"):
     """
     Initializes an index database in the specified directory.
     
     Args:
         dir (str): The directory where the index database should be created. Defaults to the current directory.
+        name (str): The file name, e.g. index.db.building for a shadow build. Defaults to index.db.
         
     Returns:
         Database: The initialized index database.
     """
     
     logging.info("****Initialize Index Function****")
-    path = Path(dir) / "index.db" 
+    path = Path(dir) / name 
     
     db_index = Database(path)
-    if not "summary" in db_index.table_names():
-        db_index["summary"].create({
-        "uuid": str,
-        "cover": str,
-        "title": str,
-        # "source": str
-        "authors": str,
-        "year": str,
-        "series": str,
-        "language": str,
-        "links": str,
-        # "desc": str,
-        "publisher": str,
-        "tags": str,
-        "identifiers": str,
-        "formats": str
-        }
-        # )
-        , pk="uuid")
+    # books/book_sites/book_formats/sites read through the summary view; migrates older layouts
+    if calishot_indexlayout.ensure(db_index):
+        print("index.db layout upgraded, every site will be read again")
+        logging.info("index.db layout upgraded, every site will be read again")
 
-        # db_index.table("index", pk="uuid")
-        # db_index.table("summary").enable_fts(["title"])
-        # db_index["summary"].enable_fts(["title", "authors", "series", "uuid", "language", "identifiers", "tags", "publisher", "formats", "pubdate"])
-        db_index["summary"].enable_fts(["title", "authors", "series", "language", "identifiers", "tags", "publisher", "formats", "year"])
+    # External-content FTS5 kept in step by triggers; migrates an index.db from enable_fts
+    if calishot_fts.ensure(db_index):
+        print("summary_fts created")
+        logging.info("summary_fts created")
 
     return db_index
 
@@ -3472,141 +4021,164 @@ def get_img_url(db, book):
         str: The URL of the image.
     """
     logging.info("****Get Img URL Function****")
-    url = json.loads(list(db['site'].rows)[0]["urls"])[0]
-
-    library=book['library']
-    id_=str(book['id'])
-
-    f_urls=[]
-
-    major=  list(db['site'].rows)[0]["major"]
-
-    if major >= 3:
-        d_url =url+"/get/thumb/"+id_+"/"+library+ "?sz=600x800"
-    else:
-        # d_url =url+"/get/thumb/"+id_
-        d_url =url+"/get/thumb_90_120/"+id_
-
-    return d_url
+    return calishot_siteurls.img_url(calishot_siteurls.from_site_db(db), book)
 
 ################
 # Build Index  #
 ################
-def build_index(dir=data_dir):
+def build_index(dir=data_dir, full=False, workers=None, shadow=False, keep=None):
     """
-    Builds an index for English ebooks in the given directory.
+    Builds or updates the index of the ebooks of every site database in the given directory.
+
+    Only the site databases that changed since the last build are read, and only
+    their new or modified rows are merged; books that left a site are removed
+    (see calishot_indexsync). Site databases are cut into rowid chunks that a pool
+    of reader processes turns into book rows, while this process alone writes
+    them to index.db in large transactions. Chunks are written in site and rowid
+    order whatever the number of readers, so the index comes out the same.
+    With shadow=True the live index.db is left alone while a copy is built, then
+    swapped in atomically (see calishot_indexswap).
 
     Args:
         dir (str): The directory to search for ebook databases. Defaults to the current directory.
-        english (bool): Flag to indicate whether to include only English ebooks in the index. Defaults to True.
+        full (bool): Ignore the per-site marks and re-read every book. Defaults to False.
+        workers (int, optional): Reader processes, 0 reads inline. Defaults to CALISHOT_INDEX_WORKERS.
+        shadow (bool): Build into index.db.building and swap it in. Defaults to False.
+        keep (int, optional): Previous generations kept by a shadow build. Defaults to CALISHOT_INDEX_GENERATIONS.
 
     Returns:
-        None
+        dict: Counts of sites read/skipped/removed and of rows upserted/deleted.
     """
     dir=data_dir
     logging.info("****Build Index Function****")
-    dbs=[]
-    for f in os.listdir(dir):
-        if not f.endswith(".db"):
+    if workers is None:
+        workers=calishot_indexsync.WORKERS
+    if keep is None:
+        keep=calishot_indexswap.GENERATIONS
+    stats={"read": 0, "skipped": 0, "sources_removed": 0, "upserted": 0, "deleted": 0}
+    paths=site_db_paths(dir)
+    index_path=str(Path(dir) / "index.db")
+
+    if shadow:
+        if (not full and os.path.exists(index_path) and calishot_indexlayout.BOOKS in Database(index_path).table_names()
+                and calishot_indexsync.up_to_date(Database(index_path), paths)):
+            stats["skipped"]=len(paths)
+            print("index.db is up to date")
+            logging.info("index.db is up to date")
+            return stats
+        building=calishot_indexswap.start(index_path)
+        db_index = init_index_db(dir=dir, name=Path(building).name)
+        calishot_indexswap.prepare(db_index.conn)
+    else:
+        db_index = init_index_db(dir=dir)
+        # Only shadow builds replay the log
+        calishot_indexlayout.trim_writes(db_index.conn)
+    calishot_indexsync.ensure(db_index)
+    marks = calishot_indexsync.load(db_index)
+
+    for source in sorted(set(marks) - {p.stem for p in paths}):
+        deleted=calishot_indexsync.delete_source(db_index, source)
+        stats["sources_removed"]+=1
+        stats["deleted"]+=deleted
+        print(f"{source}: gone, {deleted} book(s) removed")
+        logging.info("%s: gone, %s book(s) removed", source, deleted)
+
+    # Plan: which rowid chunks of which site databases to read
+    jobs=[]
+    pending={}
+    writer=calishot_indexsync.IndexWriter(db_index, txn_rows=calishot_indexsync.TXN_ROWS)
+    for p in paths:
+        source=p.stem
+        mark=None if full else marks.get(source)
+        try:
+            mtime=calishot_indexsync.file_mtime(p)
+            if mark and mark['mtime'] == mtime:
+                stats["skipped"]+=1
+                continue
+            db = Database(p.resolve())
+            state=calishot_indexsync.site_state(db)
+            if calishot_indexsync.unchanged(mark, state):
+                calishot_indexsync.save(db_index, source, mtime, state)
+                stats["skipped"]+=1
+                continue
+            # Readers take the sizes from ebook_formats; migrate a site db from before it
+            calishot_formats.ensure(db)
+            deleted=0
+            if source in marks:
+                deleted=calishot_indexsync.delete_missing(db_index, source, p)
+            where, params=calishot_indexsync.changed_filter(mark, state)
+            chunks=calishot_indexsync.plan_chunks(db, where, params, calishot_indexsync.CHUNK_ROWS)
+            site_id=calishot_indexsync.register_site(db_index, source, calishot_siteurls.from_site_db(db))
+            db.conn.close()
+        except Exception as e:
+            print ("Pb with:", p.name)
+            logging.error("Pb with: %s (%s)", p.name, e)
             continue
-        if f in ("index.db", "sites.db"):
+        stats["read"]+=1
+        stats["deleted"]+=deleted
+        if deleted:
+            print(f"{source}: {deleted} book(s) removed")
+            logging.info("%s: %s book(s) removed", source, deleted)
+        if not chunks:
+            writer.mark(source, mtime, state)
             continue
-        p = Path(dir) / f 
-        print(f)
+        pending[site_id]={"source": source, "chunks": len(chunks), "books": 0, "mtime": mtime, "state": state}
+        for lo, hi in chunks:
+            jobs.append((str(p.resolve()), site_id, lo, hi, where, params))
+
+    pool=calishot_procpool.ProcessPool(calishot_indexsync.read_summaries, workers, name="Index reader")
+
+    def read(job):
+        # Errors travel as values: an exception would end the Prefetcher's iteration
         try:
-            db = Database(p.resolve())
-        except:
-            print ("Pb with:", f)
-            logging.info("Pb with: %s", f)
-        dbs.append(db)
-    
-    db_index = init_index_db(dir=dir)
-    index_t=db_index["summary"]
+            return "ok", pool.call(*job)
+        except Exception as e:
+            return "error", e
 
-    batch_size=10000
     count=0
-    summaries=[]
-
-    for db in dbs:
-        for i, ebook in enumerate(db["ebooks"].rows):
-#            if english and (not ebook['language'] or ebook['language'] != "eng"):
-#                continue
-#            elif not english and ebook['language'] == "eng":
-#                continue
-
-            if ebook['authors']: 
-                ebook['authors']=formats=json.loads(ebook['authors'])
-            # if ebook['series']:    
-            #     ebook['series']=formats=json.loads(ebook['series'])
-            if ebook['identifiers']:
-                ebook['identifiers']=formats=json.loads(ebook['identifiers'])
-            if ebook['tags']: 
-                ebook['tags']=formats=json.loads(ebook['tags'])
-            ebook['formats']=formats=json.loads(ebook['formats'])
-            ebook['links']=""
-            summary = {k: v for k, v in ebook.items() if k in ("uuid","title", "authors", "series", "language", "formats", "tags", "publisher", "identifiers")}
-            # summary = {k: v for k, v in ebook.items() if k in ("uuid","title", "authors", "series", "identifiers", "language", "tags", "publisher", "formats")}
-            summary['title']={'href': get_desc_url(db, ebook), 'label': ebook['title']}
-
-            summary["cover"]= {"img_src": get_img_url(db, ebook), "width": 90}
-
-            formats=[]
-            for f in ebook['formats']:
-                formats.append({'href': get_format_url(db, ebook, f), 'label': f"{f} ({hsize(ebook[f])})"})
-            summary['links']=formats
-            
-            pubdate=ebook['pubdate'] 
-            summary['year']=pubdate[0:4] if pubdate else "" 
-            summaries.append(summary)
-            # print(summary)
-            logging.info("Summary: %s", summary)
-            count+=1
-            print (f"\r{count} - ebook handled: {ebook['uuid']}", end='')
-            logging.info(f"\r{count} - ebook handled: {ebook['uuid']}")
-            if not count % batch_size:
-                # print()
-                # print(f"Saving summary by batch: {len(summaries)}")    
-                # print(summaries)
-                # Prefer upsert to avoid UNIQUE constraint errors when merging multiple site DBs
-                try:
-                    index_t.upsert_all(summaries, batch_size=batch_size, pk='uuid')
-                except Exception as e:
-                    print()
-                    print("Upsert batch failed; attempting insert_all as fallback (may hit UNIQUE errors)")
-                    logging.error("Upsert batch failed: %s", e)
-                    try:
-                        index_t.insert_all(summaries, batch_size=batch_size)
-                    except Exception as e2:
-                        print("insert_all also failed:", e2)
-                        logging.error("insert_all also failed: %s", e2)
+    failed=set()
+    try:
+        # At most 2 chunks per reader are read ahead of the writer
+        with calishot_pipeline.Prefetcher(read, jobs, depth=2 * pool.workers) as prefetch:
+            for job, (status, rows) in prefetch:
+                site_pending=pending[job[1]]
+                source=site_pending["source"]
+                if source in failed:
+                    continue
+                if status != "ok":
+                    # No mark saved: the next build reads this site again
+                    failed.add(source)
                     print()
+                    print(f"{source}: index update failed: {rows}")
+                    logging.error("%s: index update failed: %s", source, rows)
+                    continue
+                writer.add(rows)
+                site_pending["books"]+=len(rows)
+                site_pending["chunks"]-=1
+                count+=len(rows)
+                print (f"\r{count} - ebooks handled", end='')
+                if not site_pending["chunks"]:
+                    writer.mark(source, site_pending["mtime"], site_pending["state"])
+                    stats["upserted"]+=site_pending["books"]
+                    logging.info("%s: %s book(s) updated", source, site_pending["books"])
+        writer.flush()
+    finally:
+        pool.close()
+    print()
 
-                # print("Saved")
-                # print()
-                summaries=[]
+    print(f"Index: {stats['read']} site(s) read, {stats['skipped']} unchanged, {stats['sources_removed']} gone; "
+          f"{stats['upserted']} book(s) updated, {stats['deleted']} removed "
+          f"({writer.commits} transaction(s), {pool.workers} reader(s))")
+    logging.info("Index: %s", stats)
 
-    # print()
-    # print("saving summary")    
-    # Final flush: upsert remaining rows by uuid
-    try:
-        index_t.upsert_all(summaries, batch_size=batch_size, pk='uuid')
-    except Exception as e:
-        print("Final upsert failed; attempting insert_all:", e)
-        logging.error("Final upsert failed: %s", e)
-        try:
-            index_t.insert_all(summaries, batch_size=batch_size)
-        except Exception as e2:
-            print("Final insert_all failed:", e2)
-            logging.error("Final insert_all failed: %s", e2)
-    # print("summary done")
-    # print()
-    
-    print()
-    print("fts")
-    logging.error("fts")
-    index_t.populate_fts(["title", "authors", "series", "identifiers", "language", "tags", "publisher", "formats", "year"])
-    print("fts done")
-    logging.error("fts done")
+    if shadow:
+        db_index.conn.close()
+        calishot_indexswap.finish(building, [calishot_fts.TABLE])
+        generation, replayed=calishot_indexswap.swap(index_path, building, keep)
+        print(f"index.db replaced, {replayed} write(s) made during the build carried over"
+              + (f", previous one kept as {Path(generation).name}" if generation else ""))
+        logging.info("index.db replaced, %s write(s) carried over, previous: %s", replayed, generation)
+    return stats
 
 ############################
 # Search books in Index.db #
@@ -3631,9 +4203,11 @@ def search(query_str, dir=data_dir, links_only=False):
     # print(rows)
     sites=set()
     ebook_ids=[]
-    for ebook in db_index["summary"].search(query_str):
-        sites.add(ebook[-1])
-        ebook_ids.append((ebook[3], ebook[-1]))
+    # summary is a view: search its FTS index (over books) directly
+    for ebook in db_index.query("SELECT uuid, source FROM summary WHERE rowid IN "
+                                "(SELECT rowid FROM summary_fts WHERE summary_fts MATCH ?)", [query_str]):
+        sites.add(ebook['source'])
+        ebook_ids.append((ebook['uuid'], ebook['source']))
         # print (ebook)
     # print("sites:", sites) 
     # print("ebooks:", ebook_ids) 
@@ -3693,6 +4267,7 @@ def index_to_json(dir=data_dir):
 
     try: 
         for row in db["summary"].rows:
+            row.pop('rowid', None)
             if row['title']:
                 row['title']=json.loads(row['title'])
             if row['authors']:
@@ -3766,46 +4341,30 @@ def init_diff_db(dir=data_dir):
 #######################
 def diff(old, new, dir=data_dir, ):
     """
-    Generate the function comment for the given function body in a markdown code block with the correct language syntax.
+    Compare two index.db snapshots and write the NEW, MOVED, CHANGED and REMOVED books to diff.db.
 
-    :param old: The old value.
-    :param new: The new value.
-    :param dir: The directory where the files are located. Defaults to ".".
+    The comparison runs in SQL on both snapshots attached to diff.db (see
+    calishot_indexdiff); the previous diff is replaced.
+
+    :param old: The old index.db file name.
+    :param new: The new index.db file name.
+    :param dir: The directory where the files are located. Defaults to data_dir.
+    :return: {status: books}, or None when a snapshot cannot be compared.
     """
     logging.info("****Diff Function****")
-    path = Path(dir) / old 
-    db_old = Database(path)
-
-    path = Path(dir) /  new 
-    db_new = Database(path)
-
-    path = Path(dir) / "diff.db"
-    db_diff =init_diff_db(dir)
-
-    for i, n_book in enumerate(db_new["summary"].rows):
-        n_uuid = n_book['uuid']
-        print(i, n_uuid)
-        logging.info("%s %s", i, n_uuid)
-        try:
-            o_book = db_old["summary"].get(n_uuid)
-            # print(n_uuid, '=OK')
-            o_loc=json.loads(o_book['title'])['href']
-            n_loc=json.loads(n_book['title'])['href']
-            if o_loc != n_loc :
-                print(n_uuid, 'MOVED')
-                logging.info("%s MOVED", n_uuid)
-                n_book["status"]="MOVED"
-                n_book["old_location"]=o_loc
-                n_book.pop ('cover', None)
-                db_diff["summary"].insert(n_book, pk='uuid')                  
-        except:
-            # print(n_uuid, '=NOK')
-            n_book.pop ('cover', None)
-            logging.error("%s =NOK", n_uuid)
-            n_book["status"]="NEW"
-            logging.error("%s NEW", n_uuid)
-            db_diff["summary"].insert(n_book, pk='uuid')
-            logging.error("%s inserted", n_uuid)
+    db_diff = init_diff_db(dir)
+    start = time.perf_counter()
+    try:
+        counts = calishot_indexdiff.compare(db_diff, Path(dir) / old, Path(dir) / new)
+    except (ValueError, sqlite3.Error) as e:
+        print(f"Diff failed: {e}")
+        logging.error("Diff of %s and %s failed: %s", old, new, e)
+        return None
+    elapsed = time.perf_counter() - start
+    summary = ", ".join(f"{status}: {count}" for status, count in counts.items())
+    print(f"Diff {old} -> {new}: {summary} ({elapsed:.1f}s)")
+    logging.info("Diff %s -> %s: %s (%.1fs)", old, new, summary, elapsed)
+    return counts
 
 
 ############################
@@ -0,0 +1,124 @@
+"""
+Shared fixtures.
+
+functions.py reads config.ini, opens data/sites.db and starts logging when it
+is imported, so it is imported once from a scratch directory; every test then
+runs in a directory of its own with an empty data/ (functions uses the
+relative ./data/ path).
+
+The import patches the standard library for gevent unless CALISHOT_CONCURRENCY
+is off, so these tests run with it off; gevent_run runs code with gevent in a
+process of its own.
+"""
+
+import os
+import sqlite3
+import subprocess
+import sys
+import threading
+from pathlib import Path
+
+import pytest
+
+from benchmarks import fake_calibre
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def record(book_id, lm="2020-01-01T00:00:00+00:00", title=None, fmts=("epub", "pdf")):
+    """An /ajax/books record of book book_id, uuid u-<book_id>."""
+    return {
+        "uuid": f"u-{book_id:07d}", "title": title or f"Book number {book_id}",
+        "authors": [f"Author {book_id % 53}"], "comments": "", "series": "S" if book_id % 3 else None,
+        "series_index": 1.0, "identifiers": {"isbn": f"978{book_id:010d}"}, "tags": ["fiction"],
+        "publisher": "Fake Press", "pubdate": "2001-01-01T00:00:00+00:00", "languages": ["eng"],
+        "cover": f"/get/cover/{book_id}/main", "last_modified": lm, "timestamp": "2020-01-01T00:00:00+00:00",
+        "formats": list(fmts), "format_metadata": {f: {"size": 1000 + book_id} for f in fmts},
+    }
+
+
+@pytest.fixture(scope="session")
+def functions(tmp_path_factory):
+    folder = tmp_path_factory.mktemp("import")
+    (folder / "data").mkdir()
+    (folder / "config.ini").write_text("[shodan]\napi_key = test-dummy-key\n")
+    # Blocking I/O: the tests never reach the network
+    os.environ.setdefault("CALISHOT_CONCURRENCY", "off")
+    cwd = os.getcwd()
+    os.chdir(folder)
+    try:
+        import functions
+    finally:
+        os.chdir(cwd)
+    return functions
+
+
+@pytest.fixture
+def workdir(functions, tmp_path, monkeypatch):
+    (tmp_path / "data").mkdir()
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def gevent_run(workdir):
+    """gevent_run(code): run code after importing functions with gevent, in a subprocess in workdir. Returns its stdout."""
+    (workdir / "config.ini").write_text("[shodan]\napi_key = test-dummy-key\n")
+    env = {k: v for k, v in os.environ.items() if k != "CALISHOT_CONCURRENCY"}
+    env["PYTHONPATH"] = os.pathsep.join([str(ROOT)] + [p for p in [env.get("PYTHONPATH")] if p])
+
+    def run(code):
+        prelude = "import functions\nfrom gevent import monkey\nassert monkey.is_module_patched('socket')\n"
+        done = subprocess.run([sys.executable, "-c", prelude + code], cwd=workdir, env=env,
+                              capture_output=True, text=True, timeout=120)
+        assert done.returncode == 0, done.stderr[-3000:]
+        return done.stdout
+    return run
+
+
+@pytest.fixture
+def make_site(functions, workdir):
+    """make_site(name, url, major=5): a site database data/<name>.db."""
+    def make(name, url, major=5):
+        db = functions.init_site_db(url, _uuid=name, dir="./data/")
+        db["site"].update(name, {"major": major, "version": f"{major}.0"})
+        return db
+    return make
+
+
+@pytest.fixture
+def add_books(functions):
+    """add_books(db, ids, lib="main", lm=, title=, fmts=): save record(i) of each id into a site database."""
+    import calishot_transform
+
+    def add(db, ids, lib="main", **kw):
+        books = [calishot_transform.book_from_calibre(str(i), record(i, **kw), lib) for i in ids]
+        functions.save_books_metadata_from_site(db, books, replace=True)
+    return add
+
+
+@pytest.fixture
+def index_db(workdir):
+    """index_db(): a fresh sqlite3 connection to data/index.db."""
+    connections = []
+
+    def connect():
+        conn = sqlite3.connect(Path(workdir) / "data" / "index.db")
+        connections.append(conn)
+        return conn
+    yield connect
+    for conn in connections:
+        conn.close()
+
+
+@pytest.fixture
+def calibre():
+    """A fake Calibre server with 1000 books, served from a thread: (url, state)."""
+    server, state = fake_calibre.make_server(books=1000)
+    # Connections the client drops at the end are not errors here
+    server.handle_error = lambda request, client_address: None
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}", state
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,62 @@
+import pytest
+import requests
+
+import calishot_pagesize
+from conftest import record
+
+
+def fake_pages(broken_at=None):
+    """get_book_page stand-in over ids 0..999 whose first page breaks off after broken_at books."""
+    calls = []
+
+    def get_book_page(api, library, offset, count, sizer=None, **kwargs):
+        calls.append((offset, count))
+
+        def page():
+            for i in range(offset, min(offset + count, 1000)):
+                if broken_at is not None and len(calls) == 1 and i - offset == broken_at:
+                    sizer.failed()
+                    raise requests.ConnectionError("connection reset")
+                yield str(i), record(i)
+        return page()
+    return get_book_page, calls
+
+
+def test_book_range_reads_a_broken_page_again_smaller(functions, monkeypatch):
+    get_book_page, calls = fake_pages(broken_at=30)
+    monkeypatch.setattr(functions, "get_book_page", get_book_page)
+    sizer = calishot_pagesize.PageSizer(400)
+
+    ids = [id for id, book in functions.get_book_range("http://x/ajax/", "", 0, 600, sizer)]
+    assert ids == [str(i) for i in range(600)]
+    assert calls == [(0, 400), (0, 200), (200, 200), (400, 200)]
+
+
+def test_book_range_gives_up_at_the_minimum_size(functions, monkeypatch):
+    get_book_page, calls = fake_pages(broken_at=30)
+    monkeypatch.setattr(functions, "get_book_page", get_book_page)
+    sizer = calishot_pagesize.PageSizer(50)
+
+    books = functions.get_book_range("http://x/ajax/", "", 0, 600, sizer)
+    with pytest.raises(requests.RequestException):
+        list(books)
+    assert calls == [(0, 50)]
+
+
+def response(status, body=b"{}"):
+    r = requests.Response()
+    r.status_code, r._content, r.url = status, body, "http://x/ajax/"
+    return r
+
+
+@pytest.mark.parametrize("status,size", [(404, 400), (500, 200)])
+def test_only_a_5xx_of_the_books_request_shrinks_the_page(functions, monkeypatch, status, size):
+    def get_with_backoff(url, **kwargs):
+        if "/search" in url:
+            return response(200, b'{"book_ids": [%s]}' % ",".join(map(str, range(400))).encode())
+        response(status).raise_for_status()
+    monkeypatch.setattr(functions.calishot_http, "get_with_backoff", get_with_backoff)
+    sizer = calishot_pagesize.PageSizer(400)
+
+    assert functions.get_book_page("http://x/ajax/", "", 0, 400, sizer=sizer) is None
+    assert sizer.size == size
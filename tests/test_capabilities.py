@@ -0,0 +1,37 @@
+import requests
+
+import calishot_capabilities
+import calishot_writer
+
+
+class FakeResponse:
+    headers = {"server": "calibre 6.11.0"}
+
+    def __init__(self, data):
+        self.data = data
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.data
+
+
+def test_counts_are_remembered_through_the_writer(functions, workdir, monkeypatch):
+    def get(url, **kwargs):
+        # Only the library_id= form knows the library
+        if "library_id=Main" not in url:
+            raise requests.HTTPError("404")
+        return FakeResponse({"total_num": 42})
+    monkeypatch.setattr(functions.calishot_http, "get", get)
+
+    path = workdir / "data" / "sites.db"
+    with calishot_writer.SitesWriter(path) as sink:
+        cache = calishot_capabilities.CapabilityCache(path, writer=sink)
+        assert functions.get_library_count("http://a:8080", "Main", capabilities=cache)[0] == 42
+        assert functions.get_library_count("http://a:8080", "Main", capabilities=cache)[0] == 42
+        assert (cache.hits, cache.probes) == (1, 1)
+        assert cache.get("http://a:8080/")["count_variant"] == "library_id"
+
+    saved = calishot_capabilities.CapabilityCache(path).get("http://a:8080")
+    assert (saved["count_variant"], saved["library_form"], saved["major"]) == ("library_id", "library_id", 6)
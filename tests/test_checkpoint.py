@@ -0,0 +1,23 @@
+import calishot_checkpoint
+
+
+def test_interrupted_pass_resumes_at_the_last_committed_page(functions, workdir, calibre, monkeypatch):
+    url, state = calibre
+    functions.init_sites_db("./data/")["sites"].insert({"uuid": "fake", "url": url})
+    # No waiting between the retries of the failing page
+    monkeypatch.setattr(functions.calishot_http.random, "uniform", lambda a, b: 0)
+
+    state.fail_books_after = 3
+    functions.index_ebooks(url, num=100, prefetch=0, adaptive=False)
+    db = functions.Database("data/fake.db")
+    checkpoint = calishot_checkpoint.load(db, "main")
+    assert (checkpoint["offset"], checkpoint["total"], len(checkpoint["last_ids"])) == (300, 1000, 100)
+    assert db["ebooks"].count == 300
+
+    state.fail_books_after = None
+    calls = state.calls["books"]
+    functions.index_ebooks(url, num=100, prefetch=0, adaptive=False)
+    # The last committed page is read again, then the 700 books left
+    assert state.calls["books"] - calls == 8
+    assert db["ebooks"].count == 1000
+    assert calishot_checkpoint.load(db, "main") is None
@@ -0,0 +1,57 @@
+import os
+
+import pytest
+from sqlite_utils import Database
+
+import calishot_formats
+
+
+def test_format_stats_triggers_match_a_recompute(functions, make_site, add_books, workdir):
+    db = make_site("siteA", "http://10.0.0.1:8080")
+    path = str(workdir / "data" / "siteA.db")
+
+    def check():
+        kept = calishot_formats.totals(db)
+        assert kept == calishot_formats.recompute(path)
+        return kept
+
+    add_books(db, [1, 2, 3])
+    assert check() == {"epub": (3, 3006), "pdf": (3, 3006)}
+
+    # Replaced books: pdf dropped from 1, mobi added to 2, sizes follow the new record
+    add_books(db, [1], fmts=("epub",))
+    add_books(db, [2], fmts=("epub", "pdf", "mobi"))
+    assert check() == {"epub": (3, 3006), "mobi": (1, 1002), "pdf": (2, 2005)}
+
+    # Size changed in place, unknown size, book deleted
+    db.execute("UPDATE ebook_formats SET size = 10 WHERE uuid = 'u-0000003' AND format = 'epub'")
+    db.execute("UPDATE ebook_formats SET size = NULL WHERE uuid = 'u-0000002' AND format = 'mobi'")
+    db.execute("DELETE FROM ebooks WHERE uuid = 'u-0000001'")
+    db.conn.commit()
+    assert check() == {"epub": (2, 1012), "mobi": (1, 0), "pdf": (2, 2005)}
+
+    assert functions.get_stats(dir="./data/") == {"epub": (2, 1012), "mobi": (1, 0), "pdf": (2, 2005)}
+    assert functions.get_stats(dir="./data/", recompute=True, workers=0) == {"epub": (2, 1012), "mobi": (1, 0), "pdf": (2, 2005)}
+
+
+@pytest.mark.parametrize("source_newer", [True, False])
+def test_compaction_keeps_the_formats_of_the_newer_copy(functions, make_site, add_books, workdir, source_newer):
+    functions.init_sites_db("./data/").table("sites", pk="uuid").insert({"uuid": "siteA", "url": "http://10.0.0.1:8080"})
+    target = make_site("siteA", "http://10.0.0.1:8080")
+    add_books(target, [1, 2, 3])
+    target.close()
+    # A duplicate from another run, with books 2 and 3 changed
+    source = make_site("dup", "http://10.0.0.1:8080")
+    add_books(source, [2, 3, 4], fmts=("epub",))
+    source.close()
+    os.utime(workdir / "data" / ("siteA.db" if source_newer else "dup.db"), (1_000_000, 1_000_000))
+
+    assert functions.compact_site_dbs(dir="./data/")["merged_files"] == 1
+    assert not (workdir / "data" / "dup.db").exists()
+    db = Database(workdir / "data" / "siteA.db")
+    changed = "epub" if source_newer else "epub,pdf"
+    assert db.execute("SELECT uuid, group_concat(format) FROM (SELECT * FROM ebook_formats ORDER BY format) "
+                      "GROUP BY uuid ORDER BY uuid").fetchall() == [
+        ("u-0000001", "epub,pdf"), ("u-0000002", changed), ("u-0000003", changed), ("u-0000004", "epub")]
+    assert calishot_formats.totals(db) == calishot_formats.recompute(str(workdir / "data" / "siteA.db"))
+    assert calishot_formats.totals(db)["epub"] == (4, 4010)
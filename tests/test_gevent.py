@@ -0,0 +1,12 @@
+from sqlite_utils import Database
+
+
+def test_check_calibre_list_with_gevent(functions, workdir, gevent_run, calibre):
+    url, state = calibre
+    Database(workdir / "data" / "sites.db")["sites"].insert({"uuid": "fake", "url": url}, pk="uuid")
+
+    gevent_run("functions.check_calibre_list(check_all=True)")
+
+    row = Database(workdir / "data" / "sites.db")["sites"].get("fake")
+    assert (row["status"], row["book_count"], row["libraries_count"]) == ("online", 1000, 1)
+    assert state.calls["search"] >= 1
@@ -0,0 +1,15 @@
+import urllib.request
+
+
+def test_incremental_pass_does_not_fetch_past_the_watermark(functions, workdir, calibre):
+    url, state = calibre
+    functions.init_sites_db("./data/")["sites"].insert({"uuid": "fake", "url": url})
+    functions.index_ebooks(url, num=100)
+    urllib.request.urlopen(f"{url}/_add?n=5").read()
+
+    before = dict(state.calls)
+    functions.index_ebooks(url, num=100, prefetch=2)
+    calls = {k: state.calls[k] - before.get(k, 0) for k in ("search", "books")}
+    # The count, one page of new books, and the modified-books pass
+    assert calls == {"search": 3, "books": 2}
+    assert functions.Database("data/fake.db")["ebooks"].count == 1005
@@ -0,0 +1,31 @@
+import shutil
+
+
+def test_diff_reports_new_removed_moved_and_changed(functions, make_site, add_books, index_db):
+    a = make_site("siteA", "http://10.0.0.1:8080")
+    b = make_site("siteB", "http://10.0.0.2:8080")
+    add_books(a, [1, 2, 3, 4])
+    functions.build_index(workers=0)
+    # Written through the view: no content_hash, same content
+    conn = index_db()
+    conn.execute("INSERT INTO summary (uuid, title) VALUES ('u-0000001', 'Book number 1')")
+    conn.commit()
+    conn.close()
+    shutil.copy("data/index.db", "data/old.db")
+
+    add_books(a, [2], title="A new edition")
+    add_books(a, [5])
+    a["ebooks"].delete("u-0000004")
+    a["ebooks"].delete("u-0000003")
+    add_books(b, [3])
+    functions.build_index(workers=0)
+
+    assert functions.diff("old.db", "index.db") == {"NEW": 1, "MOVED": 1, "CHANGED": 1, "REMOVED": 1}
+    rows = functions.init_diff_db().execute(
+        "SELECT uuid, status, old_location, json_extract(title, '$.label') FROM summary ORDER BY uuid").fetchall()
+    assert rows == [
+        ("u-0000002", "CHANGED", None, "A new edition"),
+        ("u-0000003", "MOVED", "http://10.0.0.1:8080#book_id=3&library_id=main&panel=book_details", "Book number 3"),
+        ("u-0000004", "REMOVED", None, "Book number 4"),
+        ("u-0000005", "NEW", None, "Book number 5"),
+    ]
@@ -0,0 +1,53 @@
+def test_book_locations_lists_every_copy(functions, make_site, add_books, index_db):
+    a = make_site("siteA", "http://10.0.0.1:8080")
+    b = make_site("siteB", "http://10.0.0.1:9090")
+    add_books(a, [1, 2])
+    add_books(b, [2, 3], fmts=("mobi",))
+    functions.build_index(workers=0)
+
+    conn = index_db()
+    query = "SELECT uuid, format, href, size FROM book_locations WHERE host = ? AND port = ? ORDER BY uuid, format"
+    assert conn.execute(query, ["10.0.0.1", 8080]).fetchall() == [
+        ("u-0000001", "epub", "http://10.0.0.1:8080/get/epub/1/main", 1001),
+        ("u-0000001", "pdf", "http://10.0.0.1:8080/get/pdf/1/main", 1001),
+        ("u-0000002", "epub", "http://10.0.0.1:8080/get/epub/2/main", 1002),
+        ("u-0000002", "pdf", "http://10.0.0.1:8080/get/pdf/2/main", 1002),
+    ]
+    # u-0000002 was written by siteB last, and is still listed on siteA above
+    assert conn.execute(query, ["10.0.0.1", 9090]).fetchall() == [
+        ("u-0000002", "mobi", "http://10.0.0.1:9090/get/mobi/2/main", 1002),
+        ("u-0000003", "mobi", "http://10.0.0.1:9090/get/mobi/3/main", 1003),
+    ]
+    plan = " ".join(row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + query, ["10.0.0.1", 8080]))
+    assert "idx_sites_host" in plan and "idx_book_sites_site" in plan
+
+
+def test_summary_view_round_trip_through_its_insert_trigger(functions, make_site, add_books, index_db):
+    a = make_site("siteA", "http://10.0.0.1:8080")
+    add_books(a, [1, 2])
+    functions.build_index(workers=0)
+
+    conn = index_db()
+    row = conn.execute("SELECT json_extract(title, '$.href'), json_extract(title, '$.label'), authors, "
+                       "json_extract(cover, '$.img_src'), json_extract(links, '$[0].href'), "
+                       "json_extract(links, '$[0].label'), formats FROM summary WHERE uuid = 'u-0000001'").fetchone()
+    assert row == ("http://10.0.0.1:8080#book_id=1&library_id=main&panel=book_details", "Book number 1",
+                   '["Author 1"]', "http://10.0.0.1:8080/get/thumb/1/main?sz=600x800",
+                   "http://10.0.0.1:8080/get/epub/1/main", "epub (1.0 kB)", '["epub", "pdf"]')
+    assert conn.execute("SELECT content_hash FROM books WHERE uuid = 'u-0000001'").fetchone()[0] is not None
+
+    # demeter's bookkeeping: the columns given replace the stored ones, the others are kept
+    conn.execute("INSERT OR REPLACE INTO summary (uuid, title, authors, formats) VALUES (?, ?, ?, ?)",
+                 ("u-0000001", '{"href": "x", "label": "Renamed"}', "Someone", '["epub"]'))
+    conn.execute("INSERT INTO summary (uuid, title, authors, formats) VALUES ('h-1', 'Unknown Title', 'X', 'epub')")
+    conn.commit()
+
+    row = conn.execute("SELECT json_extract(title, '$.label'), authors, series, json_array_length(links), "
+                       "source FROM summary WHERE uuid = 'u-0000001'").fetchone()
+    assert row == ("Renamed", "Someone", "S", 1, "siteA")
+    assert conn.execute("SELECT title, content_hash FROM books WHERE uuid = 'u-0000001'").fetchone() == ("Renamed", None)
+    # A book of no site renders without URLs
+    assert conn.execute("SELECT title, cover, links, source FROM summary WHERE uuid = 'h-1'").fetchone() == (
+        "Unknown Title", None, None, None)
+    assert conn.execute("SELECT uuid, title FROM summary_writes WHERE uuid IS NOT NULL ORDER BY id").fetchall() == [
+        ("u-0000001", '{"href": "x", "label": "Renamed"}'), ("h-1", "Unknown Title")]
@@ -0,0 +1,41 @@
+import os
+import sqlite3
+
+import pytest
+
+import calishot_indexswap
+
+
+def test_shadow_build_carries_over_live_writes(functions, make_site, add_books, index_db, monkeypatch):
+    a = make_site("siteA", "http://10.0.0.1:8080")
+    add_books(a, [1, 2])
+    functions.build_index(workers=0)
+    add_books(a, [3])
+    stale = index_db()
+    stale.execute("SELECT COUNT(*) FROM summary").fetchone()
+
+    start = calishot_indexswap.start
+
+    def start_then_write(path):
+        building = start(path)
+        # Demeter recording downloads while the copy is being built
+        live = sqlite3.connect(path)
+        live.execute("INSERT INTO summary (uuid, title, authors, formats) VALUES ('h-1', 'Unknown Title', 'X', 'epub')")
+        live.execute("INSERT OR REPLACE INTO summary (uuid, title, authors, formats) VALUES ('u-0000001', 'Kept', 'Y', 'epub')")
+        live.commit()
+        live.close()
+        return building
+    monkeypatch.setattr(calishot_indexswap, "start", start_then_write)
+    functions.build_index(workers=0, shadow=True)
+
+    assert os.path.isfile("data/index.db") and not os.path.islink("data/index.db")
+    assert not os.path.exists("data/index.db.building")
+    assert len(calishot_indexswap.generations("data/index.db")) == 1
+    conn = index_db()
+    assert conn.execute("SELECT title, authors FROM summary WHERE uuid = 'h-1'").fetchone() == ("Unknown Title", "X")
+    assert conn.execute("SELECT json_extract(title, '$.label'), authors FROM summary WHERE uuid = 'u-0000001'").fetchone() == (
+        "Kept", "Y")
+    assert conn.execute("SELECT COUNT(*) FROM summary").fetchone()[0] == 4
+    # A connection to the previous file cannot write into it any more
+    with pytest.raises(sqlite3.OperationalError):
+        stale.execute("INSERT INTO summary (uuid, title) VALUES ('h-2', 'Lost')")
@@ -0,0 +1,87 @@
+import json
+import os
+
+import calishot_indexsync
+
+
+def build(functions):
+    return functions.build_index(workers=0)
+
+
+def located(index_db, uuid):
+    """(source, links hrefs) of a book in the summary view, or None."""
+    row = index_db().execute("SELECT source, links FROM summary WHERE uuid = ?", [uuid]).fetchone()
+    return row and (row[0], [link["href"] for link in json.loads(row[1])])
+
+
+def test_changed_filter():
+    state = {"row_count": 3, "max_rowid": 9, "max_last_modified": "2021", "site_key": "k"}
+    assert calishot_indexsync.changed_filter(None, state) == ("1", [])
+    assert calishot_indexsync.changed_filter(dict(state, site_key="other"), state) == ("1", [])
+    assert calishot_indexsync.changed_filter(dict(state, max_rowid=5), state) == (
+        "(rowid > ? OR last_modified > ?)", [5, "2021"])
+    assert calishot_indexsync.unchanged(state, dict(state))
+    assert not calishot_indexsync.unchanged(state, dict(state, row_count=4))
+
+
+def test_incremental_build_reads_only_changes(functions, make_site, add_books, index_db):
+    a = make_site("siteA", "http://10.0.0.1:8080")
+    add_books(a, range(1, 101))
+    assert build(functions)["upserted"] == 100
+    assert build(functions)["skipped"] == 1
+
+    add_books(a, [5], lm="2021-01-01T00:00:00+00:00", title="Zebra")
+    add_books(a, [101])
+    a.execute("DELETE FROM ebooks WHERE uuid = 'u-0000010'")
+    a.conn.commit()
+    stats = build(functions)
+    assert (stats["upserted"], stats["deleted"]) == (2, 1)
+
+    conn = index_db()
+    assert conn.execute("SELECT COUNT(*) FROM books").fetchone()[0] == 100
+    assert json.loads(conn.execute("SELECT title FROM summary WHERE uuid = 'u-0000005'").fetchone()[0])["label"] == "Zebra"
+    assert conn.execute("SELECT uuid FROM summary_fts JOIN books ON books.id = summary_fts.rowid "
+                        "WHERE summary_fts MATCH 'Zebra'").fetchall() == [("u-0000005",)]
+
+
+def test_delete_missing_keeps_mirror_copies(functions, make_site, add_books, index_db):
+    a = make_site("siteA", "http://10.0.0.1:8080")
+    b = make_site("siteB", "http://10.0.0.2:8080")
+    add_books(a, range(1, 11))
+    add_books(b, range(6, 16), fmts=("mobi",))
+    build(functions)
+    # siteB is read last: it wrote the shared books
+    assert located(index_db, "u-0000006") == ("siteB", ["http://10.0.0.2:8080/get/mobi/6/main"])
+    assert index_db().execute("SELECT COUNT(*) FROM book_sites WHERE uuid = 'u-0000006'").fetchone()[0] == 2
+
+    b.execute("DELETE FROM ebooks WHERE uuid IN ('u-0000006', 'u-0000015')")
+    b.conn.commit()
+    assert build(functions)["deleted"] == 1
+    assert located(index_db, "u-0000006") == (
+        "siteA", ["http://10.0.0.1:8080/get/epub/6/main", "http://10.0.0.1:8080/get/pdf/6/main"])
+    assert located(index_db, "u-0000015") is None
+
+    a.execute("DELETE FROM ebooks WHERE uuid = 'u-0000006'")
+    a.conn.commit()
+    assert build(functions)["deleted"] == 1
+    conn = index_db()
+    assert located(index_db, "u-0000006") is None
+    for table in ("books", "book_sites", "book_formats"):
+        assert conn.execute(f"SELECT COUNT(*) FROM {table} WHERE uuid = 'u-0000006'").fetchone()[0] == 0
+
+
+def test_delete_source_keeps_mirror_copies(functions, make_site, add_books, index_db):
+    a = make_site("siteA", "http://10.0.0.1:8080")
+    b = make_site("siteB", "http://10.0.0.2:8080")
+    add_books(a, range(1, 11))
+    add_books(b, range(6, 16))
+    build(functions)
+    b.conn.close()
+    os.remove("data/siteB.db")
+
+    stats = build(functions)
+    assert (stats["sources_removed"], stats["deleted"]) == (1, 5)
+    conn = index_db()
+    assert conn.execute("SELECT COUNT(*), MIN(source), MAX(source) FROM summary").fetchone() == (10, "siteA", "siteA")
+    assert conn.execute("SELECT COUNT(*) FROM book_sites").fetchone()[0] == 10
+    assert conn.execute("SELECT source FROM sites").fetchall() == [("siteA",)]
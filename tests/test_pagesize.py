@@ -0,0 +1,47 @@
+import datetime
+
+import calishot_pagesize
+
+
+def read_all(sizer, total, limit):
+    """Page through total ids on a server that fails calls above limit. Returns the call sizes, failures negative."""
+    calls, offset = [], 0
+    while offset < total:
+        count = min(sizer.size, total - offset)
+        if count > limit:
+            sizer.failed(count)
+            calls.append(-count)
+            continue
+        sizer.observe(count, 0.5, count * 1000)
+        calls.append(count)
+        offset += count
+    return calls
+
+
+def test_the_next_run_starts_under_the_ceiling_and_does_not_ratchet_down():
+    cold = calishot_pagesize.PageSizer(1000)
+    assert min(read_all(cold, 5000, 300)) < 0
+    state = cold.state()
+    assert state["page_ceiling"] > 300 >= state["page_size"] > 250
+
+    warm = calishot_pagesize.PageSizer.learned(state, 1000)
+    calls = read_all(warm, 5000, 300)
+    assert min(calls) > 0 and len(calls) == 18
+    assert warm.state() == state
+
+
+def test_a_failed_prefetched_page_sets_the_ceiling_from_its_own_size():
+    sizer = calishot_pagesize.PageSizer(400)
+    assert sizer.failed(400)
+    # A page of 400 that was already in flight fails too
+    assert sizer.failed(400)
+    assert (sizer.size, sizer.ceiling) == (200, 400)
+    assert not sizer.failed(calishot_pagesize.MIN_PAGE)
+
+
+def test_an_old_ceiling_is_forgotten():
+    old = (datetime.datetime.utcnow() - datetime.timedelta(days=calishot_pagesize.CEILING_DAYS + 1)).isoformat()
+    sizer = calishot_pagesize.PageSizer.learned({"page_size": 280, "page_ceiling": 320, "page_ceiling_at": old}, 1000)
+    assert sizer.ceiling is None and sizer.size == 280
+    sizer.observe(280, 0.5, 1000)
+    assert sizer.size == 420
@@ -0,0 +1,97 @@
+import socket
+
+import pytest
+from sqlite_utils import Database
+
+import calishot_preprobe
+import calishot_writer
+
+
+@pytest.fixture
+def unanswered():
+    """The port of a listening socket whose accept queue is full, so that connects to it time out."""
+    server = socket.create_server(("127.0.0.1", 0), backlog=0)
+    port = server.getsockname()[1]
+    queued = []
+    for _ in range(2):
+        client = socket.socket()
+        client.setblocking(False)
+        client.connect_ex(("127.0.0.1", port))
+        queued.append(client)
+    yield port
+    for client in queued:
+        client.close()
+    server.close()
+
+
+def test_a_refused_connect_marks_the_host_down(functions, workdir):
+    listening = socket.create_server(("127.0.0.1", 0))
+    closed = socket.create_server(("127.0.0.1", 0))
+    up_port, down_port = listening.getsockname()[1], closed.getsockname()[1]
+    closed.close()
+
+    sites = [
+        {"uuid": "up", "url": f"http://127.0.0.1:{up_port}"},
+        {"uuid": "down", "url": f"http://127.0.0.1:{down_port}/", "failed_attempts": 1},
+        # Left to the HTTP probe: one to be deleted, one without a usable url
+        {"uuid": "last", "url": f"http://127.0.0.1:{down_port}", "failed_attempts": calishot_preprobe.MAX_FAILED_ATTEMPTS},
+        {"uuid": "bad", "url": "not a url"},
+    ]
+    db = functions.init_sites_db("./data/")
+    db["sites"].insert_all(sites, pk="uuid", alter=True)
+    try:
+        with calishot_writer.SitesWriter(workdir / "data" / "sites.db") as sink:
+            reachable = functions.preprobe_sites(sites, sink, timeout=2)
+    finally:
+        listening.close()
+
+    assert [s["uuid"] for s in reachable] == ["up", "last", "bad"]
+    row = db["sites"].get("down")
+    assert (row["status"], row["failed_attempts"]) == ("down", 2)
+    assert row["error_message"].startswith(f"connect to 127.0.0.1:{down_port} failed")
+    assert row["last_failed"] and row["next_check_at"]
+    assert db["sites"].get("up")["status"] is None
+
+
+def test_a_connect_timeout_marks_the_host_down(functions, workdir, unanswered):
+    listening = socket.create_server(("127.0.0.1", 0))
+    sites = [
+        {"uuid": "up", "url": f"http://127.0.0.1:{listening.getsockname()[1]}"},
+        {"uuid": "slow", "url": f"http://127.0.0.1:{unanswered}"},
+    ]
+    db = functions.init_sites_db("./data/")
+    db["sites"].insert_all(sites, pk="uuid", alter=True)
+    try:
+        with calishot_writer.SitesWriter(workdir / "data" / "sites.db") as sink:
+            reachable = functions.preprobe_sites(sites, sink, timeout=1)
+    finally:
+        listening.close()
+
+    assert [s["uuid"] for s in reachable] == ["up"]
+    row = db["sites"].get("slow")
+    assert (row["status"], row["failed_attempts"]) == ("down", 1)
+    assert row["error_message"] == f"connect to 127.0.0.1:{unanswered} failed: timed out after 1s"
+
+
+def test_the_http_pass_skips_the_hosts_the_preprobe_marks_down_with_gevent(functions, workdir, gevent_run,
+                                                                           calibre, unanswered):
+    url, state = calibre
+    closed = socket.create_server(("127.0.0.1", 0))
+    refused = closed.getsockname()[1]
+    closed.close()
+    sites = Database(workdir / "data" / "sites.db")["sites"]
+    sites.insert_all([
+        {"uuid": "up", "url": url},
+        {"uuid": "refused", "url": f"http://127.0.0.1:{refused}"},
+        {"uuid": "slow", "url": f"http://127.0.0.1:{unanswered}"},
+    ], pk="uuid")
+
+    gevent_run("functions.check_calibre_list(check_all=True)")
+
+    assert (sites.get("up")["status"], sites.get("up")["book_count"]) == ("online", 1000)
+    # The HTTP probe would have replaced the pre-probe's error with its own
+    for uuid, reason in (("refused", "Connect call failed"), ("slow", "timed out after 3.0s")):
+        row = sites.get(uuid)
+        assert (row["status"], row["failed_attempts"]) == ("down", 1)
+        assert row["error_message"].startswith(f"connect to {row['url'][len('http://'):]} failed")
+        assert reason in row["error_message"]
@@ -0,0 +1,52 @@
+import asyncio
+import threading
+import time
+
+from aiohttp import web
+
+import calishot_probe
+
+
+def test_names_of_one_server_share_its_limit_and_results_are_saved_off_the_loop(monkeypatch):
+    in_flight = {"now": 0, "max": 0}
+
+    async def handler(request):
+        in_flight["now"] += 1
+        in_flight["max"] = max(in_flight["max"], in_flight["now"])
+        await asyncio.sleep(0.02)
+        in_flight["now"] -= 1
+        if request.path.endswith("library-info"):
+            return web.json_response({"library_map": {"a": "A", "b": "B", "c": "C"}})
+        return web.json_response({"total_num": 7})
+
+    getaddrinfo = asyncio.BaseEventLoop.getaddrinfo
+
+    async def fake_getaddrinfo(self, host, *args, **kwargs):
+        # Both .test names point at the test server
+        return await getaddrinfo(self, "127.0.0.1" if host.endswith(".test") else host, *args, **kwargs)
+    monkeypatch.setattr(asyncio.BaseEventLoop, "getaddrinfo", fake_getaddrinfo)
+
+    saved = []
+
+    def on_result(site, res, library_counts):
+        time.sleep(0.05)  # a blocking sqlite write
+        saved.append((site["uuid"], res["status"], library_counts, threading.current_thread() is threading.main_thread()))
+
+    async def run():
+        app = web.Application()
+        app.router.add_get("/{tail:.*}", handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        server = web.TCPSite(runner, "127.0.0.1", 0)
+        await server.start()
+        port = runner.addresses[0][1]
+        try:
+            sites = [{"uuid": name, "url": f"http://{name}.test:{port}"} for name in ("one", "two")]
+            return await calishot_probe.probe_sites(sites, on_result=on_result, concurrency=10, per_ip=1)
+        finally:
+            await runner.cleanup()
+
+    assert asyncio.run(run()) == 2
+    assert in_flight["max"] == 1
+    counts = {"a": 7, "b": 7, "c": 7}
+    assert sorted(saved) == [("one", "online", counts, False), ("two", "online", counts, False)]
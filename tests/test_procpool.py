@@ -0,0 +1,53 @@
+import concurrent.futures
+import os
+import sys
+
+import pytest
+
+import calishot_procpool
+
+
+def reverse(text, fail=None):
+    if fail == "raise":
+        raise KeyError(text)
+    if fail == "exit":
+        os._exit(3)
+    return text[::-1]
+
+
+def loaded(name):
+    return name in sys.modules
+
+
+def test_pool_returns_results_and_worker_errors():
+    pool = calishot_procpool.ProcessPool(reverse, 2)
+    try:
+        big = "ab" * 2_000_000
+        with concurrent.futures.ThreadPoolExecutor(4) as threads:
+            assert list(threads.map(pool.call, [big] * 4)) == [big[::-1]] * 4
+        with pytest.raises(KeyError):
+            pool.call("x", "raise")
+        with pytest.raises(concurrent.futures.process.BrokenProcessPool):
+            pool.call("x", "exit")
+        # A new set of workers takes over
+        assert pool.call("abc") == "cba"
+        assert not os.listdir(pool._folder)
+    finally:
+        pool.close()
+
+
+def test_workers_do_not_import_functions():
+    pool = calishot_procpool.ProcessPool(loaded, 1)
+    try:
+        assert pool.call("calishot_procpool") and not pool.call("functions")
+    finally:
+        pool.close()
+
+
+def test_build_index_with_reader_processes(functions, make_site, add_books, index_db, monkeypatch):
+    a = make_site("siteA", "http://10.0.0.1:8080")
+    add_books(a, range(1, 301))
+    monkeypatch.setattr(functions.calishot_indexsync, "CHUNK_ROWS", 50)
+    stats = functions.build_index(workers=2)
+    assert stats["upserted"] == 300
+    assert index_db().execute("SELECT COUNT(*) FROM summary").fetchone()[0] == 300
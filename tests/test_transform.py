@@ -0,0 +1,16 @@
+import calishot_transform
+from conftest import record
+
+
+def test_language_cache_is_created_on_first_run(tmp_path):
+    path = tmp_path / "langid_cache.db"
+    stage = calishot_transform.TransformStage(workers=0, cache_path=str(path), cache_size=10)
+    assert stage.cache is None and not path.exists()
+
+    book = dict(record(1), languages=[], comments="The quick brown fox jumps over the lazy dog.")
+    rows = stage.run([("1", book)], "main")
+    assert rows[0]["language"] == "eng"
+    assert path.exists() and stage.cache.misses == 1
+    stage.run([("1", book)], "main")
+    assert stage.cache.hits == 1
+    stage.close()
@@ -0,0 +1,29 @@
+import sqlite3
+
+import calishot_writer
+
+
+def library_rows(path):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute("SELECT url, library, book_count_per_library, last_book_count_per_library, "
+                            "new_books_per_library FROM libraries_per_server ORDER BY url, library").fetchall()
+    finally:
+        conn.close()
+
+
+def test_writer_and_direct_library_counts_agree(functions, workdir):
+    queued = workdir / "queued"
+    queued.mkdir()
+    sqlite3.connect(queued / "sites.db").execute("CREATE TABLE sites (uuid TEXT PRIMARY KEY, url TEXT)").connection.close()
+    writer = calishot_writer.SitesWriter(queued / "sites.db")
+    for count in (10, 25, 20):
+        writer.upsert_library_count("http://a:8080", "main", count)
+        functions.upsert_library_count("http://a:8080", "main", count, dir=str(workdir / "data"))
+    writer.upsert_library_count("http://a:8080", "other", None)
+    functions.upsert_library_count("http://a:8080", "other", None, dir=str(workdir / "data"))
+    writer.close()
+
+    expected = [("http://a:8080", "main", 20, 25, 0), ("http://a:8080", "other", 0, 0, 0)]
+    assert library_rows(queued / "sites.db") == expected
+    assert library_rows(workdir / "data" / "sites.db") == expected
@@ -27,7 +27,10 @@ def update_database_schema(db_path):
         ("last_download", "TEXT"),
         # Ensure demeter_id and active exist for Demeter host management
         ("demeter_id", "INTEGER UNIQUE"),
-        ("active", "INTEGER DEFAULT 0")
+        ("active", "INTEGER DEFAULT 0"),
+        # Health-check scheduling (calishot_schedule)
+        ("next_check_at", "TEXT"),
+        ("change_rate", "REAL")
     ]
     
     # Change error column type from INTEGER to TEXT if needed